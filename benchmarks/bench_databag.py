@@ -0,0 +1,67 @@
+"""Compare a databag holding large nested data flattened into top level keys
+(the old behaviour) against keeping it as a source, for building script
+environments and rendering templates.
+
+    python benchmarks/bench_databag.py [nested keys] [repeats]
+"""
+import sys
+import timeit
+import tracemalloc
+import ringmaster.util as util
+from ringmaster import constants
+from ringmaster.databag import Databag
+
+TEMPLATE = "vpc: {{ resourcesvpcconfig_vpcid }}\nname: {{ name }}\n"
+
+
+def cluster_info(count):
+    return [{
+        "Name": "test",
+        "ResourcesVpcConfig": {"VpcId": "vpc-1", "SubnetIds": [f"subnet-{i}" for i in range(count // 10)]},
+        "Tags": {f"Tag{i}": {"Value": f"value-{i}", "Nested": [i, i + 1]} for i in range(count)},
+    }]
+
+
+def build(nested, as_source):
+    data = Databag({f"key_{i}": f"value_{i}" for i in range(200)})
+    if as_source:
+        data.add_source("eks_cluster", nested)
+    else:
+        data.update(util.flatten_nested_dict(nested))
+    return data
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    nested = cluster_info(count)
+
+    for label, as_source in [("flattened", False), ("source", True)]:
+        tracemalloc.start()
+        data = build(nested, as_source)
+        data.get("resourcesvpcconfig_vpcid")
+        held = tracemalloc.get_traced_memory()[0]
+
+        def env():
+            # every script changes the databag so the cache rarely helps,
+            # sources are only stringified again when they change
+            data["counter"] = data.get("counter", 0) + 1
+            util.merge_env(data)
+
+        def render():
+            data["counter"] = data.get("counter", 0) + 1
+            util.substitute_placeholders_from_memory_to_memory(TEMPLATE, constants.UP_VERB, data)
+
+        tracemalloc.reset_peak()
+        env()
+        render()
+        per_call = tracemalloc.get_traced_memory()[1] - held
+        tracemalloc.stop()
+
+        print(f"{label}: {len(data)} top level keys, databag and index {held / 1024:.0f}KiB, "
+              f"env + render peak {per_call / 1024:.0f}KiB")
+        print(f"  environment x{repeats}: {timeit.timeit(env, number=repeats):.3f}s")
+        print(f"  render x{repeats}: {timeit.timeit(render, number=repeats):.3f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""Time starting the CLI. Each import is timed in a fresh interpreter as
+imported modules are cached.
+
+    python benchmarks/bench_imports.py [runs]
+"""
+import sys
+import subprocess
+import timeit
+
+MODULES = ["ringmaster.cli", "ringmaster.aws", "ringmaster.snowflake", "ringmaster.k8s", "ringmaster.cloudflare"]
+
+
+def import_time(modules, runs):
+    statement = ";".join(f"import {module}" for module in modules)
+
+    def run():
+        subprocess.run([sys.executable, "-c", statement], check=True)
+
+    return min(timeit.repeat(run, number=1, repeat=runs))
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    baseline = import_time(["sys"], runs)
+    print(f"best of {runs}, interpreter startup ({baseline:.3f}s) excluded")
+    for module in MODULES:
+        print(f"import {module}: {import_time([module], runs) - baseline:.3f}s")
+
+    # what every run used to import
+    print(f"cli + all handler modules (old startup): {import_time(MODULES, runs) - baseline:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
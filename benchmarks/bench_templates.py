@@ -0,0 +1,61 @@
+"""Compare rendering a stack of templates with a new jinja environment per
+call (the old behaviour) against the shared environment and template cache.
+
+    python benchmarks/bench_templates.py [templates] [renders]
+"""
+import os
+import sys
+import timeit
+import tempfile
+from jinja2 import StrictUndefined
+import ringmaster.util as util
+from ringmaster import constants
+
+
+def old_substitute(raw, data):
+    jinja_env = util.jinja_environment(StrictUndefined)
+    template = jinja_env.from_string(raw)
+    return template.render({**data, "env": os.environ.copy()})
+
+
+def make_templates(count):
+    return [
+        "\n".join(
+            f"  key_{i}_{j}: {{{{ value_{j} }}}}-{{{{ value_{j} | b64encode }}}}"
+            for j in range(40)
+        )
+        for i in range(count)
+    ]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    renders = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    templates = make_templates(count)
+    data = {f"value_{j}": f"v{j}" for j in range(40)}
+    data.update({f"extra_{j}": j for j in range(2000)})
+
+    def old():
+        for _ in range(renders):
+            for raw in templates:
+                old_substitute(raw, data)
+
+    def new():
+        for _ in range(renders):
+            for raw in templates:
+                util.substitute_placeholders_from_memory_to_memory(raw, constants.UP_VERB, data)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        util.template_cache_dir = cache_dir
+        print(f"{count} templates rendered {renders} times each")
+        print(f"new environment per call: {timeit.timeit(old, number=1):.3f}s")
+        print(f"shared environment (cold): {timeit.timeit(new, number=1):.3f}s")
+        print(f"shared environment (warm): {timeit.timeit(new, number=1):.3f}s")
+
+        # next run: fresh environments, bytecode from disk
+        util.template_environments.clear()
+        print(f"shared environment (bytecode cache): {timeit.timeit(new, number=1):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
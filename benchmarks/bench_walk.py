@@ -0,0 +1,61 @@
+"""Compare the old recursive `util.walk` with the iterative version on wide
+(`eksctl get cluster` like) and deep nested data.
+
+    python benchmarks/bench_walk.py [repeats]
+"""
+import sys
+import timeit
+import ringmaster.util as util
+
+
+def old_walk(data, parent_name=None):
+    seq_iter = data if isinstance(data, dict) else range(len(data))
+    for i in seq_iter:
+        if parent_name:
+            me = f"{parent_name}_{i}"
+        else:
+            me = i
+
+        if isinstance(data[i], dict):
+            for k, v in old_walk(data[i], parent_name=me):
+                yield k, v
+        elif isinstance(data[i], list) or isinstance(data[i], tuple):
+            for k, v in old_walk(data[i], parent_name=me):
+                yield k, v
+        else:
+            yield me, data[i]
+
+
+def wide(count):
+    return [{
+        "Name": "test",
+        "ResourcesVpcConfig": {"VpcId": "vpc-1", "SubnetIds": [f"subnet-{i}" for i in range(count // 10)]},
+        "Tags": {f"Tag{i}": {"Value": f"value-{i}", "Nested": [i, {"Deeper": i}]} for i in range(count)},
+    }]
+
+
+def deep(depth, leaves):
+    data = {f"leaf{i}": i for i in range(leaves)}
+    for level in range(depth):
+        data = {f"Level{level}": data, "Sibling": level}
+    return data
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for label, data in [("wide", wide(5000)), ("deep", deep(50, 2000))]:
+        count = len(list(old_walk(data)))
+        print(f"{label}: {count} values, {repeats} walks")
+        print(f"  recursive: {timeit.timeit(lambda: list(old_walk(data)), number=repeats):.3f}s")
+        print(f"  iterative: {timeit.timeit(lambda: list(util.walk(data)), number=repeats):.3f}s")
+
+    data = wide(5000)
+    print(f"flatten_nested_dict, wide, {repeats} runs")
+    print(f"  everything:                 {timeit.timeit(lambda: util.flatten_nested_dict(data), number=repeats):.3f}s")
+    print(f"  prefix resourcesvpcconfig: "
+          f"{timeit.timeit(lambda: util.flatten_nested_dict(data, prefix='resourcesvpcconfig'), number=repeats):.3f}s")
+    print(f"  max_depth 2:                {timeit.timeit(lambda: util.flatten_nested_dict(data, max_depth=2), number=repeats):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
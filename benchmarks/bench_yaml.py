@@ -0,0 +1,67 @@
+"""Compare reading CloudFormation parameters and writing the databag before
+and after the move to libyaml and cached section parsing. Uses the bundled
+examples plus a large generated template (like the AWS quickstarts).
+
+    python benchmarks/bench_yaml.py [repeats]
+"""
+import os
+import sys
+import glob
+import timeit
+import tempfile
+import yaml
+from cfn_tools import load_yaml
+import ringmaster.yaml_io as yaml_io
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), "..", "examples")
+
+
+def large_template(resources):
+    parts = ["Parameters:\n"]
+    parts += [f"  Param{i}:\n    Type: String\n    Default: value{i}\n" for i in range(50)]
+    parts.append("Resources:\n")
+    parts += [
+        f"  Bucket{i}:\n    Type: AWS::S3::Bucket\n    Properties:\n"
+        f"      BucketName: !Sub \"${{AWS::StackName}}-{i}\"\n"
+        f"      Tags:\n        - Key: name\n          Value: !Ref Param{i % 50}\n"
+        for i in range(resources)
+    ]
+    return "".join(parts)
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with tempfile.TemporaryDirectory() as temp_dir:
+        large = os.path.join(temp_dir, "large.cloudformation.yaml")
+        with open(large, "w") as f:
+            f.write(large_template(1000))
+
+        templates = sorted(glob.glob(os.path.join(EXAMPLES_DIR, "*", "*.cloudformation.yaml"))) + [large]
+        for filename in templates:
+            with open(filename) as f:
+                lines = len(f.readlines())
+
+            def old():
+                with open(filename) as f:
+                    load_yaml(f.read()).get("Parameters")
+
+            def new():
+                yaml_io.cloudformation_cache.clear()
+                yaml_io.cloudformation_sections(filename, ["Parameters"])
+
+            def cached():
+                yaml_io.cloudformation_sections(filename, ["Parameters"])
+
+            print(f"{os.path.basename(filename)} ({lines} lines), {repeats} reads")
+            print(f"  cfn_tools full parse: {timeit.timeit(old, number=repeats):.3f}s")
+            print(f"  Parameters section:   {timeit.timeit(new, number=repeats):.3f}s")
+            print(f"  cached:               {timeit.timeit(cached, number=repeats):.3f}s")
+
+    databag = {f"key_{i}": f"value_{i}" for i in range(5000)}
+    print(f"databag with {len(databag)} keys, {repeats} dumps")
+    print(f"  yaml.dump:    {timeit.timeit(lambda: yaml.dump(databag), number=repeats):.3f}s")
+    print(f"  yaml_io.dump: {timeit.timeit(lambda: yaml_io.dump(databag), number=repeats):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
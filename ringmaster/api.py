@@ -14,22 +14,26 @@
 from datetime import datetime
 from urllib.parse import urlparse, urlunparse
 import importlib
-import requests
+import importlib.metadata
+import importlib.util
+import shutil
+import configparser
 import os
 import glob
 import yaml
-import json
 import sys
-import tempfile
 from loguru import logger
 from ringmaster import constants as constants
-import ringmaster.k8s as k8s
-import ringmaster.aws as aws
-import ringmaster.snowflake as snowflake
+import threading
 from pathlib import Path
 import ringmaster.version as version
 import ringmaster.util as util
-import ringmaster.cloudflare as cloudflare
+import ringmaster.dag as dag
+import ringmaster.state as state
+import ringmaster.channel as channel
+import ringmaster.databag as databag
+import ringmaster.yaml_io as yaml_io
+from ringmaster.databag import Databag
 
 debug = False
 
@@ -47,12 +51,10 @@ env_dir = None
 def init_databag():
     """per-run program specific data"""
 
-    # users write values as JSON to this file and they are added to the
-    # databag incrementally
-    _, intermediate_databag_file = tempfile.mkstemp(suffix="json", prefix="ringmaster")
-
+    # users write values as JSON lines to this file and they are added to
+    # the databag incrementally
     return {
-        constants.KEY_INTERMEDIATE_DATABAG: intermediate_databag_file,
+        constants.KEY_INTERMEDIATE_DATABAG: channel.create(),
         "debug": "debug" if debug else "",
     }
 
@@ -62,7 +64,7 @@ def load_databag(databag_file):
     data = {}
     if os.path.exists(databag_file):
         with open(databag_file) as f:
-            data.update(yaml.safe_load(f))
+            data.update(yaml_io.load(f))
     else:
         logger.warning(f"missing databag file: {databag_file}")
 
@@ -72,24 +74,23 @@ def load_databag(databag_file):
 
 def load_intermediate_databag(data):
     intermediate_databag_file = data[constants.KEY_INTERMEDIATE_DATABAG]
-    if os.path.getsize(intermediate_databag_file):
-        # grab stashed databag
-        logger.debug(f"loading databag left by last stage from {intermediate_databag_file}")
-        with open(intermediate_databag_file, "r") as json_file:
-            extra_data = json.load(json_file)
-
-        logger.debug(f"loaded {len(extra_data)} items: {extra_data}")
+    extra_data = channel.read(intermediate_databag_file)
+    if extra_data:
+        logger.debug(f"loaded {len(extra_data)} items from {intermediate_databag_file}: {extra_data}")
         data.update(extra_data)
 
-        # empty the bag for next iteration
-        open(intermediate_databag_file, 'w').close()
-
 
 def do_bash_script(working_dir, filename, verb, data):
     # bash scripts
     logger.info(f"bash script: {filename}")
-    logger.info(f"write JSON to file at ${constants.KEY_INTERMEDIATE_DATABAG} to add to databag")
-    util.run_cmd(f"bash {filename} {verb}", data)
+    logger.info(
+        f"append JSON lines to file at ${constants.KEY_INTERMEDIATE_DATABAG} or "
+        f"pipe at ${constants.KEY_INTERMEDIATE_DATABAG_PIPE} to add to databag"
+    )
+    # scripts may pass anything on to helpers so export every value, as if
+    # nested databag sources were flattened
+    with channel.pipe(data):
+        util.run_cmd(f"bash {filename} {verb}", data, keep_output=False)
 
     load_intermediate_databag(data)
 
@@ -115,53 +116,214 @@ def do_ringmaster_python(working_dir, filename, verb, data):
     module.main(verb)
 
 
+# handlers are either functions or "module.function" names in this package.
+# Handler modules pull in big SDKs (boto3, snowflake...) so they are only
+# imported the first time a matching file is seen, see `handler_module()`
 handlers = {
     constants.PATTERN_BASH: do_bash_script,
-    constants.PATTERN_LOCAL_CLOUDFORMATION_FILE: aws.do_local_cloudformation,
-    constants.PATTERN_REMOTE_CLOUDFORMATION_FILE: aws.do_remote_cloudformation,
-    constants.PATTERN_KUBECTL_FILE: k8s.do_kubectl,
-    constants.PATTERN_KUSTOMIZATION_FILE: k8s.do_kustomizer,
+    constants.PATTERN_LOCAL_CLOUDFORMATION_FILE: "aws.do_local_cloudformation",
+    constants.PATTERN_REMOTE_CLOUDFORMATION_FILE: "aws.do_remote_cloudformation",
+    constants.PATTERN_KUBECTL_FILE: "k8s.do_kubectl",
+    constants.PATTERN_KUSTOMIZATION_FILE: "k8s.do_kustomizer",
     constants.PATTERN_RINGMASTER_PYTHON_FILE: do_ringmaster_python,
-    constants.PATTERN_SNOWFLAKE_SQL: snowflake.do_snowflake_sql,
-    constants.PATTERN_SNOWFLAKE_QUERY: snowflake.do_snowflake_query,
-    constants.PATTERN_HELM_DEPLOY: k8s.do_helm,
-    constants.PATTERN_AWS_IAM_POLICY: aws.do_iam_policy,
-    constants.PATTERN_AWS_IAM_ROLE: aws.do_iam_role,
-    constants.PATTERN_SECRETS_MANAGER: aws.do_secrets_manager,
-    constants.PATTERN_EKSCTL_CONFIG: aws.do_eksctl,
-    constants.PATTERN_SECRET_KUBECTL: k8s.do_secret_kubectl,
-    constants.PATTERN_CLOUDFLARE: cloudflare.do_cloudflare,
+    constants.PATTERN_SNOWFLAKE_SQL: "snowflake.do_snowflake_sql",
+    constants.PATTERN_SNOWFLAKE_QUERY: "snowflake.do_snowflake_query",
+    constants.PATTERN_HELM_DEPLOY: "k8s.do_helm",
+    constants.PATTERN_AWS_IAM_POLICY: "aws.do_iam_policy",
+    constants.PATTERN_AWS_IAM_ROLE: "aws.do_iam_role",
+    constants.PATTERN_SECRETS_MANAGER: "aws.do_secrets_manager",
+    constants.PATTERN_EKSCTL_CONFIG: "aws.do_eksctl",
+    constants.PATTERN_SECRET_KUBECTL: "k8s.do_secret_kubectl",
+    constants.PATTERN_CLOUDFLARE: "cloudflare.do_cloudflare",
+}
+
+
+# handlers that can process several adjacent, independent files at once
+batch_handlers = {
+    constants.PATTERN_LOCAL_CLOUDFORMATION_FILE: "aws.do_local_cloudformation_batch",
+    constants.PATTERN_KUBECTL_FILE: "k8s.do_kubectl_batch",
+    constants.PATTERN_HELM_DEPLOY: "k8s.do_helm_batch",
 }
 
+# batch handlers that keep files talking to the same system in order
+# themselves, so files only need to be independent in terms of databag keys
+ordered_batch_patterns = {constants.PATTERN_KUBECTL_FILE, constants.PATTERN_HELM_DEPLOY}
+
+
+# handler modules with a section in `connections.yaml`
+CONNECTION_MODULES = ["aws", "snowflake", "k8s"]
+
+# settings from `connections.yaml`, see `setup_connections()`
+connections = {}
+
+# handler modules loaded so far and those `setup_connection()` has been
+# run for
+loaded_modules = set()
+connected_modules = set()
+
+# module name -> {attribute: value} to set on handler modules when they are
+# loaded, for commandline options
+handler_settings = {}
+
+# handlers may be loaded from parallel workers
+handler_lock = threading.RLock()
+
+
+def setup_loaded_connections():
+    """run `setup_connection()` for any handler module that has been imported
+    since the last call"""
+    with handler_lock:
+        for name in CONNECTION_MODULES:
+            module = sys.modules.get(f"ringmaster.{name}")
+            if module and name not in connected_modules:
+                logger.debug(f"setting up connection: {name}")
+                module.setup_connection(connections.get(name))
+                connected_modules.add(name)
+
+
+def handler_module(name):
+    """import the handler module `name` and set it up on first use"""
+    with handler_lock:
+        module = importlib.import_module(f"ringmaster.{name}")
+        if name not in loaded_modules:
+            for attribute, value in handler_settings.get(name, {}).items():
+                setattr(module, attribute, value)
+            loaded_modules.add(name)
+
+        # handler modules can import each other, eg cloudflare uses aws
+        setup_loaded_connections()
+    return module
+
+
+def resolve_handler(handler):
+    """function for a `handlers` or `batch_handlers` entry"""
+    if isinstance(handler, str):
+        module_name, function_name = handler.rsplit(".", 1)
+        handler = getattr(handler_module(module_name), function_name)
+    return handler
+
 
 def get_handler_for_file(filename):
     handler = None
     for pattern in  handlers.keys():
         if filename.endswith(pattern):
-            handler = handlers[pattern]
+            handler = resolve_handler(handlers[pattern])
             break
     return handler
 
 
 
+def databag_changes(before, after):
+    """values in `after` that were added or changed since `before`"""
+    return {
+        k: v for k, v in after.items()
+        if k not in (constants.KEY_INTERMEDIATE_DATABAG, constants.KEY_INTERMEDIATE_DATABAG_PIPE) and (k not in before or before[k] != v)
+    }
+
+
+def check_unchanged(working_dir, filename, data):
+    """returns (unchanged, fingerprint) for `filename`. Unchanged files have
+    the databag values they added last time replayed"""
+    fingerprint = state.fingerprint(working_dir, filename, data)
+    outputs = state.recorded_outputs(filename, fingerprint)
+    unchanged = outputs is not None and not state.force
+    if unchanged:
+        logger.info(f"unchanged since last run - skipping: {filename}")
+        data.update(outputs)
+    return unchanged, fingerprint
+
+
 def do_file(working_dir, filename, verb, data):
     handler = get_handler_for_file(filename)
     if handler and verb == constants.METADATA_VERB:
         metadata[constants.METADATA_FILES_KEY][os.path.basename(filename)] = {
             constants.METADATA_HASH_KEY: util.hash_file(filename)
         }
+    elif handler and verb == constants.UP_VERB:
+        unchanged, fingerprint = check_unchanged(working_dir, filename, data)
+        if not unchanged:
+            before = data.copy()
+            handler(working_dir, filename, verb, data)
+            state.record(filename, fingerprint, databag_changes(before, data))
     elif handler:
         handler(working_dir, filename, verb, data)
+        state.forget(filename)
     else:
         logger.debug(f"no handler for {filename} - skipped")
 
 
-def do_stage(working_dir, data, stage, verb):
-    """process the children of an 'inner' dir in order, eg:
-    stacks/
-        0010 <--- this level
-            somefile.yaml
-    """
+def get_batch_pattern_for_file(filename):
+    pattern = None
+    for batch_pattern in batch_handlers.keys():
+        if filename.endswith(batch_pattern):
+            pattern = batch_pattern
+            break
+    return pattern
+
+
+def plan_batches(filenames):
+    """split `filenames` into a list of (batch_pattern, [filenames]) keeping
+    their order. Adjacent files with the same batch handler that don't
+    depend on each other are grouped together, everything else is on its
+    own with `batch_pattern` set to `None`"""
+    # runs of adjacent files with the same batch pattern
+    runs = []
+    for filename in filenames:
+        pattern = get_batch_pattern_for_file(filename)
+        if pattern and runs and runs[-1][0] == pattern:
+            runs[-1][1].append(filename)
+        else:
+            runs.append((pattern, [filename]))
+
+    batches = []
+    for pattern, run in runs:
+        if not pattern:
+            batches.append((pattern, run))
+            continue
+
+        # one graph per run, a file joins the current batch if it doesn't
+        # depend on anything already in it
+        graph = dag.build_graph(run, pattern not in ordered_batch_patterns)
+        batch = []
+        for filename in run:
+            if graph[filename].intersection(batch):
+                batches.append((pattern, batch))
+                batch = []
+            batch.append(filename)
+        batches.append((pattern, batch))
+
+    return [(pattern if len(batch) > 1 else None, batch) for pattern, batch in batches]
+
+
+def do_batch(working_dir, pattern, filenames, verb, data):
+    """process `filenames` together with the batch handler for `pattern`"""
+    handler = resolve_handler(batch_handlers[pattern])
+    if verb == constants.UP_VERB:
+        fingerprints = {}
+        for filename in filenames:
+            unchanged, fingerprint = check_unchanged(working_dir, filename, data)
+            if not unchanged:
+                fingerprints[filename] = fingerprint
+
+        if fingerprints:
+            before = data.copy()
+            handler(working_dir, list(fingerprints.keys()), verb, data)
+            changes = databag_changes(before, data)
+
+            # batched files always have known outputs, use them to work out
+            # which file added what
+            for filename, fingerprint in fingerprints.items():
+                _, writes = dag.analyse_file(filename)
+                state.record(filename, fingerprint, {k: v for k, v in changes.items() if k in writes})
+    else:
+        handler(working_dir, filenames, verb, data)
+        for filename in filenames:
+            state.forget(filename)
+
+
+def walk_stage(stage):
+    """yield (root, files) for each directory in stage in the order they
+    should be processed"""
     for root, dirs, files in os.walk(stage, topdown=True, followlinks=True):
         # modify dirs in-place to exclude dirs to skip and all their children
         # https://stackoverflow.com/a/19859907/3441106
@@ -169,115 +331,367 @@ def do_stage(working_dir, data, stage, verb):
 
         # and then sort the files...
         files.sort()
-        for file in files:
-            filename = os.path.join(root, file)
+        yield root, files
+
+
+def stage_files(stage):
+    """list of every file in stage in the order they would be processed"""
+    return [os.path.join(root, file) for root, files in walk_stage(stage) for file in files]
+
+
+def do_stage(working_dir, data, stage, verb):
+    """process the children of an 'inner' dir in order, eg:
+    stacks/
+        0010 <--- this level
+            somefile.yaml
+    """
+    if verb == constants.METADATA_VERB:
+        for filename in stage_files(stage):
             do_file(working_dir, filename, verb, data)
+    else:
+        # batches can span directories, eg one helm_deploy.yaml per directory
+        for pattern, batch in plan_batches(stage_files(stage)):
+            if pattern:
+                do_batch(working_dir, pattern, batch, verb, data)
+            else:
+                do_file(working_dir, batch[0], verb, data)
+
+            checkpoint_output_databag(data)
+
+        save_output_databag(data)
 
-        if verb != constants.METADATA_VERB:
+
+def do_stages_parallel(working_dir, data, stages, verb, workers):
+    """process all files in `stages` on a pool of `workers` threads. Files are
+    started as soon as every file they depend on has been processed (see
+    `dag.py`). When going down the dependency graph is reversed"""
+    # always analyse in the order files would be brought up
+    up_stages = list(reversed(stages)) if verb == constants.DOWN_VERB else stages
+    stage_for_file = {filename: stage for stage in up_stages for filename in stage_files(stage)}
+    graph = dag.build_graph(list(stage_for_file.keys()))
+    if verb == constants.DOWN_VERB:
+        graph = dag.reverse_graph(graph)
+
+    files_left_in_stage = {stage: 0 for stage in stages}
+    for stage in stage_for_file.values():
+        files_left_in_stage[stage] += 1
+
+    def start_fn(filename):
+        # each file gets its own copy of the databag and intermediate
+        # databag file. Taken now so everything it depends on is present
+        snapshot = data.copy()
+
+        def run_fn():
+            file_data = snapshot.copy()
+            file_data.update(init_databag())
+            try:
+                do_file(working_dir, filename, verb, file_data)
+            finally:
+                channel.delete(file_data[constants.KEY_INTERMEDIATE_DATABAG])
+
+            # only hand back what this file changed
+            return databag_changes(snapshot, file_data)
+
+        return run_fn
+
+    def done_fn(filename, changes):
+        logger.debug(f"completed: {filename} changes:{changes}")
+        data.update(changes)
+        checkpoint_output_databag(data)
+
+        stage = stage_for_file[filename]
+        files_left_in_stage[stage] -= 1
+        if not files_left_in_stage[stage]:
+            logger.info(f"stage complete: {stage}")
             save_output_databag(data)
 
+    logger.info(f"processing {len(graph)} files with {workers} workers")
+    util.spinners = False
+    try:
+        dag.run_graph(graph, start_fn, done_fn, workers)
+    finally:
+        util.spinners = True
+
+
+# template variable -> command to print the version of a tool handlers run
+TOOL_VERSION_COMMANDS = {
+    "aws_version": ["aws", "--version"],
+    "eksctl_version": ["eksctl", "version"],
+    "kubectl_version": ["kubectl", "version", "--short", "--client"],
+    "helm_version": ["helm", "version", "--short"],
+}
+
+# template variable -> python distribution handlers use
+PACKAGE_VERSIONS = {
+    "boto3_version": "boto3",
+    "cloudflare_version": "cloudflare",
+    "snowflake_connector_version": "snowflake-connector-python",
+}
+
+
+def tool_versions():
+    """versions of the tools in `TOOL_VERSION_COMMANDS`. Running them is
+    slow so versions are cached until the executable on the path changes"""
+    cache_file = os.path.abspath(constants.TOOL_VERSIONS_FILE)
+    try:
+        cache = util.read_yaml_file(cache_file)
+    except (OSError, RuntimeError, yaml.YAMLError):
+        cache = {}
+
+    versions = {}
+    updated = {}
+    for key, cmd in TOOL_VERSION_COMMANDS.items():
+        executable = shutil.which(cmd[0])
+        if not executable:
+            versions[key] = "not found"
+            continue
+
+        stat = os.stat(executable)
+        signature = f"{executable}:{stat.st_mtime_ns}:{stat.st_size}"
+        cached = cache.get(key) or {}
+        if cached.get("signature") == signature:
+            versions[key] = cached["version"]
+        else:
+            versions[key] = util.run_cmd(cmd).strip()
+        updated[key] = {"signature": signature, "version": versions[key]}
+
+    if updated != cache:
+        util.save_yaml_file(cache_file, updated)
+    return versions
+
+
+def package_versions():
+    """versions of the python packages in `PACKAGE_VERSIONS` without
+    importing them"""
+    versions = {}
+    for key, distribution in PACKAGE_VERSIONS.items():
+        try:
+            versions[key] = importlib.metadata.version(distribution)
+        except importlib.metadata.PackageNotFoundError:
+            versions[key] = "not installed"
+    return versions
+
 
 def system_info():
-    aws_version = util.run_cmd(["aws", "--version"]).strip()
-    eksctl_version = util.run_cmd(["eksctl", "version"]).strip()
-    kubectl_version = util.run_cmd(["kubectl", "version", "--short", "--client"]).strip()
-    helm_version = util.run_cmd(["helm", "version", "--short"]).strip()
-
-    message = util.process_res_template(
-        "system_info.txt",
-        aws_version=aws_version,
-        boto3_version=aws.boto3_version(),
-        cloudflare_version=cloudflare.cloudflare_version(),
-        eksctl_version=eksctl_version,
-        helm_version=helm_version,
-        kubectl_version=kubectl_version,
-        snowflake_connector_version=snowflake.snowflake_connector_version()
-    )
+    message = util.process_res_template("system_info.txt", **tool_versions(), **package_versions())
 
     logger.info(message)
 
 
-def setup_connections():
+def aws_profile_exists(profile):
+    """look for a named profile the way botocore does, without importing it"""
+    files = [
+        (os.environ.get("AWS_CONFIG_FILE", constants.AWS_CONFIG_FILE),
+         profile if profile == "default" else f"profile {profile}"),
+        (os.environ.get("AWS_SHARED_CREDENTIALS_FILE", constants.AWS_CREDENTIALS_FILE), profile),
+    ]
+    for filename, section in files:
+        parser = configparser.ConfigParser()
+        try:
+            parser.read(os.path.expanduser(filename))
+        except configparser.Error as e:
+            raise RuntimeError(f"[AWS] unable to read {filename}: {e}")
+        if parser.has_section(section):
+            return True
+    return False
+
+
+def check_connections(connections):
+    """check the profiles in each section of `connections.yaml` exist before
+    anything runs. Handler modules are only set up when first used so a
+    mistake here would otherwise fail part way through a run"""
+    for name in CONNECTION_MODULES:
+        settings = connections.get(name)
+        if settings is None:
+            continue
+
+        profile = util.get_connection_profile(settings, name)
+        if name == "aws" and not aws_profile_exists(profile):
+            raise RuntimeError(f"[AWS] No such profile: {profile} (aws configure --profile {profile})")
+        elif name == "snowflake":
+            snowflake_config_file = os.path.expanduser(constants.SNOWFLAKE_CONFIG_FILE)
+            if not os.path.exists(snowflake_config_file):
+                raise RuntimeError(f"snowflake settings not found at: {snowflake_config_file}")
+            if profile not in (util.read_yaml_file(snowflake_config_file) or {}):
+                raise RuntimeError(f"snowflake profile {profile} not found in: {snowflake_config_file}")
 
+
+def setup_connections():
+    """read `connections.yaml` for handler modules to set themselves up with
+    when they are first used. The AWS profile is exported straight away as
+    scripts, kubectl and helm can all need it"""
+    global connections
     connections = get_env_connections()
-    aws.setup_connection(connections.get("aws"))
-    snowflake.setup_connection(connections.get("snowflake"))
-    k8s.setup_connection(connections.get("k8s"))
+    check_connections(connections)
+    aws_profile = (connections.get("aws") or {}).get(constants.PROFILE)
+    if aws_profile:
+        os.environ["AWS_PROFILE"] = aws_profile
+    util.set_env_prefixes(connections.get(constants.ENV_PREFIXES_KEY))
+
+    with handler_lock:
+        connected_modules.clear()
+        setup_loaded_connections()
 
     # no connection info for cloudflare - you can only manage a DNS zone once
     # so this will either work or it wont...
 
+
+def close_connections():
+    """close pooled connections, if the handler was used"""
+    module = sys.modules.get("ringmaster.snowflake")
+    if module:
+        module.close_connections()
+
+
 def run(project_dir, filename, merge, env_name, verb):
     if os.path.exists(filename):
         data = get_env_databag(os.getcwd(),merge, env_name)
         setup_connections()
 
-        do_file(project_dir, filename, verb, data)
-        save_output_databag(data)
+        try:
+            do_file(project_dir, filename, verb, data)
+            save_output_databag(data)
+        finally:
+            close_connections()
     else:
         logger.error(f"file not found: {filename}")
 
 
 def delete_output_databag():
-    output_databag_file = get_output_databag_filename()
-    if os.path.exists(output_databag_file):
-        logger.debug(f"deleting databag: {output_databag_file}")
-        os.unlink(output_databag_file)
+    databag.delete(get_output_databag_filename())
+
+
+def checkpoint_output_databag(data):
+    """journal databag changes so far, cheap enough to call after every file"""
+    databag.checkpoint(data, get_output_databag_filename())
 
 
 def save_output_databag(data):
+    """save the databag along with state, call at the end of each stage"""
     output_databag_file = get_output_databag_filename()
     logger.info(f"saving output databag:{output_databag_file}")
-    util.save_yaml_file(
-        output_databag_file,
-        data,
-        "# generated by ringmaster, do not edit!\n"
-    )
+    databag.save(data, output_databag_file, "# generated by ringmaster, do not edit!\n")
+    state.save(get_state_filename())
+    dag.save_index(get_index_filename())
+
+
+def select_stages(subdir, start, verb):
+    """stages in `subdir` in the order they should be processed beginning at
+    `start`, empty if `start` doesn't exist"""
+    # for some reason the default order is reversed when using ranges so we
+    # must always sort. If we are bringing down a stack, reverse the order
+    # to process steps last->first - dont rely on strange behaviour
+    stages = sorted(glob.glob(f"./{subdir}/[0-9][0-9][0-9][0-9]*"), reverse=(verb == constants.DOWN_VERB))
+    first_dir = os.path.basename(stages[0])
+    last_dir = os.path.basename(stages[-1])
+    if not start:
+        start = first_dir if constants.UP_VERB else last_dir
+        logger.debug(f"setting start dir:{start}")
+
+    started = False
+    selected_stages = []
+    for stage in stages:
+        logger.debug(stage)
+        if not started:
+            number = os.path.basename(stage)
+            if number == start:
+                started = True
+
+        if started:
+            selected_stages.append(stage)
+
+    return selected_stages
+
+
+def check(working_dir, subdir, merge, env_name, start):
+    """report databag keys templates and cloudformation parameters need that
+    nothing will provide, without talking to any external systems. The keys
+    each stage produces and consumes are saved to `index.yaml`"""
+    if not os.path.exists(subdir):
+        raise RuntimeError(f"missing directory: {subdir}")
+
+    data = get_env_databag(working_dir, merge, env_name)
+    channel.delete(data[constants.KEY_INTERMEDIATE_DATABAG])
+    selected_stages = select_stages(subdir, start, constants.UP_VERB)
+    if not selected_stages:
+        raise RuntimeError(f"start dir - not found: {start}")
+
+    available = set(data.keys()) | set(data.source_keys())
+    # last file we can't know the outputs of
+    unknown_producer = None
+    missing = 0
+    for stage in selected_stages:
+        produces = set()
+        consumes = set()
+        for filename in stage_files(stage):
+            reads, writes = dag.analyse_file(filename)
+            try:
+                required = dag.required_keys(filename)
+            except Exception as e:
+                logger.error(f"{filename}: unable to check - {e}")
+                missing += 1
+                required = []
+
+            for alternatives in required:
+                if not available.intersection(alternatives):
+                    if unknown_producer:
+                        logger.warning(f"{filename}: {alternatives[0]} not in databag, maybe set by {unknown_producer}")
+                    else:
+                        logger.error(f"{filename}: {alternatives[0]} not in databag and not set by any earlier file")
+                        missing += 1
+
+            consumes |= dag.databag_keys(reads) if reads is not None else set()
+            if writes is None:
+                unknown_producer = filename
+            else:
+                produces |= dag.databag_keys(writes)
+                available |= dag.databag_keys(writes)
+
+        dag.stage_index[stage] = {
+            dag.INDEX_PRODUCES_KEY: sorted(produces),
+            dag.INDEX_CONSUMES_KEY: sorted(consumes),
+        }
+
+    dag.save_index(get_index_filename())
+    if missing:
+        raise RuntimeError(f"check failed: {missing} unresolved variables")
+    logger.info(f"check passed: {len(selected_stages)} stages")
 
 
-def run_dir(working_dir, subdir, merge, env_name, start, verb):
+def run_dir(working_dir, subdir, merge, env_name, start, verb, parallel=0):
     """process an 'outer' dir and all its children in order, eg:
     stacks/ <--- this level
         0010
             somefile.yaml
+
+    if `parallel` is set, independent files are processed concurrently
+    using this many workers
     """
     if os.path.exists(subdir):
         logger.debug(f"found: {subdir}")
-        started = False
-
         data = get_env_databag(os.getcwd(), merge, env_name)
         setup_connections()
 
-        # for some reason the default order is reversed when using ranges so we
-        # must always sort. If we are bringing down a stack, reverse the order
-        # to process steps last->first - dont rely on strange behaviour
-        stages = sorted(glob.glob(f"./{subdir}/[0-9][0-9][0-9][0-9]*"), reverse=(verb == constants.DOWN_VERB))
-        first_dir = os.path.basename(stages[0])
-        last_dir = os.path.basename(stages[-1])
-        if not start:
-            start = first_dir if constants.UP_VERB else last_dir
-            logger.debug(f"setting start dir:{start}")
-
-        for stage in stages:
-            logger.debug(stage)
-            if not started:
-                number = os.path.basename(stage)
-                if number == start:
-                    started = True
-
-            if started:
-                logger.debug(f"stage: {stage}")
-                do_stage(working_dir, data, stage, verb)
-
-        if not started:
-            logger.error(f"start dir - not found: {start}")
+        selected_stages = select_stages(subdir, start, verb)
+        try:
+            if not selected_stages:
+                logger.error(f"start dir - not found: {start}")
+            elif parallel:
+                do_stages_parallel(working_dir, data, selected_stages, verb, parallel)
+            else:
+                for stage in selected_stages:
+                    logger.debug(f"stage: {stage}")
+                    do_stage(working_dir, data, stage, verb)
+        finally:
+            close_connections()
 
         # cleanup
         logger.debug("delete intermediate databag")
-        os.unlink(data[constants.KEY_INTERMEDIATE_DATABAG])
+        channel.delete(data[constants.KEY_INTERMEDIATE_DATABAG])
 
         if verb == constants.DOWN_VERB:
             delete_output_databag()
+            state.delete(get_state_filename())
 
     else:
         logger.error(f"missing directory: {subdir}")
@@ -289,7 +703,7 @@ def check_ok_to_update(local_metadata_file, remote_url):
     if os.path.exists(local_metadata_file):
         logger.debug(f"loading metadata:{local_metadata_file}")
         with open(local_metadata_file) as f:
-            local_metadata = yaml.safe_load(f)
+            local_metadata = yaml_io.load(f)
             logger.debug(f"metadata loaded:{local_metadata}")
         local_url = local_metadata.get(constants.SOURCE_KEY)
         if local_url == remote_url:
@@ -308,11 +722,13 @@ def check_ok_to_update(local_metadata_file, remote_url):
 def download_metadata_yaml(url):
     # append METADATA_FILE to the end of path if missing...
     metadata_url = util.change_url_filename(url, constants.METADATA_FILE)
-    return yaml.safe_load(requests.get(metadata_url).text)
+    import requests
+    return yaml_io.load(requests.get(metadata_url).text)
 
 
 def download_files_from_metadata(directory, new_metadata, base_url):
     """ download each file listed in new_metadata['files'] to `directory` """
+    import requests
     for filename, file_metadata in new_metadata.get(constants.METADATA_FILES_KEY, {}).items():
         local_file = os.path.join(directory, filename)
         remote_url = util.change_url_filename(base_url, filename)
@@ -417,17 +833,23 @@ def get_env_databag(working_dir, merge, env_name):
     logger.debug(f"sequential load dirs: {sequential_load_dirs}")
 
     # shallow
-    data = constants.DEFAULT_DATABAG.copy()
+    data = Databag(constants.DEFAULT_DATABAG)
     for look_at_dir in sequential_load_dirs:
         databag_file = os.path.join(look_at_dir, constants.DATABAG_FILE)
         output_databag_file = os.path.join(look_at_dir, constants.OUTPUT_DATABAG_FILE)
         target_databag_file = output_databag_file \
             if os.path.exists(output_databag_file) else databag_file
         data.update(load_databag(target_databag_file))
+        databag.replay_journal(data, output_databag_file)
 
     data.update(init_databag())
     # `env` will clash with scoped environment variables
     data[constants.DATABAG_ENV_KEY] = env_name
+
+    # only journal changes made from now on
+    data.dirty.clear()
+    state.load(get_state_filename())
+    dag.load_index(get_index_filename())
     return data
 
 
@@ -435,3 +857,15 @@ def get_output_databag_filename():
     if not env_dir:
         raise RuntimeError("databag_load_dir not set, databag not loaded yet")
     return os.path.join(env_dir, constants.OUTPUT_DATABAG_FILE)
+
+
+def get_state_filename():
+    if not env_dir:
+        raise RuntimeError("env_dir not set, databag not loaded yet")
+    return os.path.join(env_dir, constants.STATE_FILE)
+
+
+def get_index_filename():
+    if not env_dir:
+        raise RuntimeError("env_dir not set, databag not loaded yet")
+    return os.path.join(env_dir, constants.INDEX_FILE)
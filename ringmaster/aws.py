@@ -15,47 +15,101 @@ import re
 import subprocess
 import os
 import json
-from contextlib import ExitStack
+import time
+import uuid
+import threading
 from loguru import logger
 import boto3
 import snakecase
 import pathlib
 import ringmaster.util as util
 from ringmaster import constants as constants
-from cfn_tools import load_yaml
+import ringmaster.yaml_io as yaml_io
 import botocore.exceptions
-from halo import Halo
-from ringmaster.util import flatten_nested_dict
+import botocore.config
 
 # AWS/boto3 API error messages to look for. Use partial regex to protect
 # against upstream changes as much as we can
 ERROR_UP_TO_DATE = r"No updates are to be performed"
-ERROR_AWS = r"encountered a terminal failure state"
 ERROR_MISSING = r"does not exist"
 ERROR_NO_SUCH_ENTITY = r"NoSuchEntity"
 
+# databag source for `eksctl get cluster` output
+EKS_CLUSTER_SOURCE = "eks_cluster"
+
+# seconds between polls of describe_stack_events - start fast and back off
+# while nothing is happening
+CLOUDFORMATION_MIN_DELAY = 1
+CLOUDFORMATION_MAX_DELAY = 15
+CLOUDFORMATION_MAX_DELAY_KEY = "cloudformation_max_delay"
+cloudformation_max_delay = CLOUDFORMATION_MAX_DELAY
+
+# botocore tuning, settable in connections.yaml. Parallel runs need more
+# than the default 10 pooled connections per client
+MAX_POOL_CONNECTIONS_KEY = "max_pool_connections"
+MAX_POOL_CONNECTIONS = 10
+RETRY_MODE_KEY = "retry_mode"
+RETRY_MODE = "adaptive"
+MAX_ATTEMPTS_KEY = "max_attempts"
+MAX_ATTEMPTS = 10
+botocore_config = botocore.config.Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={"mode": RETRY_MODE, "max_attempts": MAX_ATTEMPTS},
+)
+
+# creating sessions and clients means reading credentials, config and service
+# models from disk so do it once per process. Sessions aren't thread safe but
+# the clients they create are, so only create them while holding the lock
+boto3_lock = threading.RLock()
+boto3_sessions = {}
+boto3_clients = {}
+
 
 def setup_connection(connection_settings):
+    global cloudformation_max_delay
+    global botocore_config
     profile_name = util.get_connection_profile(connection_settings, "aws")
     os.environ["AWS_PROFILE"] = profile_name
+    cloudformation_max_delay = connection_settings.get(CLOUDFORMATION_MAX_DELAY_KEY, CLOUDFORMATION_MAX_DELAY)
+
+    with boto3_lock:
+        botocore_config = botocore.config.Config(
+            max_pool_connections=connection_settings.get(MAX_POOL_CONNECTIONS_KEY, MAX_POOL_CONNECTIONS),
+            retries={
+                "mode": connection_settings.get(RETRY_MODE_KEY, RETRY_MODE),
+                "max_attempts": connection_settings.get(MAX_ATTEMPTS_KEY, MAX_ATTEMPTS),
+            },
+        )
+        boto3_sessions.clear()
+        boto3_clients.clear()
 
     # check named profile exists
     try:
-        _ = boto3.Session(profile_name=profile_name)
+        _ = get_boto3_session()
     except botocore.exceptions.ProfileNotFound:
         raise RuntimeError(f"[AWS] No such profile: {profile_name} (aws configure --profile {profile_name})")
 
 
-def get_boto3_session():
-    """get a boto3 session configured with the requested profile or bomb out"""
-    # profile_name = util.get_connection_profile(connection, "aws")
-    # try:
-    #     session = boto3.Session(profile_name=profile_name)
-    # except botocore.exceptions.ProfileNotFound:
-    #     raise RuntimeError(f"[AWS] No such profile: {profile_name} (aws configure --profile {profile_name})")
-    # return session
+def get_boto3_session(region_name=None):
+    """get the shared boto3 session for the active profile and `region_name`
+    (default: from profile)"""
+    key = (os.environ.get("AWS_PROFILE"), region_name)
+    with boto3_lock:
+        if key not in boto3_sessions:
+            logger.debug(f"boto3 - new session profile:{key[0]} region:{region_name}")
+            boto3_sessions[key] = boto3.Session(profile_name=key[0], region_name=region_name)
+        return boto3_sessions[key]
+
 
-    return boto3.Session()
+def get_boto3_client(service_name, region_name=None):
+    """get the shared boto3 client for `service_name`. Clients are safe to
+    use from multiple threads"""
+    key = (os.environ.get("AWS_PROFILE"), region_name, service_name)
+    with boto3_lock:
+        if key not in boto3_clients:
+            logger.debug(f"boto3 - new client profile:{key[0]} region:{region_name} service:{service_name}")
+            boto3_clients[key] = get_boto3_session(region_name).client(service_name, config=botocore_config)
+        return boto3_clients[key]
 
 
 def get_eksctl_cmd():
@@ -64,21 +118,42 @@ def get_eksctl_cmd():
     return ["eksctl"]
 
 
-def route_table_for_subnet(ec2, subnet_id):
-    # get the route tables
-    logger.debug(f"looking describe_route_table subnet_id:{subnet_id}")
-    response = ec2.describe_route_tables(
-        Filters=[{
-            'Name': 'association.subnet-id',
-            'Values': [subnet_id]
-        }]
-    )
-    try:
-        logger.debug(f"...result: {response}")
-        route_table_id = response["RouteTables"][0]["RouteTableId"]
-    except KeyError as e:
-        logger.warn(f"aws - no RouteTableId found for subnet {subnet_id} - associated?")
-        route_table_id = None
+# vpc_id -> (subnet_id -> route_table_id, main route_table_id), looked up once
+# per run
+vpc_route_tables_cache = {}
+vpc_route_tables_lock = threading.Lock()
+
+
+def vpc_route_tables(ec2, vpc_id):
+    """return (explicit subnet associations, main route table id) for every
+    route table in `vpc_id` using a single paginated lookup"""
+    with vpc_route_tables_lock:
+        if vpc_id not in vpc_route_tables_cache:
+            logger.debug(f"describe_route_tables vpc_id:{vpc_id}")
+            associations = {}
+            main_route_table_id = None
+            paginator = ec2.get_paginator("describe_route_tables")
+            for page in paginator.paginate(Filters=[{"Name": "vpc-id", "Values": [vpc_id]}]):
+                for route_table in page["RouteTables"]:
+                    for association in route_table.get("Associations", []):
+                        if association.get("Main"):
+                            main_route_table_id = route_table["RouteTableId"]
+                        elif association.get("SubnetId"):
+                            associations[association["SubnetId"]] = route_table["RouteTableId"]
+
+            logger.debug(f"...result: {associations} main: {main_route_table_id}")
+            vpc_route_tables_cache[vpc_id] = (associations, main_route_table_id)
+
+        return vpc_route_tables_cache[vpc_id]
+
+
+def route_table_for_subnet(ec2, vpc_id, subnet_id):
+    """route table for `subnet_id`, subnets without an explicit association
+    use the main route table for the VPC"""
+    associations, main_route_table_id = vpc_route_tables(ec2, vpc_id)
+    route_table_id = associations.get(subnet_id, main_route_table_id)
+    if not route_table_id:
+        logger.warning(f"aws - no RouteTableId found for subnet {subnet_id} - associated?")
 
     return route_table_id
 
@@ -93,9 +168,10 @@ def eks_cluster_info(cluster_name, data):
         data
     )
 
-    flattened_eksctl_data = flatten_nested_dict(eksctl_data)
-    logger.debug(f"loaded items:{len(flattened_eksctl_data)} data:{flattened_eksctl_data}")
-    data.update(flattened_eksctl_data)
+    # kept nested, flattened names like `resourcesvpcconfig_vpcid` are
+    # looked up on demand
+    data.add_source(EKS_CLUSTER_SOURCE, eksctl_data)
+    logger.debug(f"loaded eks cluster info: {eksctl_data}")
 
     #   + cluster_vpc_cidr
     #   + cluster_private_subnets
@@ -106,7 +182,7 @@ def eks_cluster_info(cluster_name, data):
     #   + cluster_public_subnet_{n}
     #   + cluster_public_route_tables
     #   + cluster_public_route_table_{n}
-    ec2 = get_boto3_session().client('ec2')
+    ec2 = get_boto3_client('ec2')
     try:
 
         # VPC CIDR block
@@ -139,7 +215,7 @@ def eks_cluster_info(cluster_name, data):
         #   + cluster_public_route_table_{n}
         data["cluster_public_route_tables"] = []
         for i, value in enumerate(public_subnet_ids):
-            route_table_id = route_table_for_subnet(ec2, public_subnet_ids[i])
+            route_table_id = route_table_for_subnet(ec2, data['resourcesvpcconfig_vpcid'], public_subnet_ids[i])
             data["cluster_public_route_tables"].append(route_table_id)
             data[f"cluster_public_route_table{i+1}"] = route_table_id
 
@@ -147,7 +223,7 @@ def eks_cluster_info(cluster_name, data):
         #   + cluster_private_route_table_{n}
         data["cluster_private_route_tables"] = []
         for i, value in enumerate(private_subnet_ids):
-            route_table_id = route_table_for_subnet(ec2, private_subnet_ids[i])
+            route_table_id = route_table_for_subnet(ec2, data['resourcesvpcconfig_vpcid'], private_subnet_ids[i])
             data["cluster_private_route_tables"].append(route_table_id)
             data[f"cluster_private_route_table{i+1}"] = route_table_id
 
@@ -163,7 +239,8 @@ def eks_cluster_info(cluster_name, data):
         # strip `https://` from the start of identity_oidc_issuer or we get
         # errors. Its impossible to do this natively in cloudformation so
         # simple munge here
-        if "identity_oidc_issuer" in data:
+        # the issuer comes from the nested cluster source, which `in` doesn't see
+        if data.get("identity_oidc_issuer") is not None:
             data["identity_oidc_issuer_stripped"] = \
                 data["identity_oidc_issuer"].replace("https://", "")
 
@@ -195,10 +272,8 @@ def stack_params(filename, data):
     # will barf, so grab the parameter names from the CFN file and then
     # grab the corresponding parameters from the databag. If anything is
     # missing bomb out now before CFN does.
-    # parse with cfn_flip as pyyaml cant handle things like `!Ref`
-    # https://stackoverflow.com/a/55349491/3441106
     logger.debug(f"reading cloudformation parameters from {filename}")
-    parsed = load_yaml(pathlib.Path(filename).read_text())
+    parsed = yaml_io.cloudformation_sections(filename, ["Parameters"])
 
     params = []
 
@@ -315,16 +390,151 @@ def do_local_cloudformation(working_dir, filename, verb, data):
             raise e
 
 
+def do_local_cloudformation_batch(working_dir, filenames, verb, data):
+    """submit every stack in `filenames` and then wait for them all at once.
+    The stacks must not depend on each other. Outputs are added to the
+    databag in file order once every stack is finished"""
+    client = get_boto3_client('cloudformation')
+    watches = []
+    try:
+        for filename in filenames:
+            logger.info(f"cloudformation {filename}")
+            template_body = pathlib.Path(filename).read_text()
+            stack_name = filename_to_stack_name(filename)
+            try:
+                watch = submit_cloudformation(client, stack_name, filename, verb, data, template_body=template_body)
+            except KeyError as e:
+                if verb == constants.DOWN_VERB:
+                    logger.warning(f"missing values prevent running cloudformation - skipping as system going down: {e}")
+                    continue
+                else:
+                    raise e
+
+            if watch:
+                watches.append(watch)
+    except BaseException:
+        # always wait for anything we started, even if a later submit failed,
+        # but report the submit failure rather than any error waiting
+        try:
+            watch_stacks(client, watches)
+        except Exception as e:
+            logger.error(f"error waiting for cloudformation stacks after submit failed: {e}")
+        raise
+    else:
+        watch_stacks(client, watches)
+
+    if verb != constants.DOWN_VERB:
+        for filename in filenames:
+            cloudformation_outputs(client, filename_to_stack_name(filename), data)
+
+
 def get_prefixed_stack_name(stack_name, data):
     return f"{data['name']}-{stack_name}"
 
 
-def cloudformation(stack_name, filename, verb, data, template_body=None, template_url=None):
+def new_stack_events(client, stack_id, token, seen):
+    """return events for `token` not in `seen` (oldest first), paging back
+    through stack history until we reach events we have already seen or
+    that belong to an earlier request"""
+    events = []
+    kwargs = {"StackName": stack_id}
+    while True:
+        response = client.describe_stack_events(**kwargs)
+        for event in response.get("StackEvents", []):
+            if event["EventId"] in seen or event.get("ClientRequestToken") != token:
+                return list(reversed(events))
+            events.append(event)
+
+        if not response.get("NextToken"):
+            return list(reversed(events))
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def is_stack_event(event, stack_name):
+    """True if `event` is about the stack itself rather than a resource"""
+    return event.get("ResourceType") == "AWS::CloudFormation::Stack" \
+        and event.get("LogicalResourceId") == stack_name
+
+
+def new_watch(stack_id, stack_name, token, success_status):
+    """everything needed to follow a stack through a single request"""
+    return {
+        "stack_id": stack_id,
+        "stack_name": stack_name,
+        "token": token,
+        "success_status": success_status,
+        "seen": set(),
+        "first_failure": None,
+        "status": None,
+    }
+
+
+def poll_stack(client, watch):
+    """log any new events for a watched stack and record its status once it
+    reaches a terminal state. Returns True if anything happened"""
+    events = new_stack_events(client, watch["stack_id"], watch["token"], watch["seen"])
+    for event in events:
+        watch["seen"].add(event["EventId"])
+        status = event.get("ResourceStatus", "")
+        reason = event.get("ResourceStatusReason", "")
+        logger.info(f"[{watch['stack_name']}] {event.get('LogicalResourceId')} {status} {reason}".rstrip())
+
+        if status.endswith("_FAILED") and not watch["first_failure"]:
+            watch["first_failure"] = event
+
+        if is_stack_event(event, watch["stack_name"]) and not status.endswith("_IN_PROGRESS"):
+            watch["status"] = status
+
+    return bool(events)
+
+
+def watch_failure(watch):
+    first_failure = watch["first_failure"]
+    if first_failure:
+        reason = f"{first_failure.get('LogicalResourceId')}: {first_failure.get('ResourceStatusReason')}"
+    else:
+        reason = "no failure reason reported"
+    return f"stack {watch['stack_name']} {watch['status']} - {reason}"
+
+
+def watch_stacks(client, watches):
+    """stream events for every watched stack to the log until they have all
+    reached a terminal state. Raise with the reason the first resource in
+    each stack failed if any didn't reach their `success_status`"""
+    waiting = list(watches)
+    failures = []
+    delay = CLOUDFORMATION_MIN_DELAY
+    while waiting:
+        changed = False
+        for watch in list(waiting):
+            changed = poll_stack(client, watch) or changed
+            if watch["status"]:
+                waiting.remove(watch)
+                if watch["status"] != watch["success_status"]:
+                    failures.append(watch_failure(watch))
+
+        if waiting:
+            # poll quickly while things are changing
+            delay = CLOUDFORMATION_MIN_DELAY if changed else min(delay * 2, cloudformation_max_delay)
+            time.sleep(delay)
+
+    if failures:
+        raise RuntimeError(f"cloudformation failed - {', '.join(failures)}")
+
+
+def watch_stack(client, stack_id, stack_name, token, success_status):
+    """wait for a single stack, see `watch_stacks()`"""
+    watch_stacks(client, [new_watch(stack_id, stack_name, token, success_status)])
+
+
+def submit_cloudformation(client, stack_name, filename, verb, data, template_body=None, template_url=None):
+    """start creating, updating or deleting a stack without waiting for the
+    result. Returns a watch for `watch_stacks()` or `None` if there is
+    nothing to wait for"""
     sanity_check(data)
 
     prefixed_stack_name = get_prefixed_stack_name(stack_name, data)
     params = stack_params(filename, data)
-    client = get_boto3_session().client('cloudformation')
     exists = stack_exists(client, prefixed_stack_name)
 
     if template_body:
@@ -340,7 +550,11 @@ def cloudformation(stack_name, filename, verb, data, template_body=None, templat
             "cloudformation - missing both TemplateBody and TemplateURL"
         )
 
-    act = False
+    watch = None
+
+    # every event caused by our request carries this token, letting us pick
+    # them out of the stack history
+    token = f"ringmaster-{uuid.uuid4()}"
 
     if exists and verb == constants.UP_VERB:
         # update
@@ -349,19 +563,21 @@ def cloudformation(stack_name, filename, verb, data, template_body=None, templat
                 StackName=prefixed_stack_name,
                 Parameters=params,
                 Capabilities=['CAPABILITY_NAMED_IAM'],
+                ClientRequestToken=token,
                 **template_source
-            )
+            )["StackId"]
 
-        waiter_name = "stack_update_complete"
-        act = True
+        success_status = "UPDATE_COMPLETE"
     elif exists and verb == constants.DOWN_VERB:
-        # delete
+        # delete - deleted stacks can only be looked up by ID
         def ensure_fn():
-            return client.delete_stack(
+            stack_id = client.describe_stacks(StackName=prefixed_stack_name)["Stacks"][0]["StackId"]
+            client.delete_stack(
                 StackName=prefixed_stack_name,
+                ClientRequestToken=token,
             )
-        waiter_name = "stack_delete_complete"
-        act = True
+            return stack_id
+        success_status = "DELETE_COMPLETE"
     elif not exists and verb == constants.UP_VERB:
         # create
         def ensure_fn():
@@ -369,55 +585,50 @@ def cloudformation(stack_name, filename, verb, data, template_body=None, templat
                 StackName=prefixed_stack_name,
                 Parameters=params,
                 Capabilities=['CAPABILITY_NAMED_IAM'],
+                ClientRequestToken=token,
                 **template_source
-            )
-        waiter_name = "stack_create_complete"
-        act = True
+            )["StackId"]
+        success_status = "CREATE_COMPLETE"
     elif not exists and verb == constants.DOWN_VERB:
         # already deleted
         logger.info(constants.MSG_UP_TO_DATE)
+        return None
     else:
         raise RuntimeError(f"bad arguments in run_cloudformation - exists:{exists} verb:{verb}")
 
-    if act:
-        logger.debug(
-            f"cloudformation stack:{prefixed_stack_name} file: {filename}"
-        )
+    logger.debug(
+        f"cloudformation stack:{prefixed_stack_name} file: {filename}"
+    )
 
-        # do the deed...
-        debug = data.get("debug", False)
-        try:
-            with ExitStack() as stack:
-                message = f"Cloudformation {stack_name}"
-                if not debug and not util.is_ci():
-                    stack.enter_context(Halo(text=message, spinner='dots'))
-                else:
-                    logger.info(message)
-                response = ensure_fn()
-                logger.debug(f"response: {response}")
-
-                # ...wait for the result
-                waiter = client.get_waiter(waiter_name)
-                waiter.wait(
-                    StackName=prefixed_stack_name,
-                )
+    # do the deed...
+    try:
+        logger.info(f"Cloudformation {stack_name}")
+        stack_id = ensure_fn()
+        logger.debug(f"stack_id: {stack_id}")
+        watch = new_watch(stack_id, prefixed_stack_name, token, success_status)
 
-        # boto3 exceptions...
-        # https://github.com/boto/botocore/blob/develop/botocore/exceptions.py
-        except botocore.exceptions.ClientError as e:
-            logger.debug(f"boto/client exception: {e}")
-            if re.search(ERROR_UP_TO_DATE, str(e), flags=re.IGNORECASE):
-                logger.info(constants.MSG_UP_TO_DATE)
-            else:
-                # no idea
-                raise e
-        except botocore.exceptions.WaiterError as e:
-            logger.debug(f"botocore/waiter exception: {e}")
-            if re.search(ERROR_AWS, str(e), flags=re.IGNORECASE):
-                raise RuntimeError(f"cloudformation failed - check stack {prefixed_stack_name} in the AWS console")
-            else:
-                # no idea
-                raise e
+    # boto3 exceptions...
+    # https://github.com/boto/botocore/blob/develop/botocore/exceptions.py
+    except botocore.exceptions.ClientError as e:
+        logger.debug(f"boto/client exception: {e}")
+        if re.search(ERROR_UP_TO_DATE, str(e), flags=re.IGNORECASE):
+            logger.info(constants.MSG_UP_TO_DATE)
+        else:
+            # no idea
+            raise e
+
+    return watch
+
+
+def cloudformation(stack_name, filename, verb, data, template_body=None, template_url=None):
+    client = get_boto3_client('cloudformation')
+    watch = submit_cloudformation(
+        client, stack_name, filename, verb, data, template_body=template_body, template_url=template_url
+    )
+
+    # ...wait for the result
+    if watch:
+        watch_stacks(client, [watch])
 
     # ...If we're still here our stack is up, grab all the cloudformation
     # outputs and add them to the databag
@@ -431,7 +642,7 @@ def do_iam_policy(working_dir, filename, verb, data):
     basename = os.path.basename(filename)
     policy_name = basename[:-len(constants.PATTERN_AWS_IAM_POLICY)]
     policy_arn = f"arn:aws:iam::{data['aws_account_id']}:policy/{policy_name}"
-    client = get_boto3_session().client('iam')
+    client = get_boto3_client('iam')
 
     try:
         policy_exists = client.get_policy(PolicyArn=policy_arn)
@@ -496,7 +707,7 @@ def do_iam_role(working_dir, filename, verb, data):
 
     basename = os.path.basename(filename)
     name = basename[:-len(constants.PATTERN_AWS_IAM_ROLE)]
-    client = get_boto3_session().client('iam')
+    client = get_boto3_client('iam')
 
     try:
         exists = client.get_role(RoleName=name)
@@ -592,7 +803,7 @@ def delete_secret(client, secret_id):
 
 
 def ensure_secret(data, verb, secret):
-    client = get_boto3_session().client('secretsmanager')
+    client = get_boto3_client('secretsmanager')
 
     exists, deleted = secret_exists(client, secret["name"])
     if verb == constants.UP_VERB and exists:
@@ -645,9 +856,9 @@ def do_eksctl(working_dir, filename, verb, data):
     if verb == constants.UP_VERB and exists:
         logger.info(constants.MSG_UP_TO_DATE)
     elif verb == constants.UP_VERB and not exists:
-        util.run_cmd(get_eksctl_cmd() + ["create", "cluster", "-f", processed_filename], data)
+        util.run_cmd(get_eksctl_cmd() + ["create", "cluster", "-f", processed_filename], data, keep_output=False)
     elif verb == constants.DOWN_VERB and exists:
-        util.run_cmd(get_eksctl_cmd() + ["delete", "cluster", "--name", cluster_name], data)
+        util.run_cmd(get_eksctl_cmd() + ["delete", "cluster", "--name", cluster_name], data, keep_output=False)
     elif verb == constants.DOWN_VERB and not exists:
         logger.info(constants.MSG_UP_TO_DATE)
     else:
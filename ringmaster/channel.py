@@ -0,0 +1,120 @@
+# Copyright 2020 Declarative Systems Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Values handed back to the databag by scripts.
+
+Scripts append JSON objects, one per line, to `$intermediate_databag_file`.
+Writing a single JSON object over the whole file still works. The file is
+emptied after each read so the next script starts fresh.
+
+Long running scripts can instead write lines to the named pipe at
+`$intermediate_databag_pipe` and the values are merged into the databag as
+they arrive.
+"""
+import os
+import json
+import uuid
+import tempfile
+import threading
+from contextlib import contextmanager
+from loguru import logger
+from ringmaster import constants
+
+PIPE_FILE = "databag.pipe"
+
+
+def create():
+    """new intermediate databag file, each parallel worker gets its own"""
+    _, filename = tempfile.mkstemp(suffix=".jsonl", prefix="ringmaster")
+    return filename
+
+
+def delete(filename):
+    if os.path.exists(filename):
+        os.unlink(filename)
+
+
+def parse(text):
+    """values from JSON lines in `text` or `text` as a single JSON object"""
+    values = {}
+    try:
+        for line in text.splitlines():
+            if line.strip():
+                values.update(json.loads(line))
+    except (ValueError, TypeError):
+        values = json.loads(text)
+    return values
+
+
+def read(filename):
+    """values written to `filename` since the last read"""
+    with open(filename, "r+b") as f:
+        content = f.read()
+        if content:
+            f.seek(0)
+            f.truncate()
+
+    try:
+        return parse(content.decode())
+    except ValueError:
+        raise RuntimeError(f"invalid JSON in intermediate databag: {filename}")
+
+
+@contextmanager
+def pipe(data):
+    """named pipe at `$intermediate_databag_pipe` while the block runs. JSON
+    lines written to it are merged into `data` as they arrive"""
+    if not hasattr(os, "mkfifo"):
+        yield
+        return
+
+    pipe_dir = tempfile.mkdtemp(prefix="ringmaster")
+    path = os.path.join(pipe_dir, PIPE_FILE)
+    os.mkfifo(path)
+
+    # opening read-write never blocks and we never see EOF as writers come
+    # and go, the reader stops when it sees `stop`
+    fd = os.open(path, os.O_RDWR)
+    stop = f"{uuid.uuid4()}\n".encode()
+    errors = []
+
+    def reader():
+        with open(fd, "rb", closefd=False) as f:
+            for line in f:
+                if line == stop:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    values = json.loads(line)
+                    data.update(values)
+                    logger.debug(f"intermediate databag pipe: {list(values.keys())}")
+                except (ValueError, TypeError) as e:
+                    errors.append(f"{line.decode(errors='replace').strip()} ({e})")
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    data[constants.KEY_INTERMEDIATE_DATABAG_PIPE] = path
+    try:
+        yield
+    finally:
+        # a script may have left a partial line
+        os.write(fd, b"\n" + stop)
+        thread.join()
+        os.close(fd)
+        os.unlink(path)
+        os.rmdir(pipe_dir)
+        data.pop(constants.KEY_INTERMEDIATE_DATABAG_PIPE, None)
+
+    if errors:
+        raise RuntimeError(f"invalid JSON in intermediate databag pipe: {errors}")
@@ -14,10 +14,11 @@
 """ringmaster
 
 Usage:
-  ringmaster [--debug] <dir> (up|down) [--start=<dir>] [--env=<dir>] [--no-merge-env]
+  ringmaster [--debug] <dir> (up|down) [--start=<dir>] [--env=<dir>] [--no-merge-env] [--parallel=<n>] [--snowflake-sessions=<n>] [--force]
+  ringmaster [--debug] <dir> check [--start=<dir>] [--env=<dir>] [--no-merge-env]
   ringmaster [--debug] get <dir> <url>
   ringmaster [--debug] metadata <dir> [--include=<files>]
-  ringmaster [--debug] --run <filename> (up|down) [--env=<dir>] [--no-merge-env]
+  ringmaster [--debug] --run <filename> (up|down) [--env=<dir>] [--no-merge-env] [--force]
   ringmaster --version
 
 Options:
@@ -31,6 +32,13 @@ Options:
   --no-merge-env    Do not merge databag values between env directories
   --start=<dir_num> up: start here count up, down: start here count down
   --include=<files> comma delimited list of extra files to add to metadata
+  --parallel=<n>    Process files that don't depend on each other concurrently
+                    using up to <n> workers
+  --snowflake-sessions=<n>
+                    Keep up to <n> snowflake connections open for parallel
+                    runs [default: 1]
+  --force           up: process every file even if nothing changed since the
+                    last run
 """
 
 from loguru import logger
@@ -39,6 +47,7 @@ from docopt import docopt
 import ringmaster.api as api
 import ringmaster.version as version
 import ringmaster.constants as constants
+import ringmaster.state as state
 import os
 
 debug = False
@@ -66,6 +75,8 @@ def main():
     arguments = docopt(__doc__, version=version.__version__)
     setup_logging("DEBUG" if arguments['--debug'] else "INFO")
     api.debug = arguments['--debug']
+    state.force = arguments['--force']
+    api.handler_settings["snowflake"] = {"sessions": int(arguments["--snowflake-sessions"])}
     logger.debug(f"parsed arguments: ${arguments}")
     merge = not arguments.get("--no-merge-env")
     env_name = arguments["--env"]
@@ -79,17 +90,23 @@ def main():
             verb = constants.GET_VERB
         elif arguments["metadata"]:
             verb = constants.METADATA_VERB
+        elif arguments["check"]:
+            verb = constants.CHECK_VERB
         else:
             raise RuntimeError("one of (up|down|get) is required")
 
-        api.system_info()
+        if verb != constants.CHECK_VERB:
+            api.system_info()
         working_dir = os.getcwd()
-        if arguments["get"]:
+        if verb == constants.CHECK_VERB:
+            api.check(working_dir, arguments["<dir>"], merge, env_name, arguments['--start'])
+        elif arguments["get"]:
             api.get(arguments["<dir>"], arguments["<url>"])
         elif arguments["metadata"]:
             api.write_metadata(arguments["<dir>"], arguments.get("--include", []))
         elif arguments["<dir>"]:
-            api.run_dir(working_dir, arguments["<dir>"], merge, env_name, arguments['--start'], verb)
+            parallel = int(arguments["--parallel"] or 0)
+            api.run_dir(working_dir, arguments["<dir>"], merge, env_name, arguments['--start'], verb, parallel)
         elif arguments["--run"]:
             api.run(working_dir, arguments['<filename>'], merge, env_name, verb)
         else:
@@ -16,8 +16,11 @@ UP_VERB = "up"
 DOWN_VERB = "down"
 GET_VERB = "get"
 METADATA_VERB = "metadata"
+CHECK_VERB = "check"
 DATABAG_FILE = "databag.yaml"
 OUTPUT_DATABAG_FILE = f"output_{DATABAG_FILE}"
+STATE_FILE = "state.yaml"
+INDEX_FILE = "index.yaml"
 
 STACK_DIR = "stack"
 USER_DIR = "user"
@@ -46,12 +49,18 @@ SUBSTITUTE_VARIABLE_REGEX = r"(\$\{[^}]+})"
 SINGLE_QUOTED_STRING_REGEX = r"('.*?(?<!\\)')"
 
 KEY_INTERMEDIATE_DATABAG="intermediate_databag_file"
+KEY_INTERMEDIATE_DATABAG_PIPE = "intermediate_databag_pipe"
 
 AWS_TEMPLATE_DIR = "res/aws"
 AWS_USER_TEMPLATE_DIR = "~/.ringmaster/res/aws"
 
 COMMENT_SQL = "--"
 SNOWFLAKE_CLEANUP_FILENAME = "down.snowflake.sql"
+SNOWFLAKE_CONFIG_FILE = "~/.ringmaster/snowflake.yaml"
+
+# where botocore looks for named profiles unless overridden in the environment
+AWS_CONFIG_FILE = "~/.aws/config"
+AWS_CREDENTIALS_FILE = "~/.aws/credentials"
 
 
 CFN_BASE64 = "base64"
@@ -70,6 +79,11 @@ DEFAULT_DATABAG = {
 }
 
 PROCESSED_DIR = ".processed"
+TEMPLATE_CACHE_DIR = ".ringmaster/cache"
+TOOL_VERSIONS_FILE = ".ringmaster/tool_versions.yaml"
 DATABAG_ENV_KEY = "env_name"
 CONNECTIONS_YAML = "connections.yaml"
-PROFILE = "profile"
\ No newline at end of file
+PROFILE = "profile"
+
+# top level list in connections.yaml, see `util.env_prefixes`
+ENV_PREFIXES_KEY = "env_prefixes"
@@ -0,0 +1,517 @@
+# Copyright 2020 Declarative Systems Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Work out which databag keys each file reads and writes so that files which
+don't depend on each other can be processed concurrently.
+
+Analysis is static - nothing is rendered and no external systems are called.
+Where we can't know what a file does (bash scripts, python plugins, ...) the
+file reads and writes "everything" (`None`) which makes it a barrier: it
+waits for everything before it and everything after it waits for it.
+
+Files that talk to the same external system are serialised using resource
+tokens (`@k8s`, `@snowflake`, ...). Tokens are only ever used to express
+read-after-write ordering so that eg cloudformation stacks can all publish
+exports without queuing up behind each other.
+"""
+import os
+import re
+import glob
+import hashlib
+import pathlib
+import threading
+import concurrent.futures
+from loguru import logger
+from jinja2 import meta, nodes
+import snakecase
+import ringmaster.util as util
+import ringmaster.yaml_io as yaml_io
+import ringmaster.version as version
+from ringmaster import constants
+
+TOKEN_PREFIX = "@"
+
+# files talking to the kubernetes cluster run in stage order
+TOKEN_K8S = "@k8s"
+
+# files talking to snowflake run in stage order
+TOKEN_SNOWFLAKE = "@snowflake"
+
+# AWS secrets are created by some handlers and consumed inside the cluster
+# (external-secrets), so k8s files must wait for them
+TOKEN_AWS_SECRETS = "@aws_secrets"
+
+# cloudformation stacks using `Fn::ImportValue` wait for all earlier stacks
+TOKEN_CLOUDFORMATION_EXPORTS = "@cloudformation_exports"
+
+# keys every AWS handler reads via `aws.sanity_check()` and stack naming
+AWS_KEYS = {"aws_region", "aws_account_id", "name"}
+
+# jinja templates can always reference environment variables as `env.NAME`
+TEMPLATE_BUILTINS = {"env"}
+
+# files that are processed with jinja before use
+TEMPLATED_PATTERNS = [
+    constants.PATTERN_KUBECTL_FILE,
+    constants.PATTERN_SNOWFLAKE_SQL,
+    constants.PATTERN_SNOWFLAKE_QUERY,
+    constants.PATTERN_HELM_DEPLOY,
+    constants.PATTERN_SECRETS_MANAGER,
+    constants.PATTERN_EKSCTL_CONFIG,
+    constants.PATTERN_SECRET_KUBECTL,
+    constants.PATTERN_CLOUDFLARE,
+]
+
+# variables used with these filters/tests don't have to be in the databag
+TEMPLATE_OPTIONAL_FILTERS = {"default", "d"}
+TEMPLATE_OPTIONAL_TESTS = {"defined", "undefined"}
+
+# filename -> {INDEX_HASH_KEY: ..., INDEX_READS_KEY: [...], INDEX_WRITES_KEY: [...]}
+# analysis is only repeated when the hash of the file's inputs changes
+analysis_cache = {}
+analysis_lock = threading.Lock()
+
+# stage -> {INDEX_PRODUCES_KEY: [...], INDEX_CONSUMES_KEY: [...]} from the
+# last `check`
+stage_index = {}
+
+INDEX_VERSION_KEY = "ringmaster_version"
+INDEX_FILES_KEY = "files"
+INDEX_STAGES_KEY = "stages"
+INDEX_HASH_KEY = "hash"
+INDEX_READS_KEY = "reads"
+INDEX_WRITES_KEY = "writes"
+INDEX_PRODUCES_KEY = "produces"
+INDEX_CONSUMES_KEY = "consumes"
+
+
+def template_variables(filename):
+    """return the set of databag keys referenced by jinja template `filename`"""
+    source = pathlib.Path(filename).read_text()
+    jinja_env = util.jinja_environment()
+    variables = meta.find_undeclared_variables(jinja_env.parse(source))
+    return set(variables) - TEMPLATE_BUILTINS
+
+
+def required_template_variables(filename):
+    """databag keys template `filename` can't be rendered without. A variable
+    is only optional if every use of it has a `default` or is guarded by an
+    `is defined` test"""
+    source = pathlib.Path(filename).read_text()
+    ast = util.jinja_environment().parse(source)
+    guarded = set()
+    for node in ast.find_all((nodes.Filter, nodes.Test)):
+        if isinstance(node.node, nodes.Name) and (
+                (isinstance(node, nodes.Filter) and node.name in TEMPLATE_OPTIONAL_FILTERS)
+                or (isinstance(node, nodes.Test) and node.name in TEMPLATE_OPTIONAL_TESTS)):
+            guarded.add(id(node.node))
+
+    # uses inside `{% if x is defined %}` or `x if x is defined else ...`
+    for node in ast.find_all((nodes.If, nodes.CondExpr)):
+        test = node.test
+        if not (isinstance(test, nodes.Test) and test.name in TEMPLATE_OPTIONAL_TESTS
+                and isinstance(test.node, nodes.Name)):
+            continue
+        if isinstance(node, nodes.If):
+            branches = [node.body, node.else_]
+        else:
+            branches = [[node.expr1], [node.expr2] if node.expr2 else []]
+        body = branches[0] if test.name == "defined" else branches[1]
+        for child in body:
+            # find_all() only yields descendants
+            names = [child] if isinstance(child, nodes.Name) else child.find_all(nodes.Name)
+            guarded.update(id(name) for name in names if name.name == test.node.name)
+
+    used_bare = {
+        node.name for node in ast.find_all(nodes.Name)
+        if node.ctx == "load" and id(node) not in guarded
+    }
+    return set(meta.find_undeclared_variables(ast)) - TEMPLATE_BUILTINS & used_bare
+
+
+def cloudformation_template(filename):
+    # only the sections analysis looks at
+    return yaml_io.cloudformation_sections(filename, ["Parameters", "Outputs"])
+
+
+def cloudformation_reads(parsed):
+    """databag keys a cloudformation template can take parameters from. Both
+    the raw and snake_case versions are used for lookups (see
+    `aws.stack_params()`)"""
+    reads = set(AWS_KEYS)
+    for cfn_param in parsed.get("Parameters", {}) or {}:
+        reads.add(cfn_param)
+        reads.add(util.string_to_snakecase(cfn_param))
+    return reads
+
+
+def cloudformation_export_name(export_name, stack_name):
+    """resolve an export name to the name `aws.cloudformation_outputs()` will
+    use in the databag. Only `${AWS::StackName}` is resolvable without
+    deploying the stack, anything else returns `None`"""
+    if isinstance(export_name, dict) and "Fn::Sub" in export_name:
+        export_name = export_name["Fn::Sub"]
+        if not isinstance(export_name, str):
+            return None
+        export_name = export_name.replace("${AWS::StackName}", stack_name)
+
+    if not isinstance(export_name, str) or "${" in export_name:
+        return None
+
+    return util.string_to_snakecase(export_name)
+
+
+def cloudformation_writes(parsed, stack_name):
+    """databag keys from the `Outputs` section of a cloudformation template or
+    `None` if any of them can't be worked out"""
+    writes = {TOKEN_CLOUDFORMATION_EXPORTS}
+    for output in (parsed.get("Outputs", {}) or {}).values():
+        export_name = (output.get("Export") or {}).get("Name")
+        if export_name:
+            key = cloudformation_export_name(export_name, stack_name)
+            if key is None:
+                return None
+            writes.add(key)
+    return writes
+
+
+def uses_import_value(filename):
+    return re.search(r"(Fn::ImportValue|!ImportValue)", pathlib.Path(filename).read_text())
+
+
+def analyse_script(filename):
+    # scripts can do anything
+    return None, None
+
+
+def analyse_local_cloudformation(filename):
+    parsed = cloudformation_template(filename)
+    reads = cloudformation_reads(parsed)
+    if uses_import_value(filename):
+        reads.add(TOKEN_CLOUDFORMATION_EXPORTS)
+    # only needed for cloudformation, avoid loading boto3 otherwise
+    import ringmaster.aws as aws
+    return reads, cloudformation_writes(parsed, aws.filename_to_stack_name(filename))
+
+
+def analyse_remote_cloudformation(filename):
+    # template is only available after download
+    return None, None
+
+
+def analyse_kubectl(filename):
+    reads = template_variables(filename) | {TOKEN_K8S, TOKEN_AWS_SECRETS}
+    return reads, {TOKEN_K8S}
+
+
+def analyse_kustomization(filename):
+    return {TOKEN_K8S, TOKEN_AWS_SECRETS}, {TOKEN_K8S}
+
+
+def analyse_snowflake_sql(filename):
+    return template_variables(filename) | {TOKEN_SNOWFLAKE}, {TOKEN_SNOWFLAKE}
+
+
+def analyse_snowflake_query(filename):
+    # column names are only known after running the query
+    return template_variables(filename) | {TOKEN_SNOWFLAKE}, None
+
+
+def analyse_helm(filename):
+    reads = template_variables(filename) | {TOKEN_K8S, TOKEN_AWS_SECRETS}
+    values_yaml = os.path.join(os.path.dirname(filename), "values.yaml")
+    if os.path.exists(values_yaml):
+        reads |= template_variables(values_yaml)
+    return reads, {TOKEN_K8S}
+
+
+def analyse_iam_policy(filename):
+    policy_name = os.path.basename(filename)[:-len(constants.PATTERN_AWS_IAM_POLICY)]
+    return set(AWS_KEYS), {"aws_iam_policy_" + snakecase.convert(policy_name)}
+
+
+def analyse_iam_role(filename):
+    name = os.path.basename(filename)[:-len(constants.PATTERN_AWS_IAM_ROLE)]
+    return set(AWS_KEYS), {"aws_iam_role_" + snakecase.convert(name)}
+
+
+def analyse_secrets_manager(filename):
+    return template_variables(filename) | AWS_KEYS, {TOKEN_AWS_SECRETS}
+
+
+def analyse_eksctl(filename):
+    # the whole `eksctl get cluster` output is flattened into the databag
+    return template_variables(filename) | AWS_KEYS, None
+
+
+def analyse_secret_kubectl(filename):
+    reads = template_variables(filename) | {TOKEN_K8S, TOKEN_AWS_SECRETS}
+    return reads, {TOKEN_K8S}
+
+
+def analyse_cloudflare(filename):
+    return template_variables(filename) | AWS_KEYS, {TOKEN_AWS_SECRETS}
+
+
+analysers = {
+    constants.PATTERN_BASH: analyse_script,
+    constants.PATTERN_LOCAL_CLOUDFORMATION_FILE: analyse_local_cloudformation,
+    constants.PATTERN_REMOTE_CLOUDFORMATION_FILE: analyse_remote_cloudformation,
+    constants.PATTERN_KUBECTL_FILE: analyse_kubectl,
+    constants.PATTERN_KUSTOMIZATION_FILE: analyse_kustomization,
+    constants.PATTERN_RINGMASTER_PYTHON_FILE: analyse_script,
+    constants.PATTERN_SNOWFLAKE_SQL: analyse_snowflake_sql,
+    constants.PATTERN_SNOWFLAKE_QUERY: analyse_snowflake_query,
+    constants.PATTERN_HELM_DEPLOY: analyse_helm,
+    constants.PATTERN_AWS_IAM_POLICY: analyse_iam_policy,
+    constants.PATTERN_AWS_IAM_ROLE: analyse_iam_role,
+    constants.PATTERN_SECRETS_MANAGER: analyse_secrets_manager,
+    constants.PATTERN_EKSCTL_CONFIG: analyse_eksctl,
+    constants.PATTERN_SECRET_KUBECTL: analyse_secret_kubectl,
+    constants.PATTERN_CLOUDFLARE: analyse_cloudflare,
+}
+
+
+def input_files(filename):
+    """every file whose content affects what the handler for `filename` does"""
+    if filename.endswith(constants.PATTERN_KUSTOMIZATION_FILE):
+        # kustomize reads the whole directory
+        inputs = sorted(f for f in glob.glob(os.path.join(os.path.dirname(filename), "*")) if os.path.isfile(f))
+    else:
+        inputs = [filename]
+        values_yaml = os.path.join(os.path.dirname(filename), "values.yaml")
+        if filename.endswith(constants.PATTERN_HELM_DEPLOY) and os.path.exists(values_yaml):
+            inputs.append(values_yaml)
+    return inputs
+
+
+def inputs_hash(filename):
+    digest = hashlib.sha1()
+    for input_file in input_files(filename):
+        digest.update(util.hash_file(input_file).encode())
+    return digest.hexdigest()
+
+
+def to_index(keys):
+    return None if keys is None else sorted(keys)
+
+
+def from_index(keys):
+    return None if keys is None else set(keys)
+
+
+def load_index(index_file):
+    """reuse the analysis saved by an earlier run of the same ringmaster"""
+    global analysis_cache
+    global stage_index
+    index = {}
+    if os.path.exists(index_file) and os.path.getsize(index_file):
+        logger.debug(f"loading index: {index_file}")
+        index = util.read_yaml_file(index_file)
+        if index.get(INDEX_VERSION_KEY) != version.__version__:
+            index = {}
+
+    with analysis_lock:
+        analysis_cache = index.get(INDEX_FILES_KEY) or {}
+        stage_index = index.get(INDEX_STAGES_KEY) or {}
+
+
+def save_index(index_file):
+    """save the analysis of every file seen so far and what each stage
+    produces and consumes"""
+    with analysis_lock:
+        index = {
+            INDEX_VERSION_KEY: version.__version__,
+            INDEX_STAGES_KEY: dict(stage_index),
+            INDEX_FILES_KEY: dict(analysis_cache),
+        }
+
+    logger.debug(f"saving index: {index_file}")
+    util.save_yaml_file(index_file, index, "# generated by ringmaster, do not edit!\n")
+
+
+def analyse_file(filename):
+    """return a tuple of (reads, writes) for `filename`. Each is a set of
+    databag keys and resource tokens or `None` for "everything". Files we
+    don't have a handler for don't read or write anything"""
+    try:
+        file_hash = inputs_hash(filename)
+    except OSError:
+        file_hash = None
+
+    with analysis_lock:
+        cached = analysis_cache.get(filename)
+    if file_hash and cached and cached.get(INDEX_HASH_KEY) == file_hash:
+        return from_index(cached[INDEX_READS_KEY]), from_index(cached[INDEX_WRITES_KEY])
+
+    reads, writes = analyse_uncached(filename)
+    if file_hash:
+        with analysis_lock:
+            analysis_cache[filename] = {
+                INDEX_HASH_KEY: file_hash,
+                INDEX_READS_KEY: to_index(reads),
+                INDEX_WRITES_KEY: to_index(writes),
+            }
+    return reads, writes
+
+
+def analyse_uncached(filename):
+    for pattern, analyser in analysers.items():
+        if filename.endswith(pattern):
+            try:
+                reads, writes = analyser(filename)
+            except Exception as e:
+                # anything we can't parse is treated as a barrier, the
+                # handler will report the real error when it runs
+                logger.warning(f"dependency analysis failed for {filename} - treating as barrier: {e}")
+                reads, writes = None, None
+            logger.debug(f"dependency analysis {filename} reads:{reads} writes:{writes}")
+            return reads, writes
+
+    return set(), set()
+
+
+def required_keys(filename):
+    """list of databag keys `filename` can't be processed without. Each item
+    is a tuple of alternative names, any one of them will do"""
+    required = []
+    if filename.endswith(constants.PATTERN_LOCAL_CLOUDFORMATION_FILE):
+        # see `aws.stack_params()`
+        parameters = cloudformation_template(filename).get("Parameters", {}) or {}
+        for cfn_param, definition in parameters.items():
+            if "Default" not in (definition or {}):
+                required.append((cfn_param, util.string_to_snakecase(cfn_param)))
+    elif any(filename.endswith(pattern) for pattern in TEMPLATED_PATTERNS):
+        for input_file in input_files(filename):
+            required.extend((key,) for key in sorted(required_template_variables(input_file)))
+
+    return required
+
+
+def databag_keys(keys):
+    return {key for key in keys if not key.startswith(TOKEN_PREFIX)}
+
+
+def depends_on(reads, writes, earlier_reads, earlier_writes, tokens=True):
+    """True if a file with `reads`/`writes` must run after an earlier file with
+    `earlier_reads`/`earlier_writes` to get the same result as running them
+    in sequence. Set `tokens` to `False` to only consider databag keys"""
+    if reads is None or writes is None or earlier_reads is None or earlier_writes is None:
+        return True
+
+    if not tokens:
+        reads = databag_keys(reads)
+        earlier_writes = databag_keys(earlier_writes)
+
+    keys_written = databag_keys(writes)
+    return bool(
+        # read after write (keys and tokens)
+        reads & earlier_writes
+        # write after read
+        or keys_written & earlier_reads
+        # write after write
+        or keys_written & databag_keys(earlier_writes)
+    )
+
+
+def build_graph(filenames, tokens=True):
+    """build a dependency graph for `filenames` which must be in the order
+    they would be processed sequentially. Returns a dict of filename -> set
+    of filenames it depends on, in the same order as `filenames`. See
+    `depends_on()` for `tokens`"""
+    analysed = [(filename, *analyse_file(filename)) for filename in filenames]
+    graph = {}
+    for i, (filename, reads, writes) in enumerate(analysed):
+        graph[filename] = {
+            earlier
+            for earlier, earlier_reads, earlier_writes in analysed[:i]
+            if depends_on(reads, writes, earlier_reads, earlier_writes, tokens)
+        }
+    return graph
+
+
+def reverse_graph(graph):
+    """reverse a graph built by `build_graph()` for bringing a stack down:
+    each file now waits for everything that depended on it"""
+    reversed_graph = {filename: set() for filename in reversed(list(graph.keys()))}
+    for filename, dependencies in graph.items():
+        for dependency in dependencies:
+            reversed_graph[dependency].add(filename)
+    return reversed_graph
+
+
+def run_graph(graph, start_fn, done_fn, workers, keep_going=False):
+    """run every node in `graph` on a pool of `workers` threads, starting each
+    node as soon as everything it depends on has completed.
+
+    `start_fn(node)` is called from the calling thread and must return a
+    callable to run on the pool. `done_fn(node, result)` is called from the
+    calling thread with the callable's result as each node completes, so
+    neither need any locking. The first error stops any new nodes from
+    starting and is raised once the running nodes have finished. With
+    `keep_going`, only nodes that depend on a failed node are skipped and a
+    summary of every failure is raised at the end"""
+    remaining = {node: set(dependencies) for node, dependencies in graph.items()}
+    running = {}
+    error = None
+    failures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while remaining or running:
+            if not error:
+                # submit in graph order to keep runs deterministic
+                ready = [node for node, dependencies in remaining.items() if not dependencies]
+                for node in ready:
+                    del remaining[node]
+                    logger.debug(f"starting: {node}")
+                    running[executor.submit(start_fn(node))] = node
+
+            if not running:
+                if remaining and not error:
+                    raise RuntimeError(f"dependency cycle detected between: {list(remaining.keys())}")
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"failed: {node} - {e}")
+                    if keep_going:
+                        failures[node] = e
+                        skip_dependents(remaining, node, failures)
+                    else:
+                        error = error or e
+                    continue
+
+                done_fn(node, result)
+                for dependencies in remaining.values():
+                    dependencies.discard(node)
+
+    if error:
+        raise error
+
+    if failures:
+        summary = "\n".join(f"  {node}: {e}" for node, e in failures.items())
+        raise RuntimeError(f"{len(failures)} failed:\n{summary}")
+
+
+def skip_dependents(remaining, failed_node, failures):
+    """remove everything that depends on `failed_node` from `remaining`"""
+    dependents = [node for node, dependencies in remaining.items() if failed_node in dependencies]
+    for node in dependents:
+        if node in remaining:
+            del remaining[node]
+            logger.error(f"skipped: {node} - depends on {failed_node}")
+            failures[node] = RuntimeError(f"skipped, depends on {failed_node}")
+            skip_dependents(remaining, node, failures)
@@ -0,0 +1,279 @@
+# Copyright 2020 Declarative Systems Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The databag passed to every handler.
+
+A plain dict that counts changes so that things derived from it, like the
+environment for child processes, only need rebuilding when it changes.
+
+Saving the whole databag is slow once it holds thousands of keys so it is
+only written at the end of each stage. In between, the keys that changed are
+appended to a journal next to it which is replayed if a run is interrupted.
+
+Nested data like `eksctl get cluster` output is kept as it is under a
+`source:` key. Its flattened names (see `util.walk()`) are looked up through
+an index built on first use and values are only copied out for the names a
+template uses.
+
+Flattened names work like the defaults of a `defaultdict`: `data[name]` and
+`data.get(name)` find them but they are not keys. `in`, iteration, `len()`,
+`pop()` and `{**data}` only see keys that were set directly. Use
+`source_keys()` to list them and `materialize()` to copy values out.
+"""
+import os
+import json
+from loguru import logger
+import ringmaster.util as util
+import ringmaster.yaml_io as yaml_io
+from ringmaster import constants
+
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_SET_KEY = "set"
+JOURNAL_DELETE_KEY = "delete"
+
+SOURCE_PREFIX = "source:"
+
+# passed to child processes whatever the env prefixes
+ALWAYS_EXPORTED = {constants.KEY_INTERMEDIATE_DATABAG, constants.KEY_INTERMEDIATE_DATABAG_PIPE}
+
+
+def is_source(key):
+    return isinstance(key, str) and key.startswith(SOURCE_PREFIX)
+
+
+def exported(key, prefixes):
+    """True if `key` is passed to child processes: with `prefixes` (lower
+    case), only keys starting with one of them ignoring case and the
+    intermediate databag used to talk to scripts"""
+    return prefixes is None or key in ALWAYS_EXPORTED or str(key).lower().startswith(prefixes)
+
+
+def environment(data, prefixes=None):
+    """databag values as strings ready to pass to a child process, see
+    `exported()` for `prefixes`"""
+    return {
+        key: str(value)
+        for key, value in data.items()
+        if not is_source(key) and exported(key, prefixes)
+    }
+
+
+class Databag(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+        self.environment_cache = None
+
+        # keys changed since the last `checkpoint()` and the version last
+        # written by `save()`
+        self.dirty = set()
+        self.saved_version = None
+
+        # flattened name -> path for nested sources and their values as
+        # strings for child processes
+        self.source_index = None
+        self.source_environment = None
+
+    def changed(self, keys=()):
+        self.version += 1
+        self.dirty.update(keys)
+        if self.source_index is not None and any(is_source(key) for key in keys):
+            self.source_index = None
+            self.source_environment = None
+
+    def __missing__(self, key):
+        path = self.get_source_index().get(key)
+        if path is None:
+            raise KeyError(key)
+        return self.source_value(path)
+
+    def source_value(self, path):
+        value = super().__getitem__(path[0])
+        for step in path[1:]:
+            value = value[step]
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed([key])
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed([key])
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        super().update(other)
+        self.changed(other.keys())
+
+    def pop(self, key, *args):
+        value = super().pop(key, *args)
+        self.changed([key])
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self.changed([item[0]])
+        return item
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def clear(self):
+        keys = list(self.keys())
+        super().clear()
+        self.changed(keys)
+
+    def copy(self):
+        copied = Databag(self)
+        copied.source_index = self.source_index
+        copied.source_environment = self.source_environment
+        return copied
+
+    def environment(self, sources=False, prefixes=None):
+        """cached `environment()` for this databag, rebuilt after changes or
+        if `prefixes` are different. With `sources`, every flattened name
+        from nested sources is included too, direct keys win"""
+        cached = self.environment_cache
+        if not cached or cached[:2] != (self.version, prefixes):
+            cached = (self.version, prefixes, environment(self, prefixes))
+            self.environment_cache = cached
+
+        env = cached[2]
+        if sources and self.get_source_index():
+            # sources change far less often than the rest of the databag
+            if self.source_environment is None or self.source_environment[0] != prefixes:
+                self.source_environment = (prefixes, {
+                    name: str(self.source_value(path))
+                    for name, path in self.get_source_index().items()
+                    if exported(name, prefixes)
+                })
+            env = {**self.source_environment[1], **env}
+        return env
+
+    def add_source(self, name, value):
+        """keep nested `value` as it is under `source:<name>`. Like `update()`
+        with the flattened value, direct keys with the same names are
+        replaced"""
+        key = SOURCE_PREFIX + name
+        if key in self:
+            # move to the end so it wins over earlier sources
+            del self[key]
+        self[key] = value
+        for flattened, path in self.get_source_index().items():
+            if path[0] == key and flattened in self:
+                del self[flattened]
+
+    def get_source_index(self):
+        index = self.source_index
+        if index is None:
+            index = {}
+            for key, value in super().items():
+                if is_source(key) and isinstance(value, (dict, list, tuple)):
+                    for name, path, _ in util.walk_paths(value):
+                        index[str(name).lower()] = (key,) + path
+            self.source_index = index
+        return index
+
+    def source_keys(self):
+        """flattened names available from sources"""
+        return list(self.get_source_index())
+
+    def materialize(self, names):
+        """values from sources for `names`, direct keys are left out"""
+        index = self.get_source_index()
+        return {
+            name: self.source_value(index[name])
+            for name in names
+            if name in index and name not in self
+        }
+
+
+def journal_filename(filename):
+    return filename + JOURNAL_SUFFIX
+
+
+def checkpoint(data, filename):
+    """append the keys changed since the last checkpoint to the journal for
+    `filename`. Only reports success once the entry is on disk"""
+    if not data.dirty:
+        return
+
+    entry = {
+        JOURNAL_SET_KEY: {key: data[key] for key in data.dirty if key in data},
+        JOURNAL_DELETE_KEY: sorted(key for key in data.dirty if key not in data),
+    }
+    logger.debug(f"databag journal: {len(data.dirty)} changed keys")
+    with open(journal_filename(filename), "a") as f:
+        f.write(json.dumps(entry, default=str) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    data.dirty.clear()
+
+
+def save(data, filename, comment=""):
+    """atomically write all of `data` to `filename` if it changed since the
+    last save and drop the journal"""
+    # if we die between writing the file and removing the journal, replaying
+    # must not roll anything back so the journal needs the latest values
+    checkpoint(data, filename)
+    if data.saved_version != data.version or not os.path.exists(filename):
+        util.write_if_changed(filename, comment + yaml_io.dump(dict(data)))
+        data.saved_version = data.version
+    else:
+        logger.debug(f"databag unchanged: {filename}")
+
+    journal = journal_filename(filename)
+    if os.path.exists(journal):
+        os.unlink(journal)
+
+
+def replay_journal(data, filename):
+    """apply changes left in the journal for `filename` by a run that was
+    interrupted before it could save. A half written last entry is ignored"""
+    journal = journal_filename(filename)
+    if not os.path.exists(journal):
+        return
+
+    logger.warning(f"replaying databag journal left by an interrupted run: {journal}")
+    with open(journal) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.warning(f"ignoring incomplete databag journal entry: {line.strip()}")
+                break
+
+            data.update(entry[JOURNAL_SET_KEY])
+            for key in entry[JOURNAL_DELETE_KEY]:
+                data.pop(key, None)
+
+
+def delete(filename):
+    for path in [filename, journal_filename(filename)]:
+        if os.path.exists(path):
+            logger.debug(f"deleting databag: {path}")
+            os.unlink(path)
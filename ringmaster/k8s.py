@@ -13,21 +13,110 @@
 # limitations under the License.
 import tempfile
 import os
-import yaml
+import json
+import hashlib
+import contextvars
+import time
+import threading
+import ringmaster.yaml_io as yaml_io
 import shutil
 from loguru import logger
 from .util import run_cmd
 from pathlib import Path
 from ringmaster import constants
 import ringmaster.util as util
+import ringmaster.state as state
+import ringmaster.dag as dag
 import re
 
 kubectl_context = None
 
+# apply all the `.kubectl.yaml` files in a directory with one kubectl command
+BATCH_APPLY_KEY = "batch_apply"
+batch_apply = False
+
+# use `kubectl apply --server-side`
+SERVER_SIDE_APPLY_KEY = "server_side_apply"
+server_side_apply = False
+
+# context -> time a working connection was checked, shared by every kubectl
+# handler
+sessions = {}
+sessions_lock = threading.Lock()
+SESSION_TTL_SECONDS = 300
+
+# context -> repos, releases and chart availability, see `get_helm_state()`
+helm_state = {}
+helm_lock = threading.RLock()
+HELM_REPOS_KEY = "repos"
+HELM_RELEASES_KEY = "releases"
+HELM_UPDATED_KEY = "updated"
+HELM_CHARTS_KEY = "charts"
+HELM_NAMESPACE_KEY = "namespace"
+
+# `helm repo update <repo...>` needs this version, older helm can only update
+# every repo. `helm_version` is looked up once per run
+HELM_REPO_UPDATE_NAMES_VERSION = (3, 7)
+helm_version = None
+
+# helm_deploy.yaml: use `helm upgrade --install` to roll out changes
+HELM_UPGRADE_KEY = "upgrade"
+HELM_TIMEOUT_KEY = "timeout"
+HELM_TIMEOUT = "5m0s"
+
+# helm releases in a stage to deploy at the same time
+HELM_WORKERS_KEY = "helm_workers"
+HELM_WORKERS = 4
+helm_workers = HELM_WORKERS
+
+# helm_deploy.yaml: names of releases in the same stage to wait for
+HELM_DEPENDS_ON_KEY = "depends_on"
+
+# release descriptions starting with this hold a digest of the deployment
+HELM_DIGEST_PREFIX = "ringmaster:"
+
+# talk to the cluster with the `kubernetes` python package instead of running
+# kubectl where we can (optional dependency)
+NATIVE_CLIENT_KEY = "native_client"
+native_client = False
+
+# context -> kubernetes ApiClient
+api_clients = {}
+api_clients_lock = threading.Lock()
+
+# objects the native client can apply: kind -> (`CoreV1Api` method suffix,
+# namespaced), only core/v1 kinds
+NATIVE_KINDS = {
+    "Secret": ("secret", True),
+    "ConfigMap": ("config_map", True),
+    "ServiceAccount": ("service_account", True),
+    "Service": ("service", True),
+    "Namespace": ("namespace", False),
+}
+FIELD_MANAGER = "ringmaster"
+
+# kubectl output meaning we lost the cluster, not that the command was bad
+CONNECTION_ERRORS = [
+    "Unable to connect to the server",
+    "connection refused",
+    "i/o timeout",
+    "no such host",
+    "TLS handshake timeout",
+    "connection reset by peer",
+]
+
 
 def setup_connection(connection_settings):
     global kubectl_context
+    global batch_apply
+    global server_side_apply
+    global native_client
+    global helm_workers
     kubectl_context = util.get_connection_profile(connection_settings, "k8s")
+    batch_apply = connection_settings.get(BATCH_APPLY_KEY, False)
+    server_side_apply = connection_settings.get(SERVER_SIDE_APPLY_KEY, False)
+    native_client = connection_settings.get(NATIVE_CLIENT_KEY, False)
+    helm_workers = connection_settings.get(HELM_WORKERS_KEY, HELM_WORKERS)
     logger.debug(f"k8s context set to: {kubectl_context}")
 
 
@@ -42,35 +131,154 @@ def get_helm_cmd():
 
 
 def check_kubectl_session():
-    """check kubectl connected to cluster before running commands"""
+    """check kubectl connected to cluster before running commands. A working
+    connection is remembered for each context for `SESSION_TTL_SECONDS`,
+    failures are checked again every time"""
+    with sessions_lock:
+        checked = sessions.get(kubectl_context)
+    if checked and time.monotonic() - checked < SESSION_TTL_SECONDS:
+        return True
+
     try:
-        run_cmd(get_kubectl_cmd() + ["get", "svc"])
-        connected = True
+        run_cmd(get_kubectl_cmd() + ["get", "--raw", "/readyz"])
     except RuntimeError:
-        connected = False
-    return connected
+        return False
+
+    with sessions_lock:
+        sessions[kubectl_context] = time.monotonic()
+    return True
+
+
+def check_connection_error(e):
+    """forget the session for this context if `e` was caused by losing the
+    connection to the cluster so the next command checks it again"""
+    output = getattr(e, "output", "")
+    if any(error in output for error in CONNECTION_ERRORS):
+        logger.debug(f"kubectl connection error, rechecking {kubectl_context} next time")
+        with sessions_lock:
+            sessions.pop(kubectl_context, None)
+
+
+def get_api_client():
+    """shared kubernetes `ApiClient` for the current context. All requests
+    go through its connection pool"""
+    with api_clients_lock:
+        if kubectl_context not in api_clients:
+            try:
+                import kubernetes
+            except ImportError:
+                raise RuntimeError(f"{NATIVE_CLIENT_KEY} requires the kubernetes python package: pip install ringmaster.show[kubernetes]")
+
+            logger.debug(f"k8s - creating api client for context: {kubectl_context}")
+            api_clients[kubectl_context] = kubernetes.config.new_client_from_config(
+                config_file=os.environ.get("KUBECONFIG"),
+                context=kubectl_context,
+            )
+        return api_clients[kubectl_context]
+
+
+def native_supported(objects):
+    return bool(objects) and all(
+        obj.get("apiVersion") == "v1" and obj.get("kind") in NATIVE_KINDS
+        for obj in objects
+    )
+
+
+def native_request(action, obj, ignore_statuses=(), **kwargs):
+    """call `CoreV1Api.<action>_[namespaced_]<kind>` for `obj` through the
+    shared `ApiClient`"""
+    import kubernetes
+
+    suffix, namespaced = NATIVE_KINDS[obj["kind"]]
+    metadata = obj.get("metadata") or {}
+    api = kubernetes.client.CoreV1Api(get_api_client())
+    if namespaced:
+        method = getattr(api, f"{action}_namespaced_{suffix}")
+        args = [metadata["name"], metadata.get("namespace") or "default"]
+    else:
+        method = getattr(api, f"{action}_{suffix}")
+        args = [metadata["name"]]
+
+    try:
+        # responses are not needed, skip deserializing them
+        method(*args, _preload_content=False, **kwargs)
+    except kubernetes.client.exceptions.ApiException as e:
+        if e.status not in ignore_statuses:
+            raise RuntimeError(f"k8s - {action} {obj['kind']}/{metadata['name']} failed: {e.status} {e.body}")
+    except Exception as e:
+        raise RuntimeError(f"k8s - {action} {obj['kind']}/{metadata['name']} failed: {e}")
+
+
+def native_apply(verb, objects):
+    """server side apply (or delete) `objects` straight from memory"""
+    for obj in objects:
+        description = f"{obj['kind']}/{obj['metadata']['name']}"
+        if verb == constants.UP_VERB:
+            logger.info(f"k8s - applying {description}")
+            native_request(
+                "patch",
+                obj,
+                body=obj,
+                field_manager=FIELD_MANAGER,
+                force=True,
+                _content_type="application/apply-patch+yaml",
+            )
+        elif verb == constants.DOWN_VERB:
+            logger.info(f"k8s - deleting {description}")
+            try:
+                native_request("delete", obj, ignore_statuses=(404,))
+            except RuntimeError as e:
+                logger.warning(f"Error deleting {description} but system is going down - ignoring: {e}")
+        else:
+            raise ValueError(f"invalid verb: {verb}")
+
+
+def apply_file(verb, processed_file, data):
+    """apply or delete `processed_file` with the native client if enabled and
+    it only contains simple objects, otherwise use kubectl"""
+    objects = []
+    if native_client:
+        with open(processed_file) as f:
+            objects = [obj for obj in yaml_io.load_all(f) if obj]
+
+    if native_supported(objects):
+        native_apply(verb, objects)
+    else:
+        run_kubectl(verb, "-f", processed_file, data)
 
 
 def run_kubectl(verb, flag, path, data):
+    run_kubectl_paths(verb, flag, [path], data)
+
+
+def run_kubectl_paths(verb, flag, paths, data):
+    """run kubectl (apply|delete) once for all of `paths` in order"""
     if data is None:
         data = {}
 
-    if verb == constants.UP_VERB:
-        action = "apply"
+    if verb == constants.UP_VERB and server_side_apply:
+        # server side apply can't recreate objects, take ownership of any
+        # fields instead
+        action = ["apply", "--server-side", "--force-conflicts"]
+    elif verb == constants.UP_VERB:
+        # --force is to recreate any immutable resources we touched
+        action = ["apply", "--force"]
     elif verb == constants.DOWN_VERB:
-        action = "delete"
+        action = ["delete", "--force"]
     else:
         raise ValueError(f"invalid verb: {verb}")
 
     if check_kubectl_session():
-        # --force is to recreate any immutable resources we touched
-        cmd = get_kubectl_cmd() + [action, "--force", flag, path]
+        cmd = get_kubectl_cmd() + action
+        for path in paths:
+            cmd += [flag, path]
         if data.get("debug"):
             cmd.append("-v=2")
 
         try:
-            run_cmd(cmd, data)
+            run_cmd(cmd, data, keep_output=False)
         except RuntimeError as e:
+            check_connection_error(e)
             if verb == constants.DOWN_VERB:
                 logger.warning("Error running kubectl but system is going down - ignoring")
             else:
@@ -86,7 +294,7 @@ def do_kubectl(working_dir, filename, verb, data=None):
     logger.info(f"kubectl: {filename}")
 
     try:
-        processed_file = util.substitute_placeholders_from_file_to_file(
+        processed_file, changed = util.render_processed_file(
             working_dir,
             filename,
             "#",
@@ -95,7 +303,19 @@ def do_kubectl(working_dir, filename, verb, data=None):
         )
         logger.debug(f"kubectl processed file: {processed_file}")
 
-        run_kubectl(verb, "-f", processed_file, data)
+        if verb == constants.UP_VERB and not changed and not state.force:
+            logger.info(f"kubectl: unchanged since last apply - skipping: {processed_file}")
+        else:
+            try:
+                apply_file(verb, processed_file, data)
+            except BaseException:
+                # the next run must not skip a file that wasn't applied, even
+                # if we were interrupted
+                os.unlink(processed_file)
+                raise
+
+            if verb == constants.DOWN_VERB:
+                os.unlink(processed_file)
     except RuntimeError as e:
         if verb == constants.DOWN_VERB:
             logger.warning(f"kubectl error - moving on: {e}")
@@ -108,6 +328,65 @@ def do_kubectl(working_dir, filename, verb, data=None):
             raise e
 
 
+def failed_files(output, processed_files):
+    """dict of processed file -> kubectl error lines mentioning it"""
+    failed = {}
+    for line in output.splitlines():
+        if line.lower().startswith("error"):
+            for processed_file in processed_files:
+                if processed_file in line:
+                    failed.setdefault(processed_file, []).append(line)
+    return failed
+
+
+def do_kubectl_batch(working_dir, filenames, verb, data=None):
+    """process several `.kubectl.yaml` files with one kubectl command when
+    `batch_apply` is set, otherwise one at a time"""
+    if not batch_apply:
+        for filename in filenames:
+            do_kubectl(working_dir, filename, verb, data)
+        return
+
+    logger.info(f"kubectl: {', '.join(filenames)}")
+
+    # processed file -> source file
+    processed_files = {}
+    applied = set()
+    try:
+        for filename in filenames:
+            processed_file, changed = util.render_processed_file(working_dir, filename, "#", verb, data)
+            if verb == constants.UP_VERB and not changed and not state.force:
+                logger.info(f"kubectl: unchanged since last apply - skipping: {processed_file}")
+            else:
+                processed_files[processed_file] = filename
+
+        if not processed_files:
+            return
+
+        try:
+            run_kubectl_paths(verb, "-f", list(processed_files.keys()), data)
+            applied.update(processed_files)
+        except RuntimeError as e:
+            # work out which files failed, if we can't tell assume they all did
+            failed = failed_files(getattr(e, "output", ""), processed_files) or \
+                {processed_file: [] for processed_file in processed_files}
+            for processed_file, errors in failed.items():
+                logger.error(f"kubectl failed for {processed_files[processed_file]}: {' '.join(errors) or e}")
+            applied.update(set(processed_files) - set(failed))
+
+            raise RuntimeError(f"kubectl failed for: {', '.join(processed_files[f] for f in failed)}")
+    finally:
+        # the next run must not skip a file that wasn't applied, even if a
+        # later file couldn't be rendered or we were interrupted
+        for processed_file in processed_files:
+            if processed_file not in applied and os.path.exists(processed_file):
+                os.unlink(processed_file)
+
+    if verb == constants.DOWN_VERB:
+        for processed_file in processed_files:
+            os.unlink(processed_file)
+
+
 def do_kustomizer(working_dir, filename, verb, data=None):
     logger.info(f"kustomizer: {filename}")
     sources_dir = os.path.dirname(filename)
@@ -120,29 +399,221 @@ def do_kustomizer(working_dir, filename, verb, data=None):
             raise e
 
 
-def helm_repos(base_cmd, config, filename):
-    try:
-        repos_list = util.run_cmd_json(base_cmd + ["repo", "list", "--output", "json"])
-    except RuntimeError as e:
-        logger.warning(f"""Listing helm repositories failed, this could be because you 
-        have no repositories installed helm could be broken completely: {e}""")
-        repos_list = []
-    logger.debug(f"helm repos installed: {repos_list}")
-    repos_installed = list(map(lambda x: x["name"], repos_list))
-    logger.debug(f"helm repos installed: {repos_installed}")
+def get_helm_state():
+    """repos and releases for the current context, listed once per run. Must
+    hold `helm_lock`"""
+    if kubectl_context not in helm_state:
+        try:
+            repos_list = util.run_cmd_json(["helm", "repo", "list", "--output", "json"])
+        except RuntimeError as e:
+            logger.warning(f"""Listing helm repositories failed, this could be because you 
+            have no repositories installed helm could be broken completely: {e}""")
+            repos_list = []
+        logger.debug(f"helm repos installed: {repos_list}")
+
+        releases_list = util.run_cmd_json(get_helm_cmd() + ["list", "--all-namespaces", "--output", "json"])
+        logger.debug(f"helm deployments installed: {releases_list}")
+
+        helm_state[kubectl_context] = {
+            HELM_REPOS_KEY: {repo["name"]: repo["url"] for repo in repos_list},
+            HELM_RELEASES_KEY: {(release["namespace"], release["name"]) for release in releases_list},
+            HELM_NAMESPACE_KEY: helm_default_namespace(),
+            # repos whose index has been refreshed this run
+            HELM_UPDATED_KEY: set(),
+            # (chart, version) -> available in the local index
+            HELM_CHARTS_KEY: {},
+        }
+    return helm_state[kubectl_context]
+
+
+def helm_default_namespace():
+    """namespace helm uses for releases without one, like `helm list` does:
+    `$HELM_NAMESPACE`, the namespace of the context or `default`"""
+    namespace = os.environ.get("HELM_NAMESPACE")
+    if not namespace:
+        try:
+            namespace = util.run_cmd(get_kubectl_cmd() + [
+                "config", "view", "--minify", "--output", "jsonpath={..namespace}"
+            ]).strip()
+        except RuntimeError as e:
+            logger.debug(f"helm - unable to get namespace of context {kubectl_context}: {e}")
+    return namespace or "default"
+
+
+def helm_release_key(namespace, name):
+    """(namespace, name) of a release, must hold `helm_lock`"""
+    return namespace or get_helm_state()[HELM_NAMESPACE_KEY], name
+
+
+def helm_release_exists(namespace, name):
+    with helm_lock:
+        return helm_release_key(namespace, name) in get_helm_state()[HELM_RELEASES_KEY]
 
+
+def helm_release_changed(namespace, name, exists):
+    """record a release we just installed (`exists`) or uninstalled"""
+    with helm_lock:
+        releases = get_helm_state()[HELM_RELEASES_KEY]
+        if exists:
+            releases.add(helm_release_key(namespace, name))
+        else:
+            releases.discard(helm_release_key(namespace, name))
+
+
+def helm_repos(base_cmd, config, filename):
+    """add any repos from `config` we don't have yet"""
     repos = config.get("repos", {})
     if repos:
-        for repo_key, source in config.get("repos", {}).items():
-            logger.debug(f"helm - request install repo:{repo_key}")
-            if repo_key not in repos_installed:
-                logger.info(f"helm - installing repo:{repo_key}")
-                cmd = base_cmd + ["repo", "add", repo_key, source]
-                util.run_cmd(cmd)
+        with helm_lock:
+            repos_installed = get_helm_state()[HELM_REPOS_KEY]
+            for repo_key, source in repos.items():
+                logger.debug(f"helm - request install repo:{repo_key}")
+                if repo_key not in repos_installed:
+                    logger.info(f"helm - installing repo:{repo_key}")
+                    cmd = base_cmd + ["repo", "add", repo_key, source]
+                    util.run_cmd(cmd)
+                    repos_installed[repo_key] = source
+                    # `helm repo add` downloads the index
+                    get_helm_state()[HELM_UPDATED_KEY].add(repo_key)
     else:
         logger.warning(f"helm - no helm repos specified in {filename}")
 
 
+def helm_chart_available(chart, version):
+    """True if `chart` at `version` is in the local copy of the repo index"""
+    with helm_lock:
+        charts = get_helm_state()[HELM_CHARTS_KEY]
+        if (chart, version) not in charts:
+            cmd = ["helm", "search", "repo", chart, "--output", "json"]
+            if version:
+                cmd += ["--version", version]
+            try:
+                found = util.run_cmd_json(cmd)
+            except RuntimeError as e:
+                logger.debug(f"helm - search failed for {chart}: {e}")
+                found = []
+            charts[(chart, version)] = any(result.get("name") == chart for result in found)
+        return charts[(chart, version)]
+
+
+def helm_repo_update_names():
+    """True if `helm repo update` takes the repos to update"""
+    global helm_version
+    with helm_lock:
+        if helm_version is None:
+            try:
+                output = util.run_cmd(["helm", "version", "--template", "{{.Version}}"]).strip()
+                helm_version = tuple(int(part) for part in re.findall(r"\d+", output)[:2])
+            except (RuntimeError, ValueError) as e:
+                logger.debug(f"helm - unable to get version: {e}")
+                helm_version = ()
+            logger.debug(f"helm version: {helm_version}")
+    return helm_version >= HELM_REPO_UPDATE_NAMES_VERSION
+
+
+def helm_repo_update(repos):
+    """refresh the index of each of `repos`, at most once per run"""
+    with helm_lock:
+        state = get_helm_state()
+        stale = [repo for repo in repos if repo not in state[HELM_UPDATED_KEY]]
+        if stale:
+            if helm_repo_update_names():
+                logger.info(f"helm - updating repos:{stale}")
+                util.run_cmd(["helm", "repo", "update"] + stale)
+                state[HELM_UPDATED_KEY].update(stale)
+            else:
+                logger.info("helm - updating all repos")
+                util.run_cmd(["helm", "repo", "update"])
+                state[HELM_UPDATED_KEY].update(state[HELM_REPOS_KEY])
+
+            # anything we couldn't find before might be there now
+            state[HELM_CHARTS_KEY].clear()
+
+
+def helm_prepare_chart(config):
+    """make sure the repo index has the chart we are about to install, only
+    fetching the index if it doesn't"""
+    chart = config["install"]
+    repo = chart.split("/")[0]
+    with helm_lock:
+        # anything else is a local path or URL
+        known_repo = "/" in chart and repo in get_helm_state()[HELM_REPOS_KEY]
+
+    if known_repo and not helm_chart_available(chart, config.get("version")):
+        helm_repo_update([repo])
+
+
+def helm_chart_args(config, processed_values_file, filename):
+    """chart, values and options for `helm (install|upgrade)`"""
+    args = [config["install"]]
+    if processed_values_file:
+        args.append("--values")
+        args.append(processed_values_file)
+    else:
+        for setting in config.get("set", []):
+            args.append("--set")
+            args.append(setting)
+    version = config.get("version")
+    if version:
+        args += ["--version", version]
+    else:
+        logger.warning(f"recommending versioning helm chart in {filename}")
+    args += config.get("options", [])
+    return args
+
+
+def helm_digest(config, processed_values_file):
+    """digest of everything that goes into a release. Only the content of the
+    values file counts, its path depends on where the checkout is"""
+    digest = hashlib.sha1()
+    digest.update(json.dumps([
+        config["install"],
+        config.get("version"),
+        [] if processed_values_file else config.get("set", []),
+        config.get("options", []),
+    ]).encode())
+    if processed_values_file:
+        digest.update(Path(processed_values_file).read_bytes())
+    return digest.hexdigest()
+
+
+def helm_release_digest(base_cmd, name):
+    """digest recorded in the description of the deployed release, if any"""
+    try:
+        status = util.run_cmd_json(base_cmd + ["status", name, "--output", "json"])
+    except RuntimeError as e:
+        logger.debug(f"helm - unable to get status of {name}: {e}")
+        status = {}
+
+    description = (status.get("info") or {}).get("description") or ""
+    if description.startswith(HELM_DIGEST_PREFIX):
+        digest = description[len(HELM_DIGEST_PREFIX):]
+    else:
+        digest = None
+    return digest
+
+
+def helm_upgrade(base_cmd, config, processed_values_file, filename, exists):
+    """`helm upgrade --install` if anything changed since the release was last
+    deployed by ringmaster"""
+    name = config["name"]
+    chart_args = helm_chart_args(config, processed_values_file, filename)
+    digest = helm_digest(config, processed_values_file)
+    if exists and not state.force and helm_release_digest(base_cmd, name) == digest:
+        logger.info(f"helm - up to date:{name}")
+    else:
+        logger.info(f"helm - upgrade:{name}")
+        helm_prepare_chart(config)
+        util.run_cmd(base_cmd + ["upgrade", "--install", name] + chart_args + [
+            "--atomic",
+            "--wait",
+            "--timeout", str(config.get(HELM_TIMEOUT_KEY, HELM_TIMEOUT)),
+            # there's nowhere else in the release to keep our own data
+            "--description", f"{HELM_DIGEST_PREFIX}{digest}",
+        ], keep_output=False)
+        helm_release_changed(config.get("namespace"), name, True)
+
+
 def do_helm(working_dir, filename, verb, data=None):
     logger.info(f"helm: {filename}")
 
@@ -193,33 +664,19 @@ def do_helm(working_dir, filename, verb, data=None):
             helm_repos(base_cmd, config, filename)
 
         # helm deployments
-        helm_list = util.run_cmd_json(base_cmd + ["list", "--output", "json"])
-        helm_deployments = list(map(lambda x: x["name"], helm_list))
-        logger.debug(f"helm deployments installed: {helm_deployments}")
-        exists = config["name"] in helm_deployments
-        if (verb == constants.UP_VERB and exists) or (verb == constants.DOWN_VERB and not exists):
+        exists = helm_release_exists(config.get("namespace"), config["name"])
+        if verb == constants.UP_VERB and config.get(HELM_UPGRADE_KEY):
+            helm_upgrade(base_cmd, config, processed_values_file, filename, exists)
+        elif (verb == constants.UP_VERB and exists) or (verb == constants.DOWN_VERB and not exists):
             logger.info(f"helm - already installed:{config['name']}")
         elif (verb == constants.UP_VERB and not exists) or (verb == constants.DOWN_VERB and exists):
             logger.info(f"helm - {helm_command}:{config['name']}")
             cmd = base_cmd + [helm_command, config["name"]]
             if verb == constants.UP_VERB:
-                cmd.append(config["install"])
-                if processed_values_file:
-                    cmd.append("--values")
-                    cmd.append(processed_values_file)
-                else:
-                    for setting in config.get("set", []):
-                        cmd.append("--set")
-                        cmd.append(setting)
-                cmd += config.get("options", [])
-                version = config.get("version")
-                if version:
-                    cmd += ["--version", version]
-                else:
-                    logger.warning(f"recommending versioning helm chart in {filename}")
-                cmd += config.get("options", [])
-            util.run_cmd(["helm", "repo", "update"])
-            util.run_cmd(cmd)
+                cmd += helm_chart_args(config, processed_values_file, filename)
+                helm_prepare_chart(config)
+            util.run_cmd(cmd, keep_output=False)
+            helm_release_changed(config.get("namespace"), config["name"], verb == constants.UP_VERB)
         else:
             raise RuntimeError(f"helm - invalid verb {verb}")
 
@@ -232,6 +689,55 @@ def do_helm(working_dir, filename, verb, data=None):
             raise e
 
 
+def helm_graph(working_dir, filenames, verb, data):
+    """dependency graph for the helm releases in `filenames` and the release
+    name for each file. Releases in the same namespace are deployed in order,
+    releases in other namespaces at the same time unless they list each other
+    in `depends_on`"""
+    configs = {}
+    for filename in filenames:
+        rendered = util.substitute_placeholders_from_file_to_memory(os.path.join(working_dir, filename), verb, data)
+        configs[filename] = yaml_io.load(rendered) or {}
+
+    file_for_release = {config.get("name"): filename for filename, config in configs.items()}
+    graph = {}
+    for i, (filename, config) in enumerate(configs.items()):
+        graph[filename] = {
+            earlier for earlier in filenames[:i]
+            if configs[earlier].get("namespace") == config.get("namespace")
+        }
+        for release in config.get(HELM_DEPENDS_ON_KEY) or []:
+            if release not in file_for_release:
+                raise RuntimeError(f"helm - {filename} depends on unknown release: {release}")
+            graph[filename].add(file_for_release[release])
+
+    if verb == constants.DOWN_VERB:
+        graph = dag.reverse_graph(graph)
+    return graph, {filename: config.get("name", filename) for filename, config in configs.items()}
+
+
+def do_helm_batch(working_dir, filenames, verb, data=None):
+    """deploy the helm releases in `filenames` using up to `helm_workers` at
+    once, see `helm_graph()`. Every release that can be deployed is and all
+    failures are reported at the end"""
+    graph, releases = helm_graph(working_dir, filenames, verb, data)
+    logger.info(f"helm: {len(filenames)} releases with {helm_workers} workers")
+
+    def start_fn(filename):
+        context = contextvars.copy_context()
+        context.run(util.output_prefix.set, f"[{releases[filename]}] ")
+        return lambda: context.run(do_helm, working_dir, filename, verb, data)
+
+    spinners = util.spinners
+    util.spinners = False
+    try:
+        dag.run_graph(graph, start_fn, lambda filename, result: None, helm_workers, keep_going=True)
+    except RuntimeError as e:
+        raise RuntimeError(f"helm - {e}")
+    finally:
+        util.spinners = spinners
+
+
 def do_secret_kubectl(working_dir, filename, verb, data):
     """create or delete a secret from a kubectl template file. This results in
     calling the k8s api directly - no processed file (which would contain the
@@ -267,7 +773,7 @@ def do_secret_kubectl(working_dir, filename, verb, data):
 
         # step 3 - convert string to yaml data structure - this will be merged
         # with the looked-up data from record 2 to build the entire secret
-        yaml_data = yaml.safe_load(yaml_string_metadata)
+        yaml_data = yaml_io.load(yaml_string_metadata)
 
         if not yaml_data:
             # skip this blank record and try again...
@@ -283,7 +789,7 @@ def do_secret_kubectl(working_dir, filename, verb, data):
             # substitute function expects list of strings...
             yaml_string_secret = util.substitute_placeholders_from_memory_to_memory(records[1], verb, data)
             logger.debug(f"raw secret data after placeholder substitution: {yaml_string_secret}")
-            yaml_data_secret = yaml.safe_load(yaml_string_secret)
+            yaml_data_secret = yaml_io.load(yaml_string_secret)
 
             # parsed yaml must contain `data` key...
             secret_data = yaml_data_secret.get("data")
@@ -303,16 +809,22 @@ def do_secret_kubectl(working_dir, filename, verb, data):
             # Add dummy section to keep kubectl from complaining
             yaml_data["data"] = {}
 
-        # step 5 - secret completed - save it somewhere, kubectl, delete
-        _, secret_file = tempfile.mkstemp(suffix=".yaml", prefix="ringmaster")
-        util.save_yaml_file(secret_file, yaml_data)
-
-        logger.debug("secret_kubectl - creating secret with kubectl")
-
         # print the entire secret for debug purposes ;-)
         logger.debug(f"secret: {yaml_data}")
 
-        run_kubectl(verb, "-f", secret_file, data)
-        os.unlink(secret_file)
+        if native_client and native_supported([yaml_data]):
+            # step 5 - secret completed - send it straight to the cluster
+            logger.debug("secret_kubectl - creating secret with kubernetes client")
+            native_apply(verb, [yaml_data])
+        else:
+            # step 5 - secret completed - save it somewhere, kubectl, delete
+            _, secret_file = tempfile.mkstemp(suffix=".yaml", prefix="ringmaster")
+            util.save_yaml_file(secret_file, yaml_data)
+
+            logger.debug("secret_kubectl - creating secret with kubectl")
+            try:
+                run_kubectl(verb, "-f", secret_file, data)
+            finally:
+                os.unlink(secret_file)
     else:
         raise RuntimeError(f"secret_kubectl - ${filename} must contain exactly 2 documents, found:{record_count}")
\ No newline at end of file
@@ -13,22 +13,63 @@
 # limitations under the License.
 import snowflake.connector
 import os
+import re
+import time
+import threading
+from contextlib import contextmanager
 from loguru import logger
 import yaml
 import ringmaster.util as util
 import ringmaster.constants as constants
 
-SNOWFLAKE_CONFIG_FILE = "~/.ringmaster/snowflake.yaml"
-connection = None
-
+profile = None
 profile_data = None
 
+# logging in to snowflake is slow so connections are kept open and shared
+# between files. `sessions` is the most connections to open per profile,
+# parallel runs need more than one
+sessions = 1
+
+# check connections that have been idle this long still work before use
+IDLE_CHECK_SECONDS = 300
+
+# profile -> {"idle": [(connection, last_used)], "open": count}
+pools = {}
+pools_lock = threading.Condition()
+
+# a file can `USE` another role, warehouse, database or schema and set
+# session variables. These are put back how they were when the connection
+# was opened before it is handed to the next file
+SESSION_CONTEXT = ["ROLE", "WAREHOUSE", "DATABASE", "SCHEMA"]
+SESSION_CONTEXT_SQL = "SELECT current_role(), current_warehouse(), current_database(), current_schema()"
+
+# connection -> values of SESSION_CONTEXT just after logging in
+session_contexts = {}
+
+# send this many statements from `.snowflake.sql` files to snowflake at once
+# using the connector's multi-statement support
+BATCH_STATEMENTS_KEY = "batch_statements"
+BATCH_STATEMENTS = 1
+batch_statements = BATCH_STATEMENTS
+
+# what to look for next while splitting SQL in each state
+SQL_NORMAL = re.compile(r";|--|/\*|\$\$|'|\"")
+SQL_END = {
+    "'": re.compile(r"\\.|''|'", re.DOTALL),
+    '"': re.compile(r'""|"'),
+    "$$": re.compile(r"\$\$"),
+    "/*": re.compile(r"\*/"),
+}
+
 
 def setup_connection(connection_settings):
+    global profile
     global profile_data
+    global batch_statements
 
     profile = util.get_connection_profile(connection_settings, "snowflake")
-    snowflake_config_file = os.path.expanduser(SNOWFLAKE_CONFIG_FILE)
+    batch_statements = connection_settings.get(BATCH_STATEMENTS_KEY, BATCH_STATEMENTS)
+    snowflake_config_file = os.path.expanduser(constants.SNOWFLAKE_CONFIG_FILE)
     if os.path.exists(snowflake_config_file):
         config = util.read_yaml_file(snowflake_config_file)
         profile_data = config.get(profile)
@@ -36,16 +77,141 @@ def setup_connection(connection_settings):
         raise RuntimeError(f"snowflake settings not found at: {snowflake_config_file}")
 
 
+def checkout_connection():
+    """take a connection from the pool for the current profile, opening a new
+    one if none are idle and we are allowed to. Connections that have been
+    idle for a while are checked before being handed out"""
+    with pools_lock:
+        pool = pools.setdefault(profile, {"idle": [], "open": 0})
+        while True:
+            if pool["idle"]:
+                connection, last_used = pool["idle"].pop()
+                break
+            elif pool["open"] < sessions:
+                pool["open"] += 1
+                connection, last_used = None, None
+                break
+            pools_lock.wait()
+
+    try:
+        if connection and time.monotonic() - last_used > IDLE_CHECK_SECONDS:
+            try:
+                test_connection(connection.cursor())
+            except Exception as e:
+                logger.debug(f"snowflake - idle connection failed check, reconnecting: {e}")
+                close_connection(connection)
+                connection = None
+
+        if not connection:
+            logger.debug(f"snowflake - connecting profile:{profile}")
+            connection = snowflake.connector.connect(**profile_data["credentials"])
+            session_contexts[connection] = get_session_context(connection)
+    except Exception:
+        if connection:
+            close_connection(connection)
+
+        # give the slot back
+        with pools_lock:
+            pool["open"] -= 1
+            pools_lock.notify()
+        raise
+
+    return connection
+
+
+def checkin_connection(connection):
+    """return a connection to the pool once its session is reset, connections
+    that can't be reset are closed"""
+    try:
+        reset_session(connection)
+    except Exception as e:
+        logger.debug(f"snowflake - unable to reset session, closing connection: {e}")
+        discard_connection(connection)
+        return
+
+    with pools_lock:
+        pools[profile]["idle"].append((connection, time.monotonic()))
+        pools_lock.notify()
+
+
+def discard_connection(connection):
+    """close a connection instead of returning it to the pool"""
+    close_connection(connection)
+    with pools_lock:
+        pools[profile]["open"] -= 1
+        pools_lock.notify()
+
+
+def close_connection(connection):
+    session_contexts.pop(connection, None)
+    try:
+        connection.close()
+    except Exception as e:
+        logger.debug(f"snowflake - error closing connection: {e}")
+
+
+def get_session_context(connection):
+    cs = connection.cursor()
+    cs.execute(SESSION_CONTEXT_SQL)
+    return tuple(cs.fetchone())
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def reset_session(connection):
+    """put back the role, warehouse, database and schema the connection
+    logged in with and unset any session variables"""
+    initial = session_contexts[connection]
+    current = get_session_context(connection)
+    cs = connection.cursor()
+    if current != initial:
+        for kind, was, now in zip(SESSION_CONTEXT, initial, current):
+            if was is None and now is not None:
+                raise RuntimeError(f"no {kind.lower()} to go back to")
+
+        # `USE DATABASE` also changes the schema so set everything in order
+        for kind, value in zip(SESSION_CONTEXT, initial):
+            if value is not None:
+                cs.execute(f"USE {kind} {quote_identifier(value)}")
+
+    cs.execute("SHOW VARIABLES")
+    column = [d[0].lower() for d in cs.description].index("name")
+    variables = [row[column] for row in cs.fetchall()]
+    if variables:
+        cs.execute(f"UNSET ({', '.join(variables)})")
+
+
+def close_connections():
+    """close every idle connection, call once all files have been processed"""
+    with pools_lock:
+        for profile_name, pool in pools.items():
+            logger.debug(f"snowflake - closing {len(pool['idle'])} connections for profile:{profile_name}")
+            for connection, _ in pool["idle"]:
+                close_connection(connection)
+                pool["open"] -= 1
+            pool["idle"] = []
+
+
+@contextmanager
 def get_cursor(data):
-    ctx = snowflake.connector.connect(**profile_data["credentials"])
-    cs = ctx.cursor(snowflake.connector.DictCursor)
+    """borrow a pooled connection and yield a cursor for it"""
+    connection = checkout_connection()
+    try:
+        cs = connection.cursor(snowflake.connector.DictCursor)
 
-    # grab some convenince variables from snowflake settings
-    data["snowflake_account"] = profile_data["credentials"]["account"]
-    data["snowflake_region"] = profile_data["region"]
+        # grab some convenince variables from snowflake settings
+        data["snowflake_account"] = profile_data["credentials"]["account"]
+        data["snowflake_region"] = profile_data["region"]
 
-    test_connection(cs)
-    return cs
+        yield cs
+    except BaseException:
+        # don't hand a connection in an unknown state to the next file
+        discard_connection(connection)
+        raise
+    else:
+        checkin_connection(connection)
 
 
 def test_connection(cs):
@@ -53,7 +219,83 @@ def test_connection(cs):
     one_row = cs.fetchone()
 
 
-def process_file_and_connect(working_dir, filename, verb, data):
+def split_statements(lines):
+    """yield each SQL statement in `lines` (any iterable of strings such as an
+    open file) without its terminating `;`. A `;` inside quotes, `$$`
+    blocks and comments doesn't end a statement. Comments are dropped"""
+    stmt = []
+    state = None
+    for line in lines:
+        pos = 0
+        while pos < len(line):
+            if state is None:
+                match = SQL_NORMAL.search(line, pos)
+                if not match:
+                    stmt.append(line[pos:])
+                    break
+
+                stmt.append(line[pos:match.start()])
+                pos = match.end()
+                token = match.group()
+                if token == ";":
+                    statement = "".join(stmt).strip()
+                    if statement:
+                        yield statement
+                    stmt = []
+                elif token == "--":
+                    # rest of the line is a comment
+                    stmt.append("\n")
+                    break
+                elif token == "/*":
+                    state = token
+                else:
+                    stmt.append(token)
+                    state = token
+            else:
+                match = SQL_END[state].search(line, pos)
+                end = match.end() if match else len(line)
+                if state != "/*":
+                    stmt.append(line[pos:end])
+                pos = end
+
+                # anything else is an escaped quote
+                if match and match.group() == ("*/" if state == "/*" else state):
+                    if state == "/*":
+                        stmt.append(" ")
+                    state = None
+
+    statement = "".join(stmt).strip()
+    if statement:
+        yield statement
+
+
+def execute_statements(cs, statements):
+    """execute each statement, sending up to `batch_statements` at a time"""
+    batch = []
+    for stmt in statements:
+        logger.debug(f"sql: {stmt}")
+        batch.append(stmt)
+        if len(batch) >= batch_statements:
+            execute_batch(cs, batch)
+            batch = []
+
+    if batch:
+        execute_batch(cs, batch)
+
+
+def execute_batch(cs, batch):
+    if len(batch) == 1:
+        cs.execute(batch[0])
+    else:
+        logger.debug(f"snowflake - executing {len(batch)} statements")
+        # one multi-statement request, the results of the statements after
+        # the first (and their errors) come back through `nextset()`
+        cs.execute(";\n".join(batch), num_statements=len(batch))
+        while cs.nextset():
+            pass
+
+
+def process_file(working_dir, filename, verb, data):
     # process substitutions
     processed_file = util.substitute_placeholders_from_file_to_file(
         working_dir,
@@ -63,10 +305,7 @@ def process_file_and_connect(working_dir, filename, verb, data):
         data
     )
     logger.debug(f"snowflake processed file: {processed_file}")
-
-    # connect to snowflake, bail if it fails
-    cs = get_cursor(data)
-    return cs, processed_file
+    return processed_file
 
 
 def do_snowflake_sql(working_dir, filename, verb, data):
@@ -76,19 +315,11 @@ def do_snowflake_sql(working_dir, filename, verb, data):
             (verb == constants.DOWN_VERB and script_name == constants.SNOWFLAKE_CLEANUP_FILENAME):
 
         logger.info(f"snowflake sql: {filename}")
-        cs, processed_file = process_file_and_connect(working_dir, filename, verb, data)
-
-        # build up stmt line-by-line, when we find `;` execute stmt and
-        # empty the variable for the next iteration
-        stmt = ""
-        with open(processed_file, "r") as file:
-            for line in file:
-                if not line.startswith(constants.COMMENT_SQL):
-                    stmt += line.rstrip()
-                    if stmt.endswith(";"):
-                        logger.debug(f"sql: {stmt}")
-                        cs.execute(stmt)
-                        stmt = ""
+        processed_file = process_file(working_dir, filename, verb, data)
+
+        # statements are read from the file as they are executed
+        with get_cursor(data) as cs, open(processed_file, "r") as file:
+            execute_statements(cs, split_statements(file))
     else:
         logger.info(f"skippking snowflake: {filename}")
 
@@ -97,7 +328,7 @@ def do_snowflake_query(working_dir, filename, verb, data):
     """Query snowflake for a single row of values, add each column to the databag"""
     if verb == constants.UP_VERB:
         logger.info(f"snowflake query: {filename}")
-        cs, processed_file = process_file_and_connect(
+        processed_file = process_file(
             working_dir,
             filename,
             verb,
@@ -105,15 +336,13 @@ def do_snowflake_query(working_dir, filename, verb, data):
         )
         extra_data = {}
 
-        # load the entire processed file and run EACH STATEMENT
-        with open(processed_file, 'r') as file:
-            sql = file.read()
-
-        for stmt in sql.split(";"):
-            logger.debug(f"snowflake sql query: {stmt}")
-            cs.execute(stmt)
+        # run EACH STATEMENT, the result comes from the last one
+        with get_cursor(data) as cs, open(processed_file, 'r') as file:
+            for stmt in split_statements(file):
+                logger.debug(f"snowflake sql query: {stmt}")
+                cs.execute(stmt)
 
-        result = cs.fetchone()
+            result = cs.fetchone()
         logger.info(f"sql result: {result}")
 
         # result is a dict so just lowercase each key and add to databag
@@ -0,0 +1,151 @@
+# Copyright 2020 Declarative Systems Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Remember what each file looked like the last time it was brought up so
+unchanged files can be skipped on the next run.
+
+Each file gets a fingerprint covering its source, its rendered output (for
+templated files) and the databag values it consumed. If the fingerprint
+matches the last successful run, the databag values the file added last time
+are replayed instead of running the handler.
+"""
+import os
+import json
+import hashlib
+import threading
+from loguru import logger
+import ringmaster.util as util
+import ringmaster.dag as dag
+from ringmaster import constants
+
+# run every handler even if nothing changed
+force = False
+
+# filename -> {FINGERPRINT_KEY: ..., OUTPUTS_KEY: {...}}
+files = {}
+
+# handlers may be running in parallel
+lock = threading.Lock()
+
+FINGERPRINT_KEY = "fingerprint"
+OUTPUTS_KEY = "outputs"
+
+# databag values that are different every run but don't change the result
+PER_RUN_KEYS = {constants.KEY_INTERMEDIATE_DATABAG, constants.KEY_INTERMEDIATE_DATABAG_PIPE, "debug"}
+
+
+def load(state_file):
+    global files
+    if os.path.exists(state_file) and os.path.getsize(state_file):
+        logger.debug(f"loading state: {state_file}")
+        loaded = util.read_yaml_file(state_file)
+    else:
+        loaded = {}
+
+    with lock:
+        files = loaded
+
+
+def save(state_file):
+    with lock:
+        snapshot = dict(files)
+
+    logger.debug(f"saving state: {state_file}")
+    util.save_yaml_file(state_file, snapshot, "# generated by ringmaster, do not edit!\n")
+
+
+def delete(state_file):
+    global files
+    with lock:
+        files = {}
+
+    if os.path.exists(state_file):
+        logger.debug(f"deleting state: {state_file}")
+        os.unlink(state_file)
+
+
+def consumed_keys(filename, data):
+    """databag keys read by `filename`, if we don't know then assume it reads
+    everything. Values it added itself last time are left out while they are
+    unchanged, otherwise they would be new inputs on the next run"""
+    reads, _ = dag.analyse_file(filename)
+    if reads is None:
+        keys = set(data.keys())
+    else:
+        keys = dag.databag_keys(reads)
+
+    with lock:
+        recorded = files.get(filename) or {}
+    own = {key for key, value in (recorded.get(OUTPUTS_KEY) or {}).items() if data.get(key) == value}
+    return sorted(keys - PER_RUN_KEYS - own)
+
+
+def fingerprint(working_dir, filename, data):
+    """fingerprint of everything that goes into processing `filename` or
+    `None` if it can't be worked out (the handler will report why)"""
+    if filename.endswith(constants.PATTERN_REMOTE_CLOUDFORMATION_FILE):
+        # the template is only downloaded by the handler and can change
+        # without its URL changing, always run these
+        logger.debug(f"remote template, not fingerprinting: {filename}")
+        return None
+
+    try:
+        digest = hashlib.sha1()
+        for input_file in dag.input_files(filename):
+            digest.update(util.hash_file(input_file).encode())
+
+            if any(input_file.endswith(pattern) for pattern in dag.TEMPLATED_PATTERNS + ["values.yaml"]):
+                rendered = util.substitute_placeholders_from_file_to_memory(
+                    os.path.join(working_dir, input_file),
+                    constants.UP_VERB,
+                    data
+                )
+                digest.update(rendered.encode())
+
+        consumed = {key: data.get(key) for key in consumed_keys(filename, data)}
+        digest.update(json.dumps(consumed, sort_keys=True, default=str).encode())
+        result = digest.hexdigest()
+    except Exception as e:
+        logger.debug(f"unable to fingerprint {filename}: {e}")
+        result = None
+
+    return result
+
+
+def recorded_outputs(filename, file_fingerprint):
+    """databag values `filename` added last time it was processed with the
+    same fingerprint or `None` if it needs processing"""
+    with lock:
+        recorded = files.get(filename)
+
+    if file_fingerprint and recorded and recorded.get(FINGERPRINT_KEY) == file_fingerprint:
+        outputs = recorded.get(OUTPUTS_KEY) or {}
+    else:
+        outputs = None
+    return outputs
+
+
+def record(filename, file_fingerprint, outputs):
+    with lock:
+        if file_fingerprint:
+            files[filename] = {
+                FINGERPRINT_KEY: file_fingerprint,
+                OUTPUTS_KEY: outputs,
+            }
+        else:
+            files.pop(filename, None)
+
+
+def forget(filename):
+    with lock:
+        files.pop(filename, None)
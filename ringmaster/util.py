@@ -12,51 +12,139 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import stat
 from . import constants
+from . import databag
 from loguru import logger
-import subprocess
-import requests
+import asyncio
+import codecs
+import contextvars
+import collections
+import tempfile
 import snakecase
 import json
 from contextlib import ExitStack
-from halo import Halo
 import hashlib
 import base64
-from jinja2 import Environment, Template, StrictUndefined, Undefined
+import threading
+from jinja2 import Environment, Template, StrictUndefined, Undefined, BaseLoader, FileSystemBytecodeCache, meta
 from jinja2.exceptions import UndefinedError
-import yaml
+import ringmaster.yaml_io as yaml_io
 import pathlib
 
+# spinners only make sense when one thing at a time is running, parallel
+# runs turn them off
+spinners = True
 
-def walk(data, parent_name=None):
-    seq_iter = data if isinstance(data, dict) else range(len(data))
-    for i in seq_iter:
-        if parent_name:
-            me = f"{parent_name}_{i}"
-        else:
-            me = i
-
-        if isinstance(data[i], dict):
-            for k, v in walk(data[i], parent_name=me):
-                yield k, v
-        elif isinstance(data[i], list) or isinstance(data[i], tuple):
-            for k, v in walk(data[i], parent_name=me):
-                yield k, v
+# compiled templates are saved here between runs, `None` to disable
+template_cache_dir = constants.TEMPLATE_CACHE_DIR
+
+# undefined class -> shared jinja environment
+template_environments = {}
+template_lock = threading.Lock()
+
+# template sha1 -> names it reads, see `template_variables()`
+template_variable_cache = {}
+
+# added to the start of each line of command output, lets output from
+# commands running at the same time be told apart
+output_prefix = contextvars.ContextVar("output_prefix", default="")
+
+# read command output this many bytes at a time
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# lines of output to log when a command fails
+OUTPUT_TAIL_LINES = 100
+
+# most characters of those lines kept in memory once output is spilled
+OUTPUT_TAIL_CHARS = 64 * 1024
+
+# output larger than this is saved to a log file instead of being logged
+OUTPUT_SPILL_BYTES = 1024 * 1024
+
+# see `new_file_mode()`
+file_mode = None
+
+# lower case prefixes of the databag keys passed to child processes or `None`
+# for every key. Keeps the environment small for big databags, see
+# `set_env_prefixes()`
+env_prefixes = None
+
+
+def walk(data, parent_name=None, prefix=None, max_depth=None):
+    """(flattened name, value) for every value in nested `data`, see
+    `walk_items()`"""
+    for me, _, value in walk_items(data, parent_name, prefix, max_depth):
+        yield me, value
+
+
+def walk_paths(data, parent_name=None, prefix=None, max_depth=None):
+    """like `walk()` but also yields the keys and indexes leading to each
+    value"""
+    return walk_items(data, parent_name, prefix, max_depth, with_paths=True)
+
+
+def walk_items(data, parent_name=None, prefix=None, max_depth=None, with_paths=False):
+    """flatten nested dicts, lists and tuples depth first, yielding
+    (name, path, value) for each value. Names are keys and indexes joined
+    with `_` under `parent_name`, except below a falsy name (eg index 0 of a
+    top level list) where the key is used as it is. `path` is `None` unless
+    `with_paths`.
+
+    With `prefix`, only names starting with it (ignoring case) are yielded
+    and containers that can't hold any are skipped. Containers deeper than
+    `max_depth` levels are yielded as values."""
+    if prefix is not None:
+        prefix = prefix.lower()
+
+    top = data.items() if isinstance(data, dict) else ((i, data[i]) for i in range(len(data)))
+
+    # one entry per container being walked: (its items, its name + "_" or
+    # `None` if falsy, path, depth). Each name is one concatenation onto its
+    # parent's
+    stack = [(iter(top), f"{parent_name}_" if parent_name else None, (), 1)]
+    while stack:
+        items, parent, path, depth = stack[-1]
+        for i, value in items:
+            if parent is None:
+                me = i
+            else:
+                me = parent + (i if type(i) is str else str(i))
+
+            if isinstance(value, (dict, list, tuple)) and (max_depth is None or depth < max_depth):
+                children_parent = f"{me}_" if me else None
+                if prefix is not None and children_parent:
+                    lowered = children_parent.lower()
+                    if not (lowered.startswith(prefix) or prefix.startswith(lowered)):
+                        continue
+
+                children = value.items() if isinstance(value, dict) else enumerate(value)
+                stack.append((iter(children), children_parent, (path + (i,) if with_paths else None), depth + 1))
+                break
+
+            if prefix is None or str(me).lower().startswith(prefix):
+                yield me, (path + (i,) if with_paths else None), value
         else:
-            yield me, data[i]
+            stack.pop()
 
 
-def convert_dict_values_to_string(data):
-    # all values passed to os.environ must be strings, avoid unwanted yaml help
-    for key in data:
-        data[key] = str(data[key])
+def set_env_prefixes(prefixes):
+    """only pass databag keys starting with one of `prefixes` (ignoring case)
+    to child processes, `None` passes them all"""
+    global env_prefixes
+    env_prefixes = None if prefixes is None else tuple(prefix.lower() for prefix in prefixes)
 
 
 def merge_env(data):
+    """environment for a child process: our own environment plus the databag
+    keys allowed by `env_prefixes`, including flattened values from nested
+    databag sources"""
     env = os.environ.copy()
-    env.update(data)
-
-    convert_dict_values_to_string(env)
+    if isinstance(data, databag.Databag):
+        # only stringified again when the databag changes
+        env.update(data.environment(True, env_prefixes))
+    else:
+        env.update(databag.environment(data, env_prefixes))
     return env
 
 
@@ -73,48 +161,220 @@ def is_ci():
     return "CI" in os.environ
 
 
-def run_cmd(cmd, data=None):
+def use_spinner(data):
+    """True if we should show a spinner while waiting for something"""
+    return spinners and not data.get("debug", False) and not is_ci()
+
+
+class CommandError(RuntimeError):
+    """a command exited with a non-zero status, `output` is everything it
+    printed or just the last lines if there was too much to keep"""
+
+    def __init__(self, message, output):
+        super().__init__(message)
+        self.output = output
+
+
+def open_output_log(cmd):
+    """file to save the full output of `cmd` to so it can be inspected later"""
+    fd, log_file = tempfile.mkstemp(prefix="ringmaster-", suffix=".log")
+    f = os.fdopen(fd, "w")
+    f.write(f"# {cmd}\n")
+    return f, log_file
+
+
+def prefix_lines(text):
+    """`text` with `output_prefix` added to each line"""
+    prefix = output_prefix.get()
+    return "".join(prefix + line for line in text.splitlines(keepends=True)) if prefix else text
+
+
+async def run_cmd_async(cmd, data=None, timeout=None, keep_output=True):
+    """run `cmd` and return its output, raising `RuntimeError` if it fails or
+    takes longer than `timeout` seconds. The process is killed if we are
+    cancelled. The databag is passed in the environment, see `merge_env()`.
+
+    Once there is more than `OUTPUT_SPILL_BYTES` of output it is written to a
+    log file as it arrives and only the last `OUTPUT_TAIL_LINES` lines (at
+    most `OUTPUT_TAIL_CHARS` characters) are kept in memory. The whole output
+    is read back from the log at the end unless `keep_output` is false, then
+    only those last lines are returned.
+    The log is kept if the command fails"""
     if not data:
         data = {}
-    output = ""
     env = merge_env(data)
     logger.trace(f"merged environment: {env}")
     logger.debug(f"running command: {cmd}")
     debug = data.get("debug", False)
+
+    if isinstance(cmd, str):
+        proc = await asyncio.create_subprocess_shell(
+            cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env
+        )
+    else:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env
+        )
+
+    # output is kept in `chunks` until there's too much, then in `spill`
+    chunks = []
+    size = 0
+    spill = None
+    tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    tail_size = 0
+    # pieces of the line still being read, only joined once it's complete
+    partial = []
+    partial_size = 0
+
+    def add_line(line):
+        nonlocal tail_size
+        if debug:
+            logger.log("OUTPUT", output_prefix.get() + line.strip())
+        if len(tail) == tail.maxlen:
+            tail_size -= len(tail[0])
+        tail.append(line)
+        tail_size += len(line)
+        if spill:
+            while tail_size > OUTPUT_TAIL_CHARS and len(tail) > 1:
+                tail_size -= len(tail.popleft())
+            if tail_size > OUTPUT_TAIL_CHARS:
+                tail[0] = tail[0][-OUTPUT_TAIL_CHARS:]
+                tail_size = len(tail[0])
+
+    def add_text(text):
+        nonlocal partial, partial_size
+        end = text.rfind("\n") + 1
+        if end:
+            complete = "".join(partial) + text[:end]
+            partial = [text[end:]] if end < len(text) else []
+            partial_size = len(text) - end
+            for line in complete.splitlines(keepends=True):
+                add_line(line)
+        elif text:
+            partial.append(text)
+            partial_size += len(text)
+            # the whole line is in the log, only keep its end
+            if spill and partial_size > 2 * OUTPUT_TAIL_CHARS:
+                partial = ["".join(partial)[-OUTPUT_TAIL_CHARS:]]
+                partial_size = OUTPUT_TAIL_CHARS
+
+    async def read_output():
+        nonlocal size, spill
+        decoder = codecs.getincrementaldecoder("UTF-8")(errors="replace")
+        while True:
+            chunk = await proc.stdout.read(OUTPUT_CHUNK_SIZE)
+            text = decoder.decode(chunk, final=not chunk)
+            if text:
+                size += len(text)
+                if spill:
+                    spill[0].write(text)
+                else:
+                    chunks.append(text)
+                    if size > OUTPUT_SPILL_BYTES:
+                        spill = open_output_log(cmd)
+                        spill[0].writelines(chunks)
+                        chunks.clear()
+                add_text(text)
+            if not chunk:
+                break
+
+        if partial:
+            add_line("".join(partial))
+        return await proc.wait()
+
+    try:
+        rc = await asyncio.wait_for(read_output(), timeout)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"Command timed out after {timeout} seconds - {cmd}")
+    finally:
+        if proc.returncode is None:
+            logger.debug(f"killing: {cmd}")
+            proc.kill()
+            await proc.wait()
+        if spill:
+            spill[0].close()
+
+    logger.debug(f"result: {rc}")
+    if spill:
+        log_file = spill[1]
+        if rc != 0:
+            output = "".join(tail)
+            logger.error(prefix_lines(output))
+            logger.error(f"last {len(tail)} lines shown, full output: {log_file}")
+        elif keep_output:
+            with open(log_file) as f:
+                f.readline()
+                output = f.read()
+        else:
+            output = "".join(tail)
+
+        if rc == 0:
+            os.unlink(log_file)
+    else:
+        output = "".join(chunks)
+        if rc != 0:
+            logger.error(prefix_lines(output))
+
+    if rc != 0:
+        raise CommandError(f"Command failed with non-zero exit status:{rc} - {cmd}", output)
+    return output
+
+
+async def run_cmds_async(cmds, data=None, timeout=None):
+    """run `cmds` concurrently and return their outputs in the same order. The
+    first failure cancels the remaining commands and is raised"""
+    tasks = [
+        asyncio.ensure_future(run_cmd_async(cmd, data=data, timeout=timeout))
+        for cmd in cmds
+    ]
+    if not tasks:
+        return []
+
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    for task in tasks:
+        if not task.cancelled() and task.exception():
+            raise task.exception()
+
+    return [task.result() for task in tasks]
+
+
+def run_cmd(cmd, data=None, timeout=None, keep_output=True):
+    if not data:
+        data = {}
     with ExitStack() as stack:
-        message = f"Running {cmd}"
-        if not debug and not is_ci():
+        message = f"{output_prefix.get()}Running {cmd}"
+        if use_spinner(data):
+            from halo import Halo
             stack.enter_context(Halo(text=message, spinner='dots'))
         else:
             logger.info(message)
 
-        with subprocess.Popen(cmd,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              shell=isinstance(cmd, str),
-                              env=env) as proc:
-            while True:
-                line = proc.stdout.readline()
-                while line:
-                    line_decoded = line.decode("UTF-8")
-                    if debug:
-                        logger.log("OUTPUT", line_decoded.strip())
-                    output += line_decoded
-
-                    line = proc.stdout.readline()
-                if proc.poll() is not None:
-                    break
-        rc = proc.poll()
-        logger.debug(f"result: {rc}")
-        if rc != 0:
-            logger.error(output)
-            raise RuntimeError(f"Command failed with non-zero exit status:{rc} - {cmd}")
-    return output
+        return asyncio.run(run_cmd_async(
+            cmd, data=data, timeout=timeout, keep_output=keep_output
+        ))
+
+
+def run_cmds(cmds, data=None, timeout=None):
+    """run several commands at once, see `run_cmds_async()`"""
+    if not data:
+        data = {}
+    for cmd in cmds:
+        logger.info(f"{output_prefix.get()}Running {cmd}")
+
+    return asyncio.run(run_cmds_async(cmds, data=data, timeout=timeout))
 
 
-def flatten_nested_dict(data):
+def flatten_nested_dict(data, prefix=None, max_depth=None):
+    """nested `data` as a dict of lower case flattened names, see `walk()`"""
     flattened = {}
-    for k, v in walk(data):
+    for k, v in walk(data, prefix=prefix, max_depth=max_depth):
         flattened[k.lower()] = v
 
     return flattened
@@ -147,20 +407,78 @@ def process_res_template(filename, **data):
     return template.render(**data)
 
 
+def jinja_environment(undefined=StrictUndefined):
+    """jinja environment used to process all templates"""
+    jinja_env = Environment(undefined=undefined, keep_trailing_newline=True)
+    # compatible name with Ansible filters
+    jinja_env.filters['b64encode'] = base64encode
+    return jinja_env
+
+
+class TemplateSourceLoader(BaseLoader):
+    """loads templates named by the sha1 of their source. Lets jinja cache
+    compiled templates (and bytecode) for sources we have seen before"""
+
+    def __init__(self):
+        self.sources = {}
+
+    def add(self, source):
+        name = hashlib.sha1(source.encode()).hexdigest()
+        self.sources[name] = source
+        return name
+
+    def get_source(self, environment, template):
+        return self.sources[template], None, lambda: True
+
+
+def template_environment(undefined):
+    """shared jinja environment for `undefined`, must hold `template_lock`"""
+    if undefined not in template_environments:
+        bytecode_cache = None
+        if template_cache_dir:
+            # absolute so it still works if we change directory later
+            cache_dir = os.path.abspath(template_cache_dir)
+            pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+        jinja_env = jinja_environment(undefined)
+        jinja_env.loader = TemplateSourceLoader()
+        jinja_env.bytecode_cache = bytecode_cache
+        template_environments[undefined] = jinja_env
+    return template_environments[undefined]
+
+
+def compiled_template(raw, undefined):
+    """compiled template for `raw`, only compiled once per run (or once ever
+    with the bytecode cache)"""
+    with template_lock:
+        jinja_env = template_environment(undefined)
+        return jinja_env.get_template(jinja_env.loader.add(raw))
+
+
+def template_variables(raw):
+    """names a template reads from its context"""
+    digest = hashlib.sha1(raw.encode()).hexdigest()
+    with template_lock:
+        if digest not in template_variable_cache:
+            ast = template_environment(Undefined).parse(raw)
+            template_variable_cache[digest] = frozenset(meta.find_undeclared_variables(ast))
+        return template_variable_cache[digest]
+
+
 def substitute_placeholders_from_memory_to_memory(raw, verb, data):
     """replace all variables placeholders list of lines and return the result"""
 
     # allow missing variables in templates if we are going down
     undefined = StrictUndefined if verb == constants.UP_VERB else Undefined
-    jinja_env = Environment(undefined=undefined, keep_trailing_newline=True)
-    # compatible name with Ansible filters
-    jinja_env.filters['b64encode'] = base64encode
-    template = jinja_env.from_string(raw)
-    # add `env` key with contents of environment
-    data_with_env = {**data, "env": os.environ.copy()}
+    template = compiled_template(raw, undefined)
+    if isinstance(data, databag.Databag) and data.get_source_index():
+        # nested sources only supply the names this template uses
+        data = {**data, **data.materialize(template_variables(raw))}
 
     try:
-        buffer = template.render(data_with_env)
+        # add `env` key with contents of environment
+        buffer = template.render(data, env=os.environ)
     except UndefinedError as e:
         if verb == constants.DOWN_VERB:
             logger.warning(f"returning original content due to: {e}")
@@ -203,30 +521,74 @@ def get_processed_filename(working_dir, input_filename, env_name):
     return os.path.normpath(processed_filename)
 
 
-def substitute_placeholders_from_file_to_file(working_dir, filename, comment_delim, verb, data):
-    """replace all variables placeholders in filename, return path to substituted file"""
+def new_file_mode():
+    """permissions `open()` gives new files under the current umask"""
+    global file_mode
+    if file_mode is None:
+        umask = os.umask(0)
+        os.umask(umask)
+        file_mode = 0o666 & ~umask
+    return file_mode
+
+
+def write_if_changed(filename, content):
+    """atomically replace `filename` with `content` unless it already has
+    exactly that content so its mtime is left alone. Returns `True` if the
+    file was written"""
+    digest = hashlib.sha1(content.encode()).hexdigest()
+    if os.path.exists(filename) and hash_file(filename) == digest:
+        return False
+
+    # `mkstemp()` files are only readable by us, keep the mode the file
+    # already had or would get from `open()`
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        mode = new_file_mode()
+
+    dirname = os.path.dirname(filename)
+    pathlib.Path(dirname).mkdir(parents=True, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=dirname, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.chmod(temp_file, mode)
+        os.replace(temp_file, filename)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+    return True
+
+
+def render_processed_file(working_dir, filename, comment_delim, verb, data):
+    """replace all variables placeholders in filename and save the result
+    if it changed, return a tuple of (path to substituted file, changed)"""
     processed_file = get_processed_filename(working_dir, filename, data.get(constants.DATABAG_ENV_KEY))
     logger.debug(f"substitute placeholders: {filename} => {processed_file}")
     abs_filename = os.path.normpath(os.path.join(working_dir, filename))
     if os.path.exists(abs_filename):
-        # create parent directory for processed file if needed
-        pathlib.Path(os.path.dirname(processed_file)).mkdir(parents=True, exist_ok=True)
-        with open(processed_file, "w") as out_file:
-            out_file.write(f"{comment_delim} This file was automatically generated from file: {filename}, do not edit!\n")
-            with open(abs_filename, "r") as in_file:
-                out_file.write(
-                    substitute_placeholders_from_memory_to_memory(
-                        in_file.read(),
-                        verb,
-                        data,
-                    )
+        with open(abs_filename, "r") as in_file:
+            content = f"{comment_delim} This file was automatically generated from file: {filename}, do not edit!\n" + \
+                substitute_placeholders_from_memory_to_memory(
+                    in_file.read(),
+                    verb,
+                    data,
                 )
+        changed = write_if_changed(processed_file, content)
+        logger.debug(f"processed file changed: {changed}")
     else:
         raise RuntimeError(f"No such file: {abs_filename}")
+    return processed_file, changed
+
+
+def substitute_placeholders_from_file_to_file(working_dir, filename, comment_delim, verb, data):
+    """replace all variables placeholders in filename, return path to substituted file"""
+    processed_file, _ = render_processed_file(working_dir, filename, comment_delim, verb, data)
     return processed_file
 
 
 def download(url, filename):
+    import requests
     downloaded = requests.get(url, allow_redirects=True)
     open(filename, 'wb').write(downloaded.content)
 
@@ -264,7 +626,7 @@ def change_url_filename(url, filename):
 def read_yaml_file(filename):
     """read a yaml file and return it"""
     with open(filename) as f:
-        yaml_data = yaml.safe_load(f)
+        yaml_data = yaml_io.load(f)
 
     if yaml_data is None:
         raise RuntimeError(f"No YAML data in file: {filename}")
@@ -279,7 +641,7 @@ def save_yaml_file(filename, data, comment=None):
     with open(filename, "w") as f:
         if comment:
             f.write(comment)
-        yaml.dump(data, f)
+        yaml_io.dump(data, f)
 
 
 def get_connection_profile(connection, caller_name):
@@ -0,0 +1,143 @@
+# Copyright 2020 Declarative Systems Pty Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""All YAML reading and writing, using libyaml when PyYAML was built with it.
+
+CloudFormation templates are only ever read for a few top level sections so
+`cloudformation_sections()` parses just those and caches them by content.
+"""
+import re
+import json
+import hashlib
+import threading
+import yaml
+from loguru import logger
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+class Dumper(SafeDumper):
+    """writes anything `load()` can't read back, like `Decimal` from a
+    query or a tuple, as a plain string or list"""
+
+
+def represent_other(dumper, data):
+    if isinstance(data, dict):
+        return dumper.represent_dict(data)
+    if isinstance(data, (list, tuple, set)):
+        return dumper.represent_list(list(data))
+    return dumper.represent_str(str(data))
+
+
+Dumper.add_multi_representer(object, represent_other)
+
+
+def load(stream):
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def load_all(stream):
+    return yaml.load_all(stream, Loader=SafeLoader)
+
+
+def dump(data, stream=None):
+    return yaml.dump(data, stream, Dumper=Dumper)
+
+
+class CloudformationLoader(SafeLoader):
+    """understands short form intrinsic functions like `!Ref`"""
+
+
+def construct_intrinsic(loader, tag_suffix, node):
+    """`!Sub x` -> `{"Fn::Sub": x}`, matching the long form and `cfn_tools`"""
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+
+    if tag_suffix in ["Ref", "Condition"]:
+        return {tag_suffix: value}
+    if tag_suffix == "GetAtt" and isinstance(value, str):
+        value = value.split(".", 1)
+    return {f"Fn::{tag_suffix}": value}
+
+
+CloudformationLoader.add_multi_constructor("!", construct_intrinsic)
+
+# (content digest, section) -> parsed section
+cloudformation_cache = {}
+cloudformation_lock = threading.Lock()
+
+
+def load_cloudformation(text):
+    """parse a whole template, YAML or JSON"""
+    return yaml.load(text, Loader=CloudformationLoader) or {}
+
+
+def section_text(text, section):
+    """lines of top level block `section` in a YAML template or `None` if
+    it isn't written as a plain block we can cut out"""
+    match = re.search(rf"^{section}[ \t]*:[ \t]*(#.*)?$", text, re.MULTILINE)
+    if not match:
+        return None
+
+    lines = [f"{section}:"]
+    for line in text[match.end():].splitlines()[1:]:
+        if line and not line[0].isspace() and not line.startswith("#"):
+            break
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def parse_section(text, section):
+    if text.lstrip().startswith("{"):
+        return json.loads(text).get(section)
+
+    snippet = section_text(text, section)
+    if snippet is not None:
+        try:
+            return (load_cloudformation(snippet) or {}).get(section)
+        except yaml.YAMLError as e:
+            # eg an alias to an anchor outside the section
+            logger.debug(f"unable to parse {section} on its own, parsing whole template: {e}")
+    elif not re.search(rf"\b{section}\b", text):
+        return None
+
+    return load_cloudformation(text).get(section)
+
+
+def cloudformation_sections(filename, sections):
+    """dict of the requested top level `sections` of a cloudformation
+    template, missing sections are left out"""
+    with open(filename) as f:
+        text = f.read()
+
+    digest = hashlib.sha1(text.encode()).hexdigest()
+    parsed = {}
+    for section in sections:
+        with cloudformation_lock:
+            cached = cloudformation_cache.get((digest, section))
+
+        if cached is None:
+            cached = (parse_section(text, section),)
+            with cloudformation_lock:
+                cloudformation_cache[(digest, section)] = cached
+
+        if cached[0] is not None:
+            parsed[section] = cached[0]
+    return parsed
@@ -1,8 +1,18 @@
+import hashlib
 import os
 import ringmaster.api as api
+import ringmaster.channel as channel
 import ringmaster.constants as constants
 import pytest
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+import yaml
 from loguru import logger
+from ringmaster.databag import Databag
 
 
 # directory containing .env
@@ -100,3 +110,234 @@ def test_databag_init_ok():
 
     assert data.get("intermediate_databag_file") is not None
     assert data.get("intermediate_databag_file") != "stale"
+
+
+def test_plan_batches():
+    """independent adjacent cloudformation files are batched together"""
+    tempdir = tempfile.mkdtemp()
+    vpc = os.path.join(tempdir, "a.cloudformation.yaml")
+    efs = os.path.join(tempdir, "b.cloudformation.yaml")
+    db = os.path.join(tempdir, "c.cloudformation.yaml")
+    script = os.path.join(tempdir, "d.sh")
+    pathlib.Path(vpc).write_text("Outputs:\n  Vpc:\n    Export:\n      Name: !Sub \"${AWS::StackName}-id\"\n")
+    pathlib.Path(efs).write_text("Resources: {}\n")
+    pathlib.Path(db).write_text("Parameters:\n  AId:\n    Type: String\n")
+    pathlib.Path(script).write_text("true\n")
+
+    assert api.plan_batches([vpc, efs, db, script]) == [
+        (constants.PATTERN_LOCAL_CLOUDFORMATION_FILE, [vpc, efs]),
+        # needs output from vpc
+        (None, [db]),
+        (None, [script]),
+    ]
+
+    shutil.rmtree(tempdir)
+
+
+def test_check(tmp_path, monkeypatch):
+    """unresolved variables are reported and the index is saved"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".env").mkdir()
+    (tmp_path / ".env" / "databag.yaml").write_text("a: 1\n")
+    (tmp_path / "stack" / "0010").mkdir(parents=True)
+    (tmp_path / "stack" / "0010" / "vpc.cloudformation.yaml").write_text(
+        "Outputs:\n  Vpc:\n    Export:\n      Name: !Sub \"${AWS::StackName}-id\"\n"
+    )
+    (tmp_path / "stack" / "0020").mkdir()
+    (tmp_path / "stack" / "0020" / "a.kubectl.yaml").write_text("{{ a }} {{ vpc_id }} {{ b }}\n")
+
+    with pytest.raises(RuntimeError, match="1 unresolved"):
+        api.check(str(tmp_path), "stack", True, None, None)
+
+    (tmp_path / ".env" / "databag.yaml").write_text("a: 1\nb: 2\n")
+    api.check(str(tmp_path), "stack", True, None, None)
+
+    index = yaml.safe_load((tmp_path / ".env" / constants.INDEX_FILE).read_text())
+    assert index["stages"]["./stack/0010"]["produces"] == ["vpc_id"]
+    assert {"a", "b", "vpc_id"} <= set(index["stages"]["./stack/0020"]["consumes"])
+
+
+def test_plan_batches_kubectl(tmp_path):
+    """kubectl files are applied in order so only databag keys split batches"""
+    a = str(tmp_path / "a.kubectl.yaml")
+    b = str(tmp_path / "b.kubectl.yaml")
+    script = str(tmp_path / "c.sh")
+    c = str(tmp_path / "d.kubectl.yaml")
+    for filename in [a, b, c, script]:
+        pathlib.Path(filename).write_text("x: 1\n")
+
+    assert api.plan_batches([a, b, script, c]) == [
+        (constants.PATTERN_KUBECTL_FILE, [a, b]),
+        (None, [script]),
+        (None, [c]),
+    ]
+
+
+def test_import_skips_handler_sdks():
+    """handler modules and their SDKs are only imported when needed"""
+    loaded = subprocess.check_output([
+        sys.executable, "-c",
+        "import sys, ringmaster.cli; print(' '.join(sorted(sys.modules)))"
+    ]).decode().split()
+    for module in ["boto3", "snowflake.connector", "CloudFlare", "ringmaster.aws", "ringmaster.k8s"]:
+        assert module not in loaded
+
+
+def test_handler_setup_on_first_use(monkeypatch):
+    """handler modules get their connection settings when first loaded"""
+    import ringmaster.snowflake as snowflake
+    settings = []
+    monkeypatch.setattr(snowflake, "setup_connection", settings.append)
+    monkeypatch.setattr(api, "connections", {"snowflake": {"profile": "test"}})
+    monkeypatch.setattr(api, "connected_modules", set(api.CONNECTION_MODULES) - {"snowflake"})
+    monkeypatch.setattr(api, "loaded_modules", set())
+    monkeypatch.setattr(api, "handler_settings", {"snowflake": {"sessions": 3}})
+    monkeypatch.setattr(snowflake, "sessions", 1)
+
+    assert api.get_handler_for_file("a.snowflake.sql") == snowflake.do_snowflake_sql
+    assert api.get_handler_for_file("b.snowflake.sql") == snowflake.do_snowflake_sql
+    assert settings == [{"profile": "test"}]
+    assert snowflake.sessions == 3
+
+
+def test_check_connections(tmp_path, monkeypatch):
+    """profiles are checked up front without importing handler modules"""
+    (tmp_path / "config").write_text("[default]\n[profile dev]\nregion = ap-southeast-2\n")
+    (tmp_path / "credentials").write_text("[ci]\n")
+    (tmp_path / "snowflake.yaml").write_text("test:\n  region: x\n")
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(tmp_path / "config"))
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(tmp_path / "credentials"))
+    monkeypatch.setattr(constants, "SNOWFLAKE_CONFIG_FILE", str(tmp_path / "snowflake.yaml"))
+
+    for profile in ["default", "dev", "ci"]:
+        api.check_connections({"aws": {"profile": profile}, "snowflake": {"profile": "test"}, "k8s": {"profile": "c"}})
+
+    for connections, message in [
+        ({"aws": {"profile": "missing"}}, "No such profile: missing"),
+        ({"k8s": {}}, "No profile set for k8s"),
+        ({"snowflake": {"profile": "other"}}, "snowflake profile other not found"),
+    ]:
+        with pytest.raises(RuntimeError, match=message):
+            api.check_connections(connections)
+
+    monkeypatch.setattr(constants, "SNOWFLAKE_CONFIG_FILE", str(tmp_path / "missing.yaml"))
+    with pytest.raises(RuntimeError, match="snowflake settings not found"):
+        api.check_connections({"snowflake": {"profile": "test"}})
+
+
+def test_setup_connections_env_prefixes(monkeypatch):
+    """`env_prefixes` from connections.yaml limits what child processes get"""
+    monkeypatch.setattr(api, "get_env_connections", lambda: {constants.ENV_PREFIXES_KEY: ["AWS_", "eks_"]})
+    monkeypatch.setattr(api, "CONNECTION_MODULES", [])
+    monkeypatch.setattr(api.util, "env_prefixes", None)
+    api.setup_connections()
+    assert api.util.env_prefixes == ("aws_", "eks_")
+    assert "other" not in api.util.merge_env({"other": 1, "aws_region": "x"})
+
+
+def test_tool_versions_cached(tmp_path, monkeypatch):
+    """tool versions are only looked up again when the tool changes"""
+    tool = tmp_path / "fake-tool"
+    tool.write_text("#!/bin/sh\necho 1.0\n")
+    tool.chmod(0o755)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PATH", str(tmp_path))
+    monkeypatch.setattr(api, "TOOL_VERSION_COMMANDS", {"fake_version": ["fake-tool"], "missing_version": ["missing"]})
+    cmds = []
+
+    def run_cmd(cmd, data=None, **kwargs):
+        cmds.append(cmd)
+        return f"{len(cmds)}.0\n"
+
+    monkeypatch.setattr(api.util, "run_cmd", run_cmd)
+    assert api.tool_versions() == {"fake_version": "1.0", "missing_version": "not found"}
+    assert api.tool_versions() == {"fake_version": "1.0", "missing_version": "not found"}
+
+    tool.write_text("#!/bin/sh\necho 2.0 newer\n")
+    assert api.tool_versions() == {"fake_version": "2.0", "missing_version": "not found"}
+    assert len(cmds) == 2
+
+
+def test_do_bash_script(tmp_path):
+    """values come back through the intermediate databag file and pipe"""
+    script = tmp_path / "a.sh"
+    script.write_text(
+        'echo \'{"from_file": 1}\' >> $intermediate_databag_file\n'
+        'echo \'{"from_pipe": "\'$1\'"}\' > $intermediate_databag_pipe\n'
+    )
+    data = Databag(api.init_databag())
+    try:
+        api.do_bash_script(str(tmp_path), str(script), constants.UP_VERB, data)
+    finally:
+        channel.delete(data[constants.KEY_INTERMEDIATE_DATABAG])
+
+    assert data["from_file"] == 1
+    assert data["from_pipe"] == constants.UP_VERB
+    assert constants.KEY_INTERMEDIATE_DATABAG_PIPE not in data
+
+
+def test_get(tmp_path, monkeypatch):
+    """files listed in the remote metadata are downloaded and checked"""
+    content = b"echo hello\n"
+    remote_metadata = {
+        constants.METADATA_FILES_KEY: {
+            "0010-a.sh": {constants.METADATA_HASH_KEY: hashlib.sha1(content).hexdigest()},
+        },
+    }
+    urls = []
+
+    def get(url):
+        urls.append(url)
+        if url.endswith(constants.METADATA_FILE):
+            return types.SimpleNamespace(text=yaml.safe_dump(remote_metadata))
+        return types.SimpleNamespace(content=content)
+
+    monkeypatch.setitem(sys.modules, "requests", types.SimpleNamespace(get=get))
+    api.get(str(tmp_path), "https://example.com/stack")
+
+    assert urls == [
+        f"https://example.com/stack/{constants.METADATA_FILE}",
+        "https://example.com/stack/0010-a.sh",
+    ]
+    assert (tmp_path / "0010-a.sh").read_bytes() == content
+    saved = yaml.safe_load((tmp_path / constants.METADATA_FILE).read_text())
+    assert saved[constants.SOURCE_KEY] == "https://example.com/stack"
+
+    content = b"tampered\n"
+    with pytest.raises(RuntimeError, match="local hash != remote hash"):
+        api.download_files_from_metadata(str(tmp_path), remote_metadata, "https://example.com/stack")
+
+
+def test_up_skips_unchanged(tmp_path, monkeypatch):
+    """a second up skips files that haven't changed and replays the values
+    they added last time"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(api.state, "files", {})
+    monkeypatch.setattr(api.state, "force", False)
+    monkeypatch.setattr(api, "CONNECTION_MODULES", [])
+    (tmp_path / ".env").mkdir()
+    (tmp_path / ".env" / "databag.yaml").write_text("a: 1\n")
+    (tmp_path / ".env" / constants.CONNECTIONS_YAML).write_text("{}\n")
+    (tmp_path / "stack" / "0010").mkdir(parents=True)
+    (tmp_path / "stack" / "0010" / "a.sh").write_text(
+        'echo run >> runs.txt\n'
+        'echo \'{"from_a": "\'$a\'"}\' >> $intermediate_databag_file\n'
+    )
+
+    def up():
+        api.run_dir(str(tmp_path), "stack", True, None, None, constants.UP_VERB)
+        return yaml.safe_load((tmp_path / ".env" / constants.OUTPUT_DATABAG_FILE).read_text())
+
+    assert up()["from_a"] == "1"
+    assert up()["from_a"] == "1"
+    assert (tmp_path / "runs.txt").read_text() == "run\n"
+
+    # values come back from the state even if the output databag lost them
+    (tmp_path / ".env" / constants.OUTPUT_DATABAG_FILE).write_text("a: 1\n")
+    assert up()["from_a"] == "1"
+    assert (tmp_path / "runs.txt").read_text() == "run\n"
+
+    # changing a value the script can see runs it again
+    (tmp_path / ".env" / constants.OUTPUT_DATABAG_FILE).write_text("a: 2\n")
+    assert up()["from_a"] == "2"
+    assert (tmp_path / "runs.txt").read_text() == "run\nrun\n"
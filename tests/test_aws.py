@@ -1,3 +1,5 @@
+import pytest
+import threading
 import ringmaster.aws as aws
 
 
@@ -13,4 +15,179 @@ def test_eks_name_to_kubectl_context_id():
         "foo-dev",
         "us-east-1",
     )
-    assert context_id == "iam.user@foo-dev.us-east-1.eksctl.io"
\ No newline at end of file
+    assert context_id == "iam.user@foo-dev.us-east-1.eksctl.io"
+
+
+def stack_event(event_id, logical_id, status, token="t1", reason=None, resource_type="AWS::EC2::VPC"):
+    event = {
+        "EventId": event_id,
+        "LogicalResourceId": logical_id,
+        "ResourceType": resource_type,
+        "ResourceStatus": status,
+        "ClientRequestToken": token,
+    }
+    if reason:
+        event["ResourceStatusReason"] = reason
+    return event
+
+
+class FakeCloudformation:
+    """returns a growing list of stack events (newest first) each poll, two
+    events per page"""
+    def __init__(self, polls):
+        self.polls = polls
+        self.calls = 0
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        events = self.polls[min(self.calls, len(self.polls) - 1)]
+        start = int(NextToken) if NextToken else 0
+        if not NextToken:
+            self.calls += 1
+        response = {"StackEvents": events[start:start+2]}
+        if start + 2 < len(events):
+            response["NextToken"] = str(start + 2)
+        return response
+
+
+def test_watch_stack(monkeypatch):
+    """returns once the stack is complete, ignoring earlier requests"""
+    sleeps = []
+    monkeypatch.setattr(aws.time, "sleep", lambda delay: sleeps.append(delay))
+    old = stack_event("0", "stack", "UPDATE_COMPLETE", token="old", resource_type="AWS::CloudFormation::Stack")
+    started = stack_event("1", "stack", "CREATE_IN_PROGRESS", resource_type="AWS::CloudFormation::Stack")
+    vpc = stack_event("2", "vpc", "CREATE_COMPLETE")
+    done = stack_event("3", "stack", "CREATE_COMPLETE", resource_type="AWS::CloudFormation::Stack")
+    client = FakeCloudformation([
+        [started, old],
+        [started, old],
+        [vpc, started, old],
+        [done, vpc, started, old],
+    ])
+
+    aws.watch_stack(client, "id", "stack", "t1", "CREATE_COMPLETE")
+    assert client.calls == 4
+
+    # back off while nothing happens
+    assert sleeps == [aws.CLOUDFORMATION_MIN_DELAY, aws.CLOUDFORMATION_MIN_DELAY * 2, aws.CLOUDFORMATION_MIN_DELAY]
+
+
+def test_watch_stack_failed(monkeypatch):
+    """report the reason the first resource failed"""
+    monkeypatch.setattr(aws.time, "sleep", lambda delay: None)
+    client = FakeCloudformation([[
+        stack_event("4", "stack", "ROLLBACK_COMPLETE", resource_type="AWS::CloudFormation::Stack"),
+        stack_event("3", "subnet", "CREATE_FAILED", reason="Resource creation cancelled"),
+        stack_event("2", "vpc", "CREATE_FAILED", reason="CIDR overlaps"),
+        stack_event("1", "stack", "CREATE_IN_PROGRESS", resource_type="AWS::CloudFormation::Stack"),
+    ]])
+
+    with pytest.raises(RuntimeError, match="vpc: CIDR overlaps"):
+        aws.watch_stack(client, "id", "stack", "t1", "CREATE_COMPLETE")
+
+
+def test_watch_stacks(monkeypatch):
+    """wait for every stack, reporting all failures"""
+    monkeypatch.setattr(aws.time, "sleep", lambda delay: None)
+    ok = FakeCloudformation([
+        [stack_event("1", "ok", "CREATE_IN_PROGRESS", resource_type="AWS::CloudFormation::Stack")],
+        [
+            stack_event("2", "ok", "CREATE_COMPLETE", resource_type="AWS::CloudFormation::Stack"),
+            stack_event("1", "ok", "CREATE_IN_PROGRESS", resource_type="AWS::CloudFormation::Stack"),
+        ],
+    ])
+    failed = FakeCloudformation([[
+        stack_event("4", "bad", "ROLLBACK_COMPLETE", token="t2", resource_type="AWS::CloudFormation::Stack"),
+        stack_event("3", "vpc", "CREATE_FAILED", token="t2", reason="CIDR overlaps"),
+    ]])
+
+    class Client:
+        def describe_stack_events(self, StackName, NextToken=None):
+            return (ok if StackName == "ok-id" else failed).describe_stack_events(StackName, NextToken)
+
+    watches = [
+        aws.new_watch("ok-id", "ok", "t1", "CREATE_COMPLETE"),
+        aws.new_watch("bad-id", "bad", "t2", "CREATE_COMPLETE"),
+    ]
+    with pytest.raises(RuntimeError, match="stack bad ROLLBACK_COMPLETE - vpc: CIDR overlaps"):
+        aws.watch_stacks(Client(), watches)
+
+    assert watches[0]["status"] == "CREATE_COMPLETE"
+
+
+def test_batch_submit_error_kept(monkeypatch, tmp_path):
+    """a failed submit is reported even if waiting for earlier stacks fails"""
+    def submit(client, stack_name, filename, verb, data, template_body=None):
+        if stack_name == "b":
+            raise RuntimeError("submit b failed")
+        return aws.new_watch(f"{stack_name}-id", stack_name, "t1", "CREATE_COMPLETE")
+
+    def watch_stacks(client, watches):
+        assert [watch["stack_name"] for watch in watches] == ["a"]
+        raise RuntimeError("stack a ROLLBACK_COMPLETE")
+
+    monkeypatch.setattr(aws, "get_boto3_client", lambda service: None)
+    monkeypatch.setattr(aws, "submit_cloudformation", submit)
+    monkeypatch.setattr(aws, "watch_stacks", watch_stacks)
+    filenames = []
+    for name in ["a", "b"]:
+        filename = tmp_path / f"{name}.cloudformation.yaml"
+        filename.write_text("Resources: {}\n")
+        filenames.append(str(filename))
+
+    with pytest.raises(RuntimeError, match="submit b failed"):
+        aws.do_local_cloudformation_batch(str(tmp_path), filenames, "up", {})
+
+
+def test_get_boto3_client(monkeypatch):
+    """clients are created once and shared between threads"""
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.delenv("AWS_PROFILE", raising=False)
+    aws.boto3_clients.clear()
+
+    clients = []
+    threads = [
+        threading.Thread(target=lambda: clients.append(aws.get_boto3_client("cloudformation")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(map(id, clients))) == 1
+    assert aws.get_boto3_client("iam") is not clients[0]
+    assert aws.get_boto3_client("cloudformation", "us-west-2") is not clients[0]
+    assert clients[0].meta.config.retries["mode"] == aws.RETRY_MODE
+
+
+class FakeEc2:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = 0
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "describe_route_tables"
+        return self
+
+    def paginate(self, Filters):
+        self.calls += 1
+        return iter(self.pages)
+
+
+def test_route_table_for_subnet():
+    """one lookup per vpc, unassociated subnets use the main route table"""
+    aws.vpc_route_tables_cache.clear()
+    ec2 = FakeEc2([
+        {"RouteTables": [
+            {"RouteTableId": "rtb-main", "Associations": [{"Main": True}]},
+            {"RouteTableId": "rtb-a", "Associations": [{"Main": False, "SubnetId": "subnet-a"}]},
+        ]},
+        {"RouteTables": [
+            {"RouteTableId": "rtb-b", "Associations": [{"Main": False, "SubnetId": "subnet-b"}]},
+        ]},
+    ])
+
+    assert aws.route_table_for_subnet(ec2, "vpc-1", "subnet-a") == "rtb-a"
+    assert aws.route_table_for_subnet(ec2, "vpc-1", "subnet-b") == "rtb-b"
+    assert aws.route_table_for_subnet(ec2, "vpc-1", "subnet-c") == "rtb-main"
+    assert ec2.calls == 1
@@ -0,0 +1,64 @@
+import json
+import pytest
+import ringmaster.channel as channel
+from ringmaster import constants
+from ringmaster.databag import Databag
+
+
+@pytest.fixture
+def intermediate_databag():
+    filename = channel.create()
+    yield filename
+    channel.delete(filename)
+
+
+def test_read_appended(intermediate_databag):
+    """only lines written since the last read are returned"""
+    with open(intermediate_databag, "a") as f:
+        f.write('{"a": 1}\n{"b": 2}\n')
+    assert channel.read(intermediate_databag) == {"a": 1, "b": 2}
+    assert channel.read(intermediate_databag) == {}
+
+    with open(intermediate_databag, "a") as f:
+        f.write('{"c": [3]}\n')
+    assert channel.read(intermediate_databag) == {"c": [3]}
+
+
+def test_read_rewritten(intermediate_databag):
+    """scripts writing a whole JSON object over the file still work"""
+    with open(intermediate_databag, "w") as f:
+        f.write('{"a": 1}\n')
+    assert channel.read(intermediate_databag) == {"a": 1}
+
+    with open(intermediate_databag, "w") as f:
+        json.dump({"long_key_name": "long value", "b": {"c": 2}}, f, indent=2)
+    assert channel.read(intermediate_databag) == {"long_key_name": "long value", "b": {"c": 2}}
+
+    # same length and longer than what was read before
+    with open(intermediate_databag, "w") as f:
+        f.write('{"a": 2}\n')
+    assert channel.read(intermediate_databag) == {"a": 2}
+
+    with open(intermediate_databag, "w") as f:
+        f.write('{"a": 3, "b": 4}\n')
+    assert channel.read(intermediate_databag) == {"a": 3, "b": 4}
+
+    with open(intermediate_databag, "w") as f:
+        f.write("nonsense")
+    with pytest.raises(RuntimeError, match="invalid JSON"):
+        channel.read(intermediate_databag)
+
+
+def test_pipe():
+    data = Databag()
+    with channel.pipe(data):
+        pipe = data[constants.KEY_INTERMEDIATE_DATABAG_PIPE]
+        with open(pipe, "w") as f:
+            f.write('{"a": 1}\n{"b": 2}\n')
+
+    assert data == {"a": 1, "b": 2}
+
+    with pytest.raises(RuntimeError, match="invalid JSON"):
+        with channel.pipe(data):
+            with open(data[constants.KEY_INTERMEDIATE_DATABAG_PIPE], "w") as f:
+                f.write('{"a": ')
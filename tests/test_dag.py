@@ -0,0 +1,161 @@
+import os
+import threading
+import pytest
+import ringmaster.dag as dag
+
+
+examples_dir = os.path.relpath(
+    os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "examples")),
+    os.getcwd()
+)
+
+
+def example(filename):
+    return os.path.join(examples_dir, filename)
+
+
+def test_analyse_iam_policy():
+    reads, writes = dag.analyse_file(example("0010-iam/ExternalDns.iam_policy.json"))
+    assert "aws_account_id" in reads
+    assert writes == {"aws_iam_policy_external_dns"}
+
+
+def test_analyse_cloudformation():
+    """outputs are resolved to the databag names cloudformation_outputs() uses"""
+    _, writes = dag.analyse_file(example("0020-efs/efs.cloudformation.yaml"))
+    assert {"efs_efs", "efs_access_point"} <= writes
+
+
+def test_analyse_template():
+    reads, writes = dag.analyse_file(example("0170-efs-pv/pv.kubectl.yaml"))
+    assert {"efs_efs", "efs_access_point", dag.TOKEN_K8S} <= reads
+    assert "env" not in reads
+    assert writes == {dag.TOKEN_K8S}
+
+
+def test_analyse_script_is_barrier():
+    assert dag.analyse_file(example("0120-eks-cluster-access/iam_access.sh")) == (None, None)
+
+
+def test_build_graph():
+    iam_a = example("0010-iam/ExternalDns.iam_policy.json")
+    iam_b = example("0010-iam/Certbot.iam_policy.json")
+    efs = example("0020-efs/efs.cloudformation.yaml")
+    eks = example("0110-eks-cluster/cluster.eksctl.yaml")
+    pv = example("0170-efs-pv/pv.kubectl.yaml")
+    claim = example("0170-efs-pv/claim.kubectl.yaml")
+    graph = dag.build_graph([iam_a, iam_b, efs, eks, pv, claim])
+
+    # independent files
+    assert graph[iam_a] == set()
+    assert graph[iam_b] == set()
+    assert graph[efs] == set()
+
+    # eksctl writes unknown keys so waits for everything
+    assert graph[eks] == {iam_a, iam_b, efs}
+
+    # kubectl waits for eksctl, the stack outputs it uses and other k8s files
+    assert {eks, efs} <= graph[pv]
+    assert pv in graph[claim]
+
+    # down waits for everything that depended on us
+    reversed_graph = dag.reverse_graph(graph)
+    assert list(reversed_graph.keys())[0] == claim
+    assert reversed_graph[efs] == {eks, pv}
+
+
+def test_run_graph():
+    graph = {"a": set(), "b": set(), "c": {"a", "b"}}
+    lock = threading.Lock()
+    started = []
+    completed = []
+
+    def start_fn(node):
+        def run_fn():
+            with lock:
+                started.append(node)
+            return node.upper()
+        return run_fn
+
+    def done_fn(node, result):
+        completed.append(result)
+
+    dag.run_graph(graph, start_fn, done_fn, 2)
+    assert started[-1] == "c"
+    assert sorted(completed) == ["A", "B", "C"]
+
+
+def test_run_graph_raises():
+    """dependents of a failed node never start"""
+    graph = {"a": set(), "b": {"a"}}
+    started = []
+
+    def start_fn(node):
+        def run_fn():
+            started.append(node)
+            raise RuntimeError(f"failed: {node}")
+        return run_fn
+
+    with pytest.raises(RuntimeError):
+        dag.run_graph(graph, start_fn, lambda node, result: None, 2)
+
+    assert started == ["a"]
+
+
+def test_required_template_variables(tmp_path):
+    template = tmp_path / "a.kubectl.yaml"
+    template.write_text(
+        "{{ a }} {{ b | default('x') }} {% if c is defined %}{{ c }}{% endif %}{% set d = 1 %}{{ d }} {{ env.HOME }}"
+    )
+    assert dag.required_template_variables(str(template)) == {"a"}
+    assert dag.required_keys(str(template)) == [("a",)]
+
+    # optional only if every use has a default
+    template.write_text(
+        "{{ a | default('x') }} {{ a }} {{ b if b is defined else 'x' }} {% if c is undefined %}x{% else %}{{ c }}{% endif %}"
+    )
+    assert dag.required_template_variables(str(template)) == {"a"}
+
+
+def test_required_keys_cloudformation(tmp_path):
+    template = tmp_path / "a.cloudformation.yaml"
+    template.write_text("Parameters:\n  VpcId:\n    Type: String\n  Size:\n    Type: String\n    Default: '1'\n")
+    assert dag.required_keys(str(template)) == [("VpcId", "vpc_id")]
+
+
+def test_index(tmp_path, monkeypatch):
+    """analysis is reused until the file changes"""
+    template = tmp_path / "a.kubectl.yaml"
+    template.write_text("{{ a }}")
+    index_file = str(tmp_path / "index.yaml")
+    reads, _ = dag.analyse_file(str(template))
+    dag.save_index(index_file)
+
+    dag.analysis_cache.clear()
+    dag.load_index(index_file)
+    monkeypatch.setattr(dag, "analyse_uncached", lambda filename: pytest.fail("not cached"))
+    assert dag.analyse_file(str(template))[0] == reads
+
+    template.write_text("{{ b }}")
+    monkeypatch.undo()
+    assert "b" in dag.analyse_file(str(template))[0]
+
+
+def test_run_graph_keep_going():
+    """independent nodes still run after a failure, dependents are skipped"""
+    graph = {"a": set(), "b": {"a"}, "c": {"b"}, "d": set()}
+    completed = []
+
+    def start_fn(node):
+        def run_fn():
+            if node == "a":
+                raise RuntimeError("boom")
+            return node
+        return run_fn
+
+    with pytest.raises(RuntimeError) as e:
+        dag.run_graph(graph, start_fn, lambda node, result: completed.append(result), 2, keep_going=True)
+
+    assert completed == ["d"]
+    assert "3 failed" in str(e.value)
+    assert "a: boom" in str(e.value)
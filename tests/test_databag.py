@@ -0,0 +1,178 @@
+import yaml
+import os
+import ringmaster.databag as databag
+from ringmaster.databag import Databag
+import ringmaster.util as util
+from ringmaster import constants
+
+
+def test_version():
+    data = Databag({"a": 1})
+    versions = [data.version]
+    data["b"] = 2
+    data.update({"c": 3})
+    data.setdefault("c", 4)
+    versions.append(data.version)
+    data.setdefault("d", 4)
+    data.pop("d")
+    del data["c"]
+    versions.append(data.version)
+
+    assert versions == [0, 2, 5]
+    assert isinstance(data.copy(), Databag)
+
+
+def test_environment_cached():
+    data = Databag({"a": 1, "aws_region": "ap-southeast-2"})
+    env = data.environment()
+    assert env == {"a": "1", "aws_region": "ap-southeast-2"}
+    assert data.environment() is env
+
+    data["a"] = 2
+    assert data.environment()["a"] == "2"
+
+
+def test_env_prefixes(monkeypatch):
+    """only keys with an allowed prefix are passed to child processes"""
+    data = Databag({"aws_region": "ap-southeast-2", "Cluster_Name": "c", "other": "x"})
+    data.add_source("eks_cluster", {"ClusterVpc": "vpc-1", "Subnet": "y"})
+    data[constants.KEY_INTERMEDIATE_DATABAG] = "/tmp/a"
+    monkeypatch.setattr(util, "env_prefixes", None)
+    util.set_env_prefixes(["AWS_", "cluster"])
+
+    env = util.merge_env(data)
+    assert {key: env[key] for key in env if key not in util.os.environ} == {
+        "aws_region": "ap-southeast-2",
+        "Cluster_Name": "c",
+        "clustervpc": "vpc-1",
+        constants.KEY_INTERMEDIATE_DATABAG: "/tmp/a",
+    }
+    assert "other" not in util.merge_env({"other": "x", "aws_a": 1})
+    assert util.run_cmd("echo $aws_region-$other", data).strip() == "ap-southeast-2-"
+
+    util.set_env_prefixes(None)
+    assert util.merge_env(data)["other"] == "x"
+
+
+def test_merge_env():
+    data = Databag({"a": 1, "aws_region": "ap-southeast-2"})
+    env = util.merge_env(data)
+    assert env["aws_region"] == "ap-southeast-2"
+    assert env["PATH"] == util.os.environ["PATH"]
+
+    assert util.merge_env({"a": 1})["a"] == "1"
+
+
+def test_yaml():
+    assert yaml.safe_load(yaml.dump(dict(Databag({"a": 1})))) == {"a": 1}
+
+
+def test_dirty_keys():
+    data = Databag({"a": 1, "b": 2})
+    assert not data.dirty
+
+    data["c"] = 3
+    data.update(d=4)
+    data.pop("a")
+    data.setdefault("b", 5)
+    assert data.dirty == {"a", "c", "d"}
+
+
+def test_save_and_journal(tmp_path):
+    """changes are journalled until the databag is saved"""
+    filename = str(tmp_path / "output_databag.yaml")
+    data = Databag({"a": 1, "b": 2})
+    databag.save(data, filename)
+    mtime = os.stat(filename).st_mtime_ns
+
+    data["a"] = 10
+    databag.checkpoint(data, filename)
+    del data["b"]
+    databag.checkpoint(data, filename)
+    assert not data.dirty
+    assert len(open(databag.journal_filename(filename)).readlines()) == 2
+
+    # interrupted before the next save
+    resumed = Databag(yaml.safe_load(open(filename)))
+    databag.replay_journal(resumed, filename)
+    assert resumed == {"a": 10}
+
+    databag.save(data, filename)
+    assert yaml.safe_load(open(filename)) == {"a": 10}
+    assert not os.path.exists(databag.journal_filename(filename))
+
+    # nothing changed so nothing written
+    os.utime(filename, ns=(mtime, mtime))
+    databag.save(data, filename)
+    assert os.stat(filename).st_mtime_ns == mtime
+
+
+def test_replay_torn_journal(tmp_path):
+    """a half written entry from a crash is ignored"""
+    filename = str(tmp_path / "output_databag.yaml")
+    with open(databag.journal_filename(filename), "w") as f:
+        f.write('{"set": {"a": 1}, "delete": []}\n{"set": {"b"')
+
+    data = Databag()
+    databag.replay_journal(data, filename)
+    assert data == {"a": 1}
+
+
+EKS_CLUSTER = [{
+    "Name": "test",
+    "ResourcesVpcConfig": {"VpcId": "vpc-1", "SubnetIds": ["subnet-a", "subnet-b"]},
+}]
+
+
+def test_source_lookup():
+    """flattened names resolve into nested sources without being copied"""
+    data = Databag({"resourcesvpcconfig_vpcid": "stale", "a": 1})
+    data.add_source("eks_cluster", EKS_CLUSTER)
+    assert "resourcesvpcconfig_vpcid" not in dict(data)
+    assert data["resourcesvpcconfig_vpcid"] == "vpc-1"
+    assert data.get("resourcesvpcconfig_subnetids_1") == "subnet-b"
+    assert data.get("missing") is None
+    assert "resourcesvpcconfig_subnetids_0" in data.source_keys()
+
+    # not keys, like defaultdict defaults
+    assert "name" not in data
+    assert "name" not in data.keys()
+    assert len(data) == 2
+
+    # direct keys set later win
+    data["name"] = "override"
+    assert data["name"] == "override"
+    assert data.materialize(["name", "resourcesvpcconfig_vpcid", "a"]) == {"resourcesvpcconfig_vpcid": "vpc-1"}
+
+    copied = data.copy()
+    copied.add_source("eks_cluster", [{"Name": "other"}])
+    assert copied.get("resourcesvpcconfig_vpcid") is None
+    assert data["resourcesvpcconfig_vpcid"] == "vpc-1"
+
+
+def test_source_environment():
+    """values from sources are only exported when asked for"""
+    data = Databag({"a": 1})
+    data.add_source("eks_cluster", EKS_CLUSTER)
+    data["name"] = "direct"
+    assert data.environment() == {"a": "1", "name": "direct"}
+
+    env = data.environment(sources=True)
+    assert env["resourcesvpcconfig_vpcid"] == "vpc-1"
+    assert env["name"] == "direct"
+
+    data["a"] = 2
+    assert data.environment(sources=True)["a"] == "2"
+    data.add_source("eks_cluster", [{"Other": "x"}])
+    assert "resourcesvpcconfig_vpcid" not in data.environment(sources=True)
+
+
+def test_source_saved(tmp_path):
+    """sources are saved nested and still resolve after loading"""
+    filename = str(tmp_path / "output_databag.yaml")
+    data = Databag()
+    data.add_source("eks_cluster", EKS_CLUSTER)
+    databag.save(data, filename)
+
+    loaded = Databag(yaml.safe_load(open(filename)))
+    assert loaded["resourcesvpcconfig_subnetids_0"] == "subnet-a"
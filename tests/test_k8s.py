@@ -0,0 +1,306 @@
+import os
+import json
+import threading
+import http.server
+import pytest
+import yaml
+import ringmaster.k8s as k8s
+import ringmaster.util as util
+from ringmaster import constants
+
+
+@pytest.fixture
+def kubectl(monkeypatch, tmp_path):
+    """record kubectl commands, `apply` fails for any file in `broken`"""
+    monkeypatch.setattr(k8s, "kubectl_context", "test")
+    monkeypatch.setattr(k8s, "batch_apply", True)
+    k8s.sessions.clear()
+    monkeypatch.chdir(tmp_path)
+    for name in ["a", "b"]:
+        (tmp_path / f"{name}.kubectl.yaml").write_text(f"name: {name}\n")
+
+    cmds = []
+    broken = []
+
+    def run_cmd(cmd, data=None, **kwargs):
+        cmds.append(cmd)
+        errors = [f'Error from server: error when creating "{path}": nope' for path in cmd if any(b in path for b in broken)]
+        if errors:
+            raise util.CommandError("failed", "\n".join(errors))
+        return ""
+
+    monkeypatch.setattr(k8s, "run_cmd", run_cmd)
+    return cmds, broken
+
+
+def test_kubectl_batch(kubectl, tmp_path):
+    """one kubectl apply for all files, unchanged files are skipped next time"""
+    cmds, _ = kubectl
+    k8s.do_kubectl_batch(str(tmp_path), ["a.kubectl.yaml", "b.kubectl.yaml"], constants.UP_VERB, {})
+    applies = [cmd for cmd in cmds if "apply" in cmd]
+    assert len(applies) == 1
+    assert applies[0].count("-f") == 2
+
+    cmds.clear()
+    k8s.do_kubectl_batch(str(tmp_path), ["a.kubectl.yaml", "b.kubectl.yaml"], constants.UP_VERB, {})
+    assert cmds == []
+
+
+def test_kubectl_batch_failed(kubectl, tmp_path):
+    """errors are reported against the file that caused them"""
+    cmds, broken = kubectl
+    broken.append("b.kubectl.yaml")
+    with pytest.raises(RuntimeError, match="kubectl failed for: b.kubectl.yaml$"):
+        k8s.do_kubectl_batch(str(tmp_path), ["a.kubectl.yaml", "b.kubectl.yaml"], constants.UP_VERB, {})
+
+    assert os.path.exists(util.get_processed_filename(str(tmp_path), "a.kubectl.yaml", None))
+    assert not os.path.exists(util.get_processed_filename(str(tmp_path), "b.kubectl.yaml", None))
+
+
+def test_kubectl_interrupted(kubectl, tmp_path, monkeypatch):
+    """files that were never applied are not skipped next time"""
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(k8s, "apply_file", interrupted)
+    monkeypatch.setattr(k8s, "run_kubectl_paths", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        k8s.do_kubectl(str(tmp_path), "a.kubectl.yaml", constants.UP_VERB, {})
+    with pytest.raises(KeyboardInterrupt):
+        k8s.do_kubectl_batch(str(tmp_path), ["b.kubectl.yaml"], constants.UP_VERB, {})
+
+    for filename in ["a.kubectl.yaml", "b.kubectl.yaml"]:
+        assert not os.path.exists(util.get_processed_filename(str(tmp_path), filename, None))
+
+
+def test_session_cached(kubectl, tmp_path):
+    """the cluster is only checked once until a connection error"""
+    cmds, broken = kubectl
+    k8s.do_kubectl(str(tmp_path), "a.kubectl.yaml", constants.UP_VERB, {})
+    k8s.do_kustomizer(str(tmp_path), "kustomization.yaml", constants.UP_VERB, {})
+    assert len([cmd for cmd in cmds if "/readyz" in cmd]) == 1
+
+    broken.append("b.kubectl.yaml")
+    with pytest.raises(RuntimeError):
+        k8s.do_kubectl(str(tmp_path), "b.kubectl.yaml", constants.UP_VERB, {})
+    assert k8s.sessions
+
+    k8s.check_connection_error(util.CommandError("failed", "Unable to connect to the server: dial tcp: i/o timeout"))
+    assert not k8s.sessions
+
+
+def test_session_failure_not_cached(kubectl):
+    """a failed check is tried again next time"""
+    cmds, broken = kubectl
+    broken.append("/readyz")
+    assert not k8s.check_kubectl_session()
+    assert not k8s.check_kubectl_session()
+    assert not k8s.sessions
+
+    broken.clear()
+    assert k8s.check_kubectl_session()
+    assert k8s.check_kubectl_session()
+    assert len([cmd for cmd in cmds if "/readyz" in cmd]) == 3
+
+
+@pytest.fixture
+def api_server(monkeypatch, tmp_path):
+    """stub kubernetes API server recording (method, path, body)"""
+    pytest.importorskip("kubernetes")
+    requests = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def respond(self, status):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            requests.append((self.command, self.path, self.headers.get("Authorization"), body and json.loads(body)))
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def do_PATCH(self):
+            self.respond(200)
+
+        def do_DELETE(self):
+            self.respond(404)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    kubeconfig = tmp_path / "kubeconfig"
+    kubeconfig.write_text(yaml.safe_dump({
+        "apiVersion": "v1",
+        "kind": "Config",
+        "clusters": [{"name": "stub", "cluster": {"server": f"http://127.0.0.1:{server.server_port}"}}],
+        "users": [{"name": "stub", "user": {"token": "t0ken"}}],
+        "contexts": [{"name": "stub", "context": {"cluster": "stub", "user": "stub"}}],
+        "current-context": "stub",
+    }))
+    monkeypatch.setenv("KUBECONFIG", str(kubeconfig))
+    monkeypatch.setattr(k8s, "kubectl_context", "stub")
+    monkeypatch.setattr(k8s, "native_client", True)
+    k8s.api_clients.clear()
+    yield requests
+    server.shutdown()
+
+
+def test_native_secret(api_server, tmp_path, monkeypatch):
+    """secrets are applied from memory without running kubectl"""
+    monkeypatch.setattr(k8s, "run_cmd", lambda *args, **kwargs: pytest.fail("kubectl was run"))
+    monkeypatch.setattr(k8s.tempfile, "mkstemp", lambda *args, **kwargs: pytest.fail("secret written to disk"))
+    secret = tmp_path / "a.secret_kubectl.yaml"
+    secret.write_text("apiVersion: v1\nkind: Secret\nmetadata:\n  name: s\n  namespace: ns\n---\ndata:\n  password: {{ p }}\n")
+
+    k8s.do_secret_kubectl(str(tmp_path), str(secret), constants.UP_VERB, {"p": "hunter2"})
+    k8s.do_secret_kubectl(str(tmp_path), str(secret), constants.DOWN_VERB, {"p": "hunter2"})
+
+    method, path, token, body = api_server[0]
+    assert (method, path, token) == ("PATCH", "/api/v1/namespaces/ns/secrets/s?fieldManager=ringmaster&force=true", "Bearer t0ken")
+    assert body["data"] == {"password": util.base64encode("hunter2")}
+    assert api_server[1][:2] == ("DELETE", "/api/v1/namespaces/ns/secrets/s")
+
+
+def test_native_unsupported(api_server, tmp_path, monkeypatch):
+    """anything else is still applied with kubectl"""
+    cmds = []
+    monkeypatch.setattr(k8s, "run_cmd", lambda cmd, data=None, **kwargs: cmds.append(cmd))
+    processed_file = tmp_path / "a.yaml"
+    processed_file.write_text("apiVersion: apps/v1\nkind: Deployment\nmetadata:\n  name: d\n")
+    k8s.apply_file(constants.UP_VERB, str(processed_file), {})
+    assert api_server == []
+    assert any("apply" in cmd for cmd in cmds)
+
+
+@pytest.fixture
+def helm(monkeypatch, tmp_path):
+    """fake helm with repo `stable` and release `existing`, chart versions in
+    `index` are available locally"""
+    monkeypatch.setattr(k8s, "kubectl_context", "test")
+    monkeypatch.setattr(k8s, "helm_version", None)
+    monkeypatch.delenv("HELM_NAMESPACE", raising=False)
+    monkeypatch.chdir(tmp_path)
+    k8s.helm_state.clear()
+    cmds = []
+    index = {("stable/a", "1.0")}
+    descriptions = {}
+
+    def run_cmd(cmd, data=None, **kwargs):
+        cmds.append(cmd)
+        if "version" in cmd:
+            return "v3.12.0"
+        elif "config" in cmd:
+            return "context-ns"
+        elif "repo" in cmd and "list" in cmd:
+            output = [{"name": "stable", "url": "https://example.com"}]
+        elif "list" in cmd:
+            output = [{"name": "existing", "namespace": "ns"}]
+        elif "status" in cmd:
+            output = {"info": {"description": descriptions.get(cmd[cmd.index("status") + 1])}}
+        elif "upgrade" in cmd:
+            descriptions[cmd[cmd.index("--install") + 1]] = cmd[cmd.index("--description") + 1]
+            output = ""
+        elif "search" in cmd:
+            chart, version = cmd[cmd.index("repo") + 1], cmd[cmd.index("--version") + 1]
+            output = [{"name": chart, "version": version}] if (chart, version) in index else []
+        else:
+            output = ""
+        return json.dumps(output)
+
+    monkeypatch.setattr(util, "run_cmd", run_cmd)
+
+    def deploy(name, chart, version, **kwargs):
+        deploy_dir = tmp_path / name
+        deploy_dir.mkdir(exist_ok=True)
+        (deploy_dir / "helm_deploy.yaml").write_text(yaml.safe_dump({
+            "name": name, "namespace": "ns", "install": chart, "version": version,
+            "repos": {"stable": "https://example.com"}, **kwargs,
+        }))
+        return f"{name}/helm_deploy.yaml"
+
+    return cmds, deploy
+
+
+def test_helm_state_cached(helm, tmp_path):
+    """repos and releases are listed once and indexes only updated when a
+    chart version is missing"""
+    cmds, deploy = helm
+    for filename in [deploy("existing", "stable/a", "1.0"), deploy("b", "stable/a", "1.0"),
+                     deploy("c", "stable/a", "2.0"), deploy("d", "stable/a", "3.0")]:
+        k8s.do_helm(str(tmp_path), filename, constants.UP_VERB, {})
+
+    assert len([cmd for cmd in cmds if "list" in cmd]) == 2
+    assert [cmd for cmd in cmds if "update" in cmd] == [["helm", "repo", "update", "stable"]]
+    assert len([cmd for cmd in cmds if "install" in cmd]) == 3
+    assert k8s.helm_release_exists("ns", "d")
+
+
+def test_helm_old_version_and_namespace(helm, monkeypatch):
+    """older helm updates every repo, releases without a namespace are in
+    the namespace of the context"""
+    cmds, _ = helm
+    monkeypatch.setattr(k8s, "helm_version", (3, 6))
+    k8s.helm_repo_update(["stable"])
+    assert [cmd for cmd in cmds if "update" in cmd] == [["helm", "repo", "update"]]
+
+    k8s.helm_release_changed(None, "e", True)
+    assert ("context-ns", "e") in k8s.helm_state["test"][k8s.HELM_RELEASES_KEY]
+    assert k8s.helm_release_exists(None, "e")
+    assert not k8s.helm_release_exists(None, "existing")
+
+
+def test_helm_upgrade(helm, tmp_path):
+    """upgrade only runs when something changed"""
+    cmds, deploy = helm
+    for settings in [["a=1"], ["a=1"], ["a=2"]]:
+        filename = deploy("existing", "stable/a", "1.0", upgrade=True, timeout="1m", set=settings)
+        k8s.do_helm(str(tmp_path), filename, constants.UP_VERB, {})
+
+    upgrades = [cmd for cmd in cmds if "upgrade" in cmd]
+    assert len(upgrades) == 2
+    assert {"--atomic", "--wait", "1m"} <= set(upgrades[0])
+
+
+def test_helm_digest(tmp_path):
+    """the digest follows the values, not where the processed file is"""
+    config = {"install": "stable/a", "version": "1.0", "options": ["--wait"]}
+    for checkout in ["one", "two"]:
+        (tmp_path / checkout).mkdir()
+        (tmp_path / checkout / "values.yaml").write_text("a: 1\n")
+
+    digest = k8s.helm_digest(config, str(tmp_path / "one" / "values.yaml"))
+    assert digest == k8s.helm_digest(config, str(tmp_path / "two" / "values.yaml"))
+
+    (tmp_path / "two" / "values.yaml").write_text("a: 2\n")
+    assert digest != k8s.helm_digest(config, str(tmp_path / "two" / "values.yaml"))
+    assert digest != k8s.helm_digest({**config, "version": "2.0"}, str(tmp_path / "one" / "values.yaml"))
+
+
+def test_helm_batch(helm, tmp_path, monkeypatch):
+    """releases in the same namespace run in order, failures are summarised
+    and releases depending on them are skipped"""
+    _, deploy = helm
+    filenames = [
+        deploy("a", "stable/a", "1.0", namespace="one"),
+        deploy("b", "stable/a", "1.0", namespace="one"),
+        deploy("bad", "stable/a", "1.0", namespace="two"),
+        deploy("c", "stable/a", "1.0", namespace="three", depends_on=["bad"]),
+    ]
+    graph, releases = k8s.helm_graph(str(tmp_path), filenames, constants.UP_VERB, {})
+    assert graph == {filenames[0]: set(), filenames[1]: {filenames[0]}, filenames[2]: set(), filenames[3]: {filenames[2]}}
+    assert releases[filenames[2]] == "bad"
+
+    deployed = []
+
+    def do_helm(working_dir, filename, verb, data=None):
+        if "bad" in filename:
+            raise RuntimeError("boom")
+        deployed.append((util.output_prefix.get(), filename))
+
+    monkeypatch.setattr(k8s, "do_helm", do_helm)
+    with pytest.raises(RuntimeError, match=r"helm - 2 failed:\n  bad/helm_deploy.yaml: boom"):
+        k8s.do_helm_batch(str(tmp_path), filenames, constants.UP_VERB, {})
+
+    assert deployed == [("[a] ", filenames[0]), ("[b] ", filenames[1])]
+    assert util.spinners
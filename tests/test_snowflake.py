@@ -0,0 +1,171 @@
+import pytest
+import ringmaster.snowflake as snowflake
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = [{}]
+        self.description = []
+        self.results = []
+
+    def execute(self, stmt, num_statements=None):
+        if self.connection.broken:
+            raise RuntimeError("connection broken")
+        if stmt == snowflake.SESSION_CONTEXT_SQL:
+            self.rows = [self.connection.context]
+        elif stmt == "SHOW VARIABLES":
+            self.description = [("created_on",), ("name",)]
+            self.rows = [(None, name) for name in self.connection.variables]
+        else:
+            self.connection.executed.append(stmt)
+            self.results = stmt.split(";\n")[1:] if num_statements else []
+
+    def nextset(self):
+        if not self.results:
+            return None
+        if "fail" in self.results.pop(0):
+            raise RuntimeError("statement failed")
+        return self
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+        self.executed = []
+        self.context = ("ROLE", "WH", "DB", "PUBLIC")
+        self.variables = []
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+
+    def connect(**kwargs):
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(snowflake.snowflake.connector, "connect", connect)
+    monkeypatch.setattr(snowflake, "profile", "test")
+    monkeypatch.setattr(snowflake, "profile_data", {"credentials": {"account": "test"}, "region": "test"})
+    snowflake.pools.clear()
+    yield opened
+    snowflake.close_connections()
+
+
+def test_connection_reused(connections):
+    """one login per profile"""
+    data = {}
+    for _ in range(3):
+        with snowflake.get_cursor(data) as cs:
+            cs.execute("SELECT 1")
+
+    assert len(connections) == 1
+    assert data["snowflake_account"] == "test"
+
+    snowflake.close_connections()
+    assert connections[0].closed
+
+
+def test_idle_connection_checked(connections, monkeypatch):
+    """broken connections are replaced after being idle"""
+    with snowflake.get_cursor({}):
+        pass
+
+    connections[0].broken = True
+    monkeypatch.setattr(snowflake, "IDLE_CHECK_SECONDS", -1)
+    with snowflake.get_cursor({}) as cs:
+        assert cs.connection is connections[1]
+
+    assert connections[0].closed
+    assert len(connections) == 2
+
+
+def test_sessions(connections, monkeypatch):
+    """a second connection is only opened when allowed"""
+    monkeypatch.setattr(snowflake, "sessions", 2)
+    with snowflake.get_cursor({}):
+        with snowflake.get_cursor({}):
+            pass
+
+    assert len(connections) == 2
+
+
+def test_session_reset(connections):
+    """the next file gets the session the connection logged in with"""
+    with snowflake.get_cursor({}):
+        connections[0].context = ("OTHER", "WH", "OTHER_DB", "S")
+        connections[0].variables = ["A", "B"]
+
+    assert connections[0].executed == [
+        'USE ROLE "ROLE"', 'USE WAREHOUSE "WH"', 'USE DATABASE "DB"', 'USE SCHEMA "PUBLIC"', "UNSET (A, B)",
+    ]
+    assert not connections[0].closed
+
+
+def test_session_not_reset(connections):
+    """connections are closed if the session can't be put back or the file
+    failed"""
+    with snowflake.get_cursor({}):
+        # logged in without a database, there's no way back once one is used
+        snowflake.session_contexts[connections[0]] = ("ROLE", "WH", None, None)
+    assert connections[0].closed
+
+    with pytest.raises(RuntimeError, match="boom"):
+        with snowflake.get_cursor({}):
+            raise RuntimeError("boom")
+    assert connections[1].closed
+    assert snowflake.pools["test"] == {"idle": [], "open": 0}
+
+
+def test_split_statements():
+    sql = [
+        "-- comment; not a statement\n",
+        "CREATE TABLE t (a STRING);\n",
+        "INSERT INTO t VALUES ('a;b'), ('it''s;'), ('back\\'slash;');\n",
+        'SELECT "odd;name" FROM t /* comment; */ WHERE a = 1;\n',
+        "CREATE FUNCTION f() RETURNS STRING AS $$\n",
+        "  return 'x;y';\n",
+        "$$;\n",
+        "SELECT 1 -- trailing; comment\n",
+        "FROM t\n",
+        ";;\n",
+        "SELECT 2\n",
+    ]
+    assert list(snowflake.split_statements(sql)) == [
+        "CREATE TABLE t (a STRING)",
+        "INSERT INTO t VALUES ('a;b'), ('it''s;'), ('back\\'slash;')",
+        'SELECT "odd;name" FROM t   WHERE a = 1',
+        "CREATE FUNCTION f() RETURNS STRING AS $$\n  return 'x;y';\n$$",
+        "SELECT 1 \nFROM t",
+        "SELECT 2",
+    ]
+
+
+def test_split_statements_empty():
+    assert list(snowflake.split_statements(["-- nothing\n", "/* here\n", "*/;\n"])) == []
+
+
+def test_execute_statements(connections, monkeypatch):
+    monkeypatch.setattr(snowflake, "batch_statements", 2)
+    with snowflake.get_cursor({}) as cs:
+        snowflake.execute_statements(cs, iter(["SELECT 1", "SELECT 2", "SELECT 3"]))
+
+    assert connections[0].executed == ["SELECT 1;\nSELECT 2", "SELECT 3"]
+
+    with pytest.raises(RuntimeError, match="statement failed"):
+        with snowflake.get_cursor({}) as cs:
+            snowflake.execute_statements(cs, iter(["SELECT 1", "SELECT fail"]))
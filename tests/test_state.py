@@ -0,0 +1,65 @@
+import os
+import tempfile
+import shutil
+import ringmaster.state as state
+import ringmaster.constants as constants
+
+
+# directory containing .env
+root_dir = os.path.relpath(
+    os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "tests")),
+    os.getcwd()
+)
+
+test_file = os.path.join(root_dir, "teststack/0010-foo/test.kubectl.yaml")
+
+
+def test_fingerprint():
+    """fingerprint only changes when something the file uses changes"""
+    data = {"parent_value": "top", "unrelated": "a", constants.KEY_INTERMEDIATE_DATABAG: "/tmp/a"}
+    fingerprint = state.fingerprint(".", test_file, data)
+    assert fingerprint
+
+    data["unrelated"] = "b"
+    data[constants.KEY_INTERMEDIATE_DATABAG] = "/tmp/b"
+    assert state.fingerprint(".", test_file, data) == fingerprint
+
+    data["parent_value"] = "override"
+    assert state.fingerprint(".", test_file, data) != fingerprint
+
+    # missing value can't be rendered
+    assert state.fingerprint(".", test_file, {}) is None
+
+
+def test_fingerprint_remote_cloudformation(tmp_path):
+    """remote templates can change at the same URL so are never skipped"""
+    remote = tmp_path / f"vpc{constants.PATTERN_REMOTE_CLOUDFORMATION_FILE}"
+    remote.write_text("remote: https://example.com/vpc.yaml\nlocal_file: vpc.cloudformation.yaml\n")
+    assert state.fingerprint(".", str(remote), {}) is None
+
+
+def test_recorded_outputs():
+    state.record(test_file, "abc", {"foo": "bar"})
+    assert state.recorded_outputs(test_file, "abc") == {"foo": "bar"}
+    assert state.recorded_outputs(test_file, "def") is None
+    assert state.recorded_outputs(test_file, None) is None
+
+    state.forget(test_file)
+    assert state.recorded_outputs(test_file, "abc") is None
+
+
+def test_save_load():
+    tempdir = tempfile.mkdtemp()
+    state_file = os.path.join(tempdir, constants.STATE_FILE)
+    state.record(test_file, "abc", {"foo": "bar"})
+    state.save(state_file)
+
+    state.forget(test_file)
+    state.load(state_file)
+    assert state.recorded_outputs(test_file, "abc") == {"foo": "bar"}
+
+    state.delete(state_file)
+    assert not os.path.exists(state_file)
+    assert state.recorded_outputs(test_file, "abc") is None
+
+    shutil.rmtree(tempdir)
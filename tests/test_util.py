@@ -1,11 +1,14 @@
 import pytest
+import random
 import ringmaster.util as util
 import os
 from jinja2.exceptions import UndefinedError
+from jinja2 import StrictUndefined, Undefined
 import ringmaster.constants as constants
 import tempfile
 import shutil
 import pathlib
+from ringmaster.databag import Databag
 
 
 # directory containing .env
@@ -225,3 +228,173 @@ def test_substitute_placeholders_from_file_to_file_env():
     assert yaml_data["parent_value"] == data["parent_value"]
 
     shutil.rmtree(tempdir)
+
+
+def test_run_cmd():
+    assert util.run_cmd(["printf", "a\nb"]) == "a\nb"
+    assert util.run_cmd("echo $TEST_RUN_CMD", data={"TEST_RUN_CMD": 1}) == "1\n"
+
+
+def test_run_cmd_spilled(monkeypatch, tmp_path):
+    """big output goes to a log file as it arrives, only kept if the
+    command fails"""
+    monkeypatch.setattr(util, "OUTPUT_SPILL_BYTES", 4)
+    monkeypatch.setattr(util, "OUTPUT_TAIL_LINES", 2)
+    monkeypatch.setattr(util.tempfile, "tempdir", str(tmp_path))
+    expected = "".join(f"{i}\n" for i in range(1, 11))
+
+    assert util.run_cmd("seq 10") == expected
+    assert util.run_cmd("seq 10", keep_output=False) == "9\n10\n"
+    assert list(tmp_path.iterdir()) == []
+
+    with pytest.raises(util.CommandError, match="exit status:3") as e:
+        util.run_cmd("seq 10; exit 3")
+
+    assert e.value.output == "9\n10\n"
+    log_files = list(tmp_path.iterdir())
+    assert log_files[0].read_text() == "# seq 10; exit 3\n" + expected
+
+
+def test_run_cmd_spilled_long_line(monkeypatch, tmp_path):
+    """a single long line is only kept in full in the log file"""
+    monkeypatch.setattr(util, "OUTPUT_SPILL_BYTES", 1000)
+    monkeypatch.setattr(util, "OUTPUT_CHUNK_SIZE", 100)
+    monkeypatch.setattr(util, "OUTPUT_TAIL_CHARS", 50)
+    monkeypatch.setattr(util.tempfile, "tempdir", str(tmp_path))
+    cmd = "head -c 100000 /dev/zero | tr '\\0' a; echo b"
+
+    assert util.run_cmd(cmd) == "a" * 100000 + "b\n"
+    assert util.run_cmd(cmd, keep_output=False) == "a" * 48 + "b\n"
+
+
+def test_run_cmd_timeout():
+    with pytest.raises(RuntimeError, match="timed out"):
+        util.run_cmd(["sleep", "10"], timeout=0.1)
+
+
+def test_run_cmds():
+    assert util.run_cmds([["echo", "a"], ["echo", "b"]]) == ["a\n", "b\n"]
+    with pytest.raises(RuntimeError, match="exit status:1"):
+        util.run_cmds([["sleep", "10"], ["false"]])
+
+
+def test_compiled_template_cached():
+    first = util.compiled_template("{{ a }}", StrictUndefined)
+    assert util.compiled_template("{{ a }}", StrictUndefined) is first
+    assert util.compiled_template("{{ a }}", Undefined) is not first
+    assert util.substitute_placeholders_from_memory_to_memory("{{ a }} {{ env.HOME }}", constants.UP_VERB, {"a": 1}) \
+        == f"1 {os.environ['HOME']}"
+
+
+def test_render_processed_file(tmp_path):
+    """processed files are only rewritten when their content changes"""
+    (tmp_path / "a.kubectl.yaml").write_text("value: {{ a }}\n")
+    processed_file, changed = util.render_processed_file(str(tmp_path), "a.kubectl.yaml", "#", constants.UP_VERB, {"a": 1})
+    assert changed
+    mtime = os.stat(processed_file).st_mtime_ns
+
+    _, changed = util.render_processed_file(str(tmp_path), "a.kubectl.yaml", "#", constants.UP_VERB, {"a": 1})
+    assert not changed
+    assert os.stat(processed_file).st_mtime_ns == mtime
+
+    _, changed = util.render_processed_file(str(tmp_path), "a.kubectl.yaml", "#", constants.UP_VERB, {"a": 2})
+    assert changed
+    assert util.read_yaml_file(processed_file) == {"value": 2}
+    assert os.listdir(os.path.dirname(processed_file)) == ["a.kubectl.yaml"]
+
+
+def test_write_if_changed_mode(tmp_path):
+    """written files get the usual permissions, not those of a temp file"""
+    filename = str(tmp_path / "a.yaml")
+    assert util.write_if_changed(filename, "a: 1\n")
+    assert os.stat(filename).st_mode & 0o777 == util.new_file_mode()
+
+    os.chmod(filename, 0o640)
+    assert util.write_if_changed(filename, "a: 2\n")
+    assert os.stat(filename).st_mode & 0o777 == 0o640
+
+
+def test_render_with_source():
+    """templates see flattened names from nested databag sources"""
+    data = Databag({"a": 1})
+    data.add_source("eks_cluster", [{"ResourcesVpcConfig": {"VpcId": "vpc-1"}}])
+    rendered = util.substitute_placeholders_from_memory_to_memory(
+        "{{ a }} {{ resourcesvpcconfig_vpcid }}", constants.UP_VERB, data
+    )
+    assert rendered == "1 vpc-1"
+    assert util.template_variables("{{ a }} {% set b = 1 %}{{ b }}") == {"a"}
+
+
+def test_run_cmd_env_sources():
+    """every command can see values from nested sources, scripts even through
+    `${!name}`"""
+    data = Databag()
+    data.add_source("eks_cluster", {"VpcId": "vpc-1", "Other": "x"})
+    data["other"] = "direct"
+    assert util.run_cmd(["bash", "-c", "name=vpcid; echo ${!name}-$other"], data).strip() == "vpc-1-direct"
+
+    # not just scripts, eg kubectl, helm and eksctl
+    env = dict(line.split("=", 1) for line in util.run_cmd(["env"], data).splitlines() if "=" in line)
+    assert (env["vpcid"], env["other"]) == ("vpc-1", "direct")
+
+
+def old_walk(data, parent_name=None):
+    """recursive `walk()` the iterative version must match"""
+    seq_iter = data if isinstance(data, dict) else range(len(data))
+    for i in seq_iter:
+        if parent_name:
+            me = f"{parent_name}_{i}"
+        else:
+            me = i
+
+        if isinstance(data[i], dict):
+            for k, v in old_walk(data[i], parent_name=me):
+                yield k, v
+        elif isinstance(data[i], list) or isinstance(data[i], tuple):
+            for k, v in old_walk(data[i], parent_name=me):
+                yield k, v
+        else:
+            yield me, data[i]
+
+
+def random_nested(rng, depth=0):
+    """nested data with the awkward cases: falsy and non-string keys, empty
+    containers, tuples and strings"""
+    kind = rng.choice(["dict", "list", "tuple", "leaf", "leaf"] if depth < 5 else ["leaf"])
+    size = rng.randint(0, 4)
+    if kind == "dict":
+        keys = ["", 0, 1, None, "a", "B", "a_b", "Vpc", "x" * rng.randint(1, 3)]
+        return {rng.choice(keys): random_nested(rng, depth + 1) for _ in range(size)}
+    if kind == "list":
+        return [random_nested(rng, depth + 1) for _ in range(size)]
+    if kind == "tuple":
+        return tuple(random_nested(rng, depth + 1) for _ in range(size))
+    return rng.choice([None, 0, 1.5, "", "value", True, "ab"])
+
+
+def test_walk_matches_recursive():
+    rng = random.Random(1234)
+    for _ in range(2000):
+        data = random_nested(rng)
+        if not isinstance(data, (dict, list, tuple)):
+            data = [data]
+        for parent_name in [None, 0, "", "top"]:
+            expected = list(old_walk(data, parent_name))
+            assert list(util.walk(data, parent_name)) == expected
+            assert [(k, v) for k, _, v in util.walk_paths(data, parent_name)] == expected
+
+            prefix = rng.choice(["a", "b_", "1_a", "top_v", "0"])
+            assert list(util.walk(data, parent_name, prefix=prefix)) == \
+                [(k, v) for k, v in expected if str(k).lower().startswith(prefix.lower())]
+
+
+def test_walk_paths_and_depth():
+    data = [{"A": {"B": [1, {"C": 2}]}}, {"D": 3}]
+    assert list(util.walk_paths(data)) == [
+        ("A_B_0", (0, "A", "B", 0), 1),
+        ("A_B_1_C", (0, "A", "B", 1, "C"), 2),
+        ("1_D", (1, "D"), 3),
+    ]
+    assert util.flatten_nested_dict(data) == {"a_b_0": 1, "a_b_1_c": 2, "1_d": 3}
+    assert list(util.walk(data, max_depth=3)) == [("A_B", [1, {"C": 2}]), ("1_D", 3)]
+    assert util.flatten_nested_dict(data, prefix="a_b_1") == {"a_b_1_c": 2}
@@ -0,0 +1,65 @@
+import decimal
+import glob
+import os
+import json
+import pytest
+from cfn_tools import load_yaml
+import ringmaster.yaml_io as yaml_io
+
+examples_dir = os.path.join(os.path.dirname(__file__), "..", "examples")
+
+
+@pytest.mark.parametrize("filename", sorted(glob.glob(os.path.join(examples_dir, "*", "*.cloudformation.yaml"))))
+def test_cloudformation_sections_match_full_parse(filename):
+    """same result as parsing the whole template with cfn_tools"""
+    with open(filename) as f:
+        parsed = json.loads(json.dumps(load_yaml(f.read())))
+
+    sections = yaml_io.cloudformation_sections(filename, ["Parameters", "Outputs"])
+    for section in ["Parameters", "Outputs"]:
+        assert sections.get(section) == parsed.get(section)
+
+
+def test_short_form_intrinsics():
+    """short form tags parse the same as with cfn_tools"""
+    text = (
+        "Conditions:\n  Prod: !Equals [!Ref Env, prod]\n  Both: !And [!Condition Prod, !Not [!Condition Dev]]\n"
+        "Outputs:\n  Arn:\n    Value: !If [Prod, !GetAtt Vpc.Arn, !Sub '${AWS::StackName}-x']\n"
+    )
+    assert yaml_io.load_cloudformation(text) == json.loads(json.dumps(load_yaml(text)))
+
+
+def test_cloudformation_sections_cached(tmp_path, monkeypatch):
+    filename = tmp_path / "a.cloudformation.yaml"
+    filename.write_text(
+        "Resources:\n  Vpc:\n    Type: AWS::EC2::VPC\n"
+        "Parameters:\n  # comment\n  Name:\n    Type: String\n\n  Size:\n    Default: !Ref AWS::Region\n"
+        "Outputs:\n  Id:\n    Value: !GetAtt Vpc.Id\n"
+    )
+    parsed = []
+    parse_section = yaml_io.parse_section
+    monkeypatch.setattr(yaml_io, "parse_section", lambda *args: parsed.append(args) or parse_section(*args))
+
+    for _ in range(2):
+        assert yaml_io.cloudformation_sections(str(filename), ["Parameters", "Outputs", "Conditions"]) == {
+            "Parameters": {"Name": {"Type": "String"}, "Size": {"Default": {"Ref": "AWS::Region"}}},
+            "Outputs": {"Id": {"Value": {"Fn::GetAtt": ["Vpc", "Id"]}}},
+        }
+    assert len(parsed) == 3
+
+
+def test_cloudformation_sections_fallback(tmp_path):
+    """templates we can't cut sections out of are parsed whole"""
+    aliased = tmp_path / "aliased.cloudformation.yaml"
+    aliased.write_text("Mappings: &name\n  Type: String\nParameters:\n  Name: *name\n")
+    assert yaml_io.cloudformation_sections(str(aliased), ["Parameters"]) == {"Parameters": {"Name": {"Type": "String"}}}
+
+    as_json = tmp_path / "json.cloudformation.yaml"
+    as_json.write_text(json.dumps({"Parameters": {"Name": {"Type": "String"}}}))
+    assert yaml_io.cloudformation_sections(str(as_json), ["Parameters", "Outputs"]) == {"Parameters": {"Name": {"Type": "String"}}}
+
+
+def test_dump_round_trip():
+    """values safe_load can't read are written as plain types"""
+    data = {"a": decimal.Decimal("1.5"), "b": (1, 2), "c": {"d": None}}
+    assert yaml_io.load(yaml_io.dump(data)) == {"a": "1.5", "b": [1, 2], "c": {"d": None}}